@@ -85,6 +85,19 @@ const parseWardURI = ward => {
   }
 }
 
+// Every geometry table stores a copy of its geometry simplified for each of these zoom levels (see
+// `scripts/simplify.py`). A `zoom` gets the coarsest copy that is still detailed enough; no `zoom` gets full detail.
+const GEOMETRY_ZOOMS = [5, 8, 11]
+
+const geometryColumn = (alias, zoom) => {
+  const level = GEOMETRY_ZOOMS.find(level => level >= Number(zoom))
+  if (zoom !== undefined && level !== undefined) {
+    return `COALESCE(${alias}.geometry_z${level}, ${alias}.geometry)`
+  } else {
+    return `${alias}.geometry`
+  }
+}
+
 const prettifySQL = sql => {
   sql = sql.replace(/(\s*\n){2,}/g, '\n\n')
   sql = sql.replace(/(^(\s*\n)+|(\n\s*)+$)/g, '')
@@ -163,7 +176,7 @@ const statesListSQL = params => {
            st.area AS area,
            st.perimeter AS perimeter,
            st.npi AS npi,
-           ST_AsGeoJSON(st.geometry) AS geometry
+           ST_AsGeoJSON(${geometryColumn('st', params['zoom'])}) AS geometry
 
       FROM states AS st
 
@@ -250,7 +263,7 @@ const countiesListSQL = params => {
            cty.area AS area,
            cty.perimeter AS perimeter,
            cty.npi AS npi,
-           ST_AsGeoJSON(cty.geometry) AS geometry
+           ST_AsGeoJSON(${geometryColumn('cty', params['zoom'])}) AS geometry
 
       FROM counties AS cty
 
@@ -301,7 +314,7 @@ const assembliesListSQL = params => {
            asm.area AS area,
            asm.perimeter AS perimeter,
            asm.npi AS npi,
-           ST_AsGeoJSON(asm.geometry) AS geometry
+           ST_AsGeoJSON(${geometryColumn('asm', params['zoom'])}) AS geometry
 
       FROM assemblies AS asm
 
@@ -355,7 +368,7 @@ const senatesListSQL = params => {
            sen.area AS area,
            sen.perimeter AS perimeter,
            sen.npi AS npi,
-           ST_AsGeoJSON(sen.geometry) AS geometry
+           ST_AsGeoJSON(${geometryColumn('sen', params['zoom'])}) AS geometry
 
       FROM senates AS sen
 
@@ -409,7 +422,7 @@ const congressionalsListSQL = params => {
            con.area AS area,
            con.perimeter AS perimeter,
            con.npi AS npi,
-           ST_AsGeoJSON(con.geometry) AS geometry
+           ST_AsGeoJSON(${geometryColumn('con', params['zoom'])}) AS geometry
 
       FROM congressionals AS con
 
@@ -467,7 +480,7 @@ const wardsListSQL = params => {
            wrd.area AS area,
            wrd.perimeter AS perimeter,
            wrd.npi AS npi,
-           ST_AsGeoJSON(wrd.geometry) AS geometry
+           ST_AsGeoJSON(${geometryColumn('wrd', params['zoom'])}) AS geometry
 
       FROM wards AS wrd
 
@@ -537,33 +550,21 @@ const votesListSQL = params => {
                vt.total AS total,
                vt.democrat AS democrat,
                vt.republican AS republican,
-               CASE
-                 WHEN vt.democrat + vt.republican > 0
-                   THEN ((vt.democrat::REAL / (vt.democrat + vt.republican)) - 0.5) / 0.5
-                 ELSE 0
-               END AS competitiveness,
+               vt.competitiveness AS competitiveness,
                st.area AS area,
                st.perimeter AS perimeter,
                st.npi AS npi,
-               ST_AsGeoJSON(st.geometry) AS geometry
-
-          FROM (SELECT vt.state AS state,
-                       SUM(vt.total) AS total,
-                       SUM(vt.democrat) AS democrat,
-                       SUM(vt.republican) AS republican
-
-                  FROM votes AS vt
+               ST_AsGeoJSON(${geometryColumn('st', params['zoom'])}) AS geometry
 
-                 WHERE vt.state = '${params['state']}'
-                   AND vt.race = '${params['race']}'
-                   AND vt.year = '${params['year']}'
+          FROM vote_rollups AS vt
 
-                 GROUP BY vt.state) AS vt
-              
                JOIN states AS st
                ON vt.state = st.name
 
-         WHERE TRUE
+         WHERE vt.state = '${params['state']}'
+           AND vt.race = '${params['race']}'
+           AND vt.year = '${params['year']}'
+           AND vt.level = 'state'
          ${(params['within']) ? `
            AND ST_Within(st.geometry, ST_GeomFromGeoJSON('${params['within']}'))
          ` : ''}
@@ -583,40 +584,14 @@ const votesListSQL = params => {
                vt.total AS total,
                vt.democrat AS democrat,
                vt.republican AS republican,
-               CASE
-                 WHEN vt.democrat + vt.republican > 0
-                   THEN ((vt.democrat::REAL / (vt.democrat + vt.republican)) - 0.5) / 0.5
-                 ELSE 0
-               END AS competitiveness,
+               vt.competitiveness AS competitiveness,
                cty.area AS area,
                cty.perimeter AS perimeter,
                cty.npi AS npi,
-               ST_AsGeoJSON(cty.geometry) AS geometry
+               ST_AsGeoJSON(${geometryColumn('cty', params['zoom'])}) AS geometry
 
-          FROM (SELECT cty.state AS state,
-                       cty.name AS name,
-                       SUM(vt.total) AS total,
-                       SUM(vt.democrat) AS democrat,
-                       SUM(vt.republican) AS republican
-
-                  FROM votes AS vt
-
-                       JOIN wards AS wrd
-                       ON vt.state = wrd.state
-                          AND vt.ward_year = wrd.year
-                          AND vt.ward = wrd.name
-
-                       JOIN counties AS cty
-                       ON wrd.state = cty.state
-                          AND wrd.county = cty.name
+          FROM vote_rollups AS vt
 
-                 WHERE vt.state = '${params['state']}'
-                   AND vt.race = '${params['race']}'
-                   AND vt.year = '${params['year']}'
-
-                 GROUP BY cty.state,
-                          cty.name) AS vt
-              
                JOIN counties AS cty
                ON vt.state = cty.state
                   AND vt.name = cty.name
@@ -626,7 +601,10 @@ const votesListSQL = params => {
                ON cty.name = wrd.county
              ` : ''}
 
-         WHERE TRUE
+         WHERE vt.state = '${params['state']}'
+           AND vt.race = '${params['race']}'
+           AND vt.year = '${params['year']}'
+           AND vt.level = 'county'
          ${(params['within']) ? `
            AND ST_Within(cty.geometry, ST_GeomFromGeoJSON('${params['within']}'))
          ` : ''}
@@ -655,46 +633,17 @@ const votesListSQL = params => {
                vt.total AS total,
                vt.democrat AS democrat,
                vt.republican AS republican,
-               CASE
-                 WHEN vt.democrat + vt.republican > 0
-                   THEN ((vt.democrat::REAL / (vt.democrat + vt.republican)) - 0.5) / 0.5
-                 ELSE 0
-               END AS competitiveness,
+               vt.competitiveness AS competitiveness,
                asm.area AS area,
                asm.perimeter AS perimeter,
                asm.npi AS npi,
-               ST_AsGeoJSON(asm.geometry) AS geometry
+               ST_AsGeoJSON(${geometryColumn('asm', params['zoom'])}) AS geometry
 
-          FROM (SELECT asm.state AS state,
-                       asm.year AS year,
-                       asm.name AS name,
-                       SUM(vt.total) AS total,
-                       SUM(vt.democrat) AS democrat,
-                       SUM(vt.republican) AS republican
+          FROM vote_rollups AS vt
 
-                  FROM votes AS vt
-
-                       JOIN wards AS wrd
-                       ON vt.state = wrd.state
-                          AND vt.ward_year = wrd.year
-                          AND vt.ward = wrd.name
-
-                       JOIN assemblies AS asm
-                       ON wrd.state = asm.state
-                          AND wrd.year = asm.year
-                          AND wrd.assembly = asm.name
-
-                 WHERE vt.state = '${params['state']}'
-                   AND vt.race = '${params['race']}'
-                   AND vt.year = '${params['year']}'
-
-                 GROUP BY asm.state,
-                          asm.year,
-                          asm.name) AS vt
-              
                JOIN assemblies AS asm
                ON vt.state = asm.state
-                  AND vt.year = asm.year
+                  AND vt.ward_year = asm.year
                   AND vt.name = asm.name
 
              ${(params['ward']) ? `
@@ -702,7 +651,10 @@ const votesListSQL = params => {
                ON asm.name = wrd.assembly
              ` : ''}
 
-         WHERE TRUE
+         WHERE vt.state = '${params['state']}'
+           AND vt.race = '${params['race']}'
+           AND vt.year = '${params['year']}'
+           AND vt.level = 'assembly'
          ${(params['within']) ? `
            AND ST_Within(asm.geometry, ST_GeomFromGeoJSON('${params['within']}'))
          ` : ''}
@@ -732,46 +684,17 @@ const votesListSQL = params => {
                vt.total AS total,
                vt.democrat AS democrat,
                vt.republican AS republican,
-               CASE
-                 WHEN vt.democrat + vt.republican > 0
-                   THEN ((vt.democrat::REAL / (vt.democrat + vt.republican)) - 0.5) / 0.5
-                 ELSE 0
-               END AS competitiveness,
+               vt.competitiveness AS competitiveness,
                sen.area AS area,
                sen.perimeter AS perimeter,
                sen.npi AS npi,
-               ST_AsGeoJSON(sen.geometry) AS geometry
+               ST_AsGeoJSON(${geometryColumn('sen', params['zoom'])}) AS geometry
 
-          FROM (SELECT sen.state AS state,
-                       sen.year AS year,
-                       sen.name AS name,
-                       SUM(vt.total) AS total,
-                       SUM(vt.democrat) AS democrat,
-                       SUM(vt.republican) AS republican
-
-                  FROM votes AS vt
-
-                       JOIN wards AS wrd
-                       ON vt.state = wrd.state
-                          AND vt.ward_year = wrd.year
-                          AND vt.ward = wrd.name
+          FROM vote_rollups AS vt
 
-                       JOIN senates AS sen
-                       ON wrd.state = sen.state
-                          AND wrd.year = sen.year
-                          AND wrd.senate = sen.name
-
-                 WHERE vt.state = '${params['state']}'
-                   AND vt.race = '${params['race']}'
-                   AND vt.year = '${params['year']}'
-
-                 GROUP BY sen.state,
-                          sen.year,
-                          sen.name) AS vt
-              
                JOIN senates AS sen
                ON vt.state = sen.state
-                  AND vt.year = sen.year
+                  AND vt.ward_year = sen.year
                   AND vt.name = sen.name
 
              ${(params['ward']) ? `
@@ -779,7 +702,10 @@ const votesListSQL = params => {
                ON sen.name = wrd.senate
              ` : ''}
 
-         WHERE TRUE
+         WHERE vt.state = '${params['state']}'
+           AND vt.race = '${params['race']}'
+           AND vt.year = '${params['year']}'
+           AND vt.level = 'senate'
          ${(params['within']) ? `
            AND ST_Within(sen.geometry, ST_GeomFromGeoJSON('${params['within']}'))
          ` : ''}
@@ -809,46 +735,17 @@ const votesListSQL = params => {
                vt.total AS total,
                vt.democrat AS democrat,
                vt.republican AS republican,
-               CASE
-                 WHEN vt.democrat + vt.republican > 0
-                   THEN ((vt.democrat::REAL / (vt.democrat + vt.republican)) - 0.5) / 0.5
-                 ELSE 0
-               END AS competitiveness,
+               vt.competitiveness AS competitiveness,
                con.area AS area,
                con.perimeter AS perimeter,
                con.npi AS npi,
-               ST_AsGeoJSON(con.geometry) AS geometry
-
-          FROM (SELECT con.state AS state,
-                       con.year AS year,
-                       con.name AS name,
-                       SUM(vt.total) AS total,
-                       SUM(vt.democrat) AS democrat,
-                       SUM(vt.republican) AS republican
-
-                  FROM votes AS vt
-
-                       JOIN wards AS wrd
-                       ON vt.state = wrd.state
-                          AND vt.ward_year = wrd.year
-                          AND vt.ward = wrd.name
-
-                       JOIN congressionals AS con
-                       ON wrd.state = con.state
-                          AND wrd.year = con.year
-                          AND wrd.congressional = con.name
+               ST_AsGeoJSON(${geometryColumn('con', params['zoom'])}) AS geometry
 
-                 WHERE vt.state = '${params['state']}'
-                   AND vt.race = '${params['race']}'
-                   AND vt.year = '${params['year']}'
+          FROM vote_rollups AS vt
 
-                 GROUP BY con.state,
-                          con.year,
-                          con.name) AS vt
-              
                JOIN congressionals AS con
                ON vt.state = con.state
-                  AND vt.year = con.year
+                  AND vt.ward_year = con.year
                   AND vt.name = con.name
 
              ${(params['ward']) ? `
@@ -856,7 +753,10 @@ const votesListSQL = params => {
                ON con.name = wrd.congressional
              ` : ''}
 
-         WHERE TRUE
+         WHERE vt.state = '${params['state']}'
+           AND vt.race = '${params['race']}'
+           AND vt.year = '${params['year']}'
+           AND vt.level = 'congressional'
          ${(params['within']) ? `
            AND ST_Within(con.geometry, ST_GeomFromGeoJSON('${params['within']}'))
          ` : ''}
@@ -892,7 +792,7 @@ const votesListSQL = params => {
                wrd.area AS area,
                wrd.perimeter AS perimeter,
                wrd.npi AS npi,
-               ST_AsGeoJSON(wrd.geometry) AS geometry
+               ST_AsGeoJSON(${geometryColumn('wrd', params['zoom'])}) AS geometry
 
           FROM votes AS vt
               
@@ -960,7 +860,7 @@ const populationsListSQL = params => {
                st.area AS area,
                st.perimeter AS perimeter,
                st.npi AS npi,
-               ST_AsGeoJSON(st.geometry) AS geometry
+               ST_AsGeoJSON(${geometryColumn('st', params['zoom'])}) AS geometry
 
           FROM (SELECT pop.state AS state,
                        SUM(pop.total) AS total,
@@ -1007,7 +907,7 @@ const populationsListSQL = params => {
                cty.area AS area,
                cty.perimeter AS perimeter,
                cty.npi AS npi,
-               ST_AsGeoJSON(cty.geometry) AS geometry
+               ST_AsGeoJSON(${geometryColumn('cty', params['zoom'])}) AS geometry
 
           FROM (SELECT cty.state AS state,
                        cty.name AS name,
@@ -1080,7 +980,7 @@ const populationsListSQL = params => {
                asm.area AS area,
                asm.perimeter AS perimeter,
                asm.npi AS npi,
-               ST_AsGeoJSON(asm.geometry) AS geometry
+               ST_AsGeoJSON(${geometryColumn('asm', params['zoom'])}) AS geometry
 
           FROM (SELECT asm.state AS state,
                        asm.year AS year,
@@ -1158,7 +1058,7 @@ const populationsListSQL = params => {
                sen.area AS area,
                sen.perimeter AS perimeter,
                sen.npi AS npi,
-               ST_AsGeoJSON(sen.geometry) AS geometry
+               ST_AsGeoJSON(${geometryColumn('sen', params['zoom'])}) AS geometry
 
           FROM (SELECT sen.state AS state,
                        sen.year AS year,
@@ -1236,7 +1136,7 @@ const populationsListSQL = params => {
                con.area AS area,
                con.perimeter AS perimeter,
                con.npi AS npi,
-               ST_AsGeoJSON(con.geometry) AS geometry
+               ST_AsGeoJSON(${geometryColumn('con', params['zoom'])}) AS geometry
 
           FROM (SELECT con.state AS state,
                        con.year AS year,
@@ -1316,7 +1216,7 @@ const populationsListSQL = params => {
                wrd.area AS area,
                wrd.perimeter AS perimeter,
                wrd.npi AS npi,
-               ST_AsGeoJSON(wrd.geometry) AS geometry
+               ST_AsGeoJSON(${geometryColumn('wrd', params['zoom'])}) AS geometry
 
           FROM populations AS pop
               
@@ -1366,6 +1266,31 @@ const populationsListSQL = params => {
   }
 }
 
+// The shared-arc TopoJSON of the state and every county, district and ward with votes for the race and year, on the
+// latest ward vintage it was held on, built by `scripts/topojson.py`. The arcs of the vintage and the objects of the
+// race are stored serialized and apart, so only the race's counts are sent.
+const topologyGetSQL = params => {
+  return `
+    SELECT CONCAT('{"type":"Topology","bbox":', tp.bbox,
+                  ',"transform":', tp.transform,
+                  ',"objects":', obj.objects,
+                  ',"arcs":', tp.arcs, '}') AS topology
+
+      FROM topology_objects AS obj
+
+           JOIN topologies AS tp
+           ON obj.state = tp.state
+              AND obj.ward_year = tp.year
+
+     WHERE obj.state = '${params['state']}'
+       AND obj.race = '${params['race']}'
+       AND obj.year = '${params['year']}'
+
+     ORDER BY obj.ward_year DESC
+     LIMIT 1
+  `
+}
+
 ////////////////////////////////////////////////////////////////////////////////////////////////////////////////////////
 // Resource Methods
 ////////////////////////////////////////////////////////////////////////////////////////////////////////////////////////
@@ -1452,6 +1377,39 @@ const getMethod = (buildSQL, req, res) => {
   })
 }
 
+// The topology is stored serialized, so it is sent as is instead of being parsed and serialized again
+const topologyMethod = (buildSQL, req, res) => {
+  const id = uuid()
+  logRequest(id, req)
+  const sql = prettifySQL(buildSQL())
+  POOL.query(sql).then(results => {
+    if (results.rows.length > 0) {
+      res.status(STATUS_CODE_OK).type('json').send(results.rows[0]['topology'])
+      logResponse(id, sql, res)
+    } else {
+      const body = {
+        'error': {
+          'code': STATUS_CODE_NOT_FOUND,
+          'message': `Resource '${req.url}' could not be found`,
+          'status': STATUS_NOT_FOUND,
+        }
+      }
+      res.status(STATUS_CODE_NOT_FOUND).json(body)
+      logResponse(id, sql, res /*, body */)
+    }
+  }).catch(error => {
+    const body = {
+      'error': {
+        'code': STATUS_CODE_INTERNAL_SERVER_ERROR,
+        'message': `Unexpected error occurred when getting resource '${req.url}': ${error.message}`,
+        'status': STATUS_INTERNAL_SERVER_ERROR,
+      }
+    }
+    res.status(STATUS_CODE_INTERNAL_SERVER_ERROR).json(body)
+    logResponse(id, sql, res /*, body */)
+  })
+}
+
 ////////////////////////////////////////////////////////////////////////////////////////////////////////////////////////
 // App Configuration
 ////////////////////////////////////////////////////////////////////////////////////////////////////////////////////////
@@ -1477,6 +1435,7 @@ app.get('/states', (req, res) => {
       within: req.query['within'],
       intersects: req.query['intersects'],
       contains: req.query['contains'],
+      zoom: req.query['zoom'],
       county: parseCountyURI(req.query['county']),
       assembly: parseAssemblyURI(req.query['assembly']),
       senate: parseSenateURI(req.query['senate']),
@@ -1503,6 +1462,7 @@ app.get('/states/:state/counties', (req, res) => {
       within: req.query['within'],
       intersects: req.query['intersects'],
       contains: req.query['contains'],
+      zoom: req.query['zoom'],
       ward: parseWardURI(req.query['ward']),
     })
   }, req, res)
@@ -1527,6 +1487,7 @@ app.get('/states/:state/years/:year/assemblies', (req, res) => {
       within: req.query['within'],
       intersects: req.query['intersects'],
       contains: req.query['contains'],
+      zoom: req.query['zoom'],
       ward: parseWardURI(req.query['ward']),
     })
   }, req, res)
@@ -1552,6 +1513,7 @@ app.get('/states/:state/years/:year/senates', (req, res) => {
       within: req.query['within'],
       intersects: req.query['intersects'],
       contains: req.query['contains'],
+      zoom: req.query['zoom'],
       ward: parseWardURI(req.query['ward']),
     })
   }, req, res)
@@ -1577,6 +1539,7 @@ app.get('/states/:state/years/:year/congressionals', (req, res) => {
       within: req.query['within'],
       intersects: req.query['intersects'],
       contains: req.query['contains'],
+      zoom: req.query['zoom'],
       ward: parseWardURI(req.query['ward']),
     })
   }, req, res)
@@ -1602,6 +1565,7 @@ app.get('/states/:state/years/:year/wards', (req, res) => {
       within: req.query['within'],
       intersects: req.query['intersects'],
       contains: req.query['contains'],
+      zoom: req.query['zoom'],
       county: parseCountyURI(req.query['county']),
       assembly: parseAssemblyURI(req.query['assembly']),
       senate: parseSenateURI(req.query['senate']),
@@ -1632,6 +1596,7 @@ app.get('/states/:state/races/:race/years/:year/votes', (req, res) => {
       within: req.query['within'],
       intersects: req.query['intersects'],
       contains: req.query['contains'],
+      zoom: req.query['zoom'],
       county: parseCountyURI(req.query['county']),
       assembly: parseAssemblyURI(req.query['assembly']),
       senate: parseSenateURI(req.query['senate']),
@@ -1641,6 +1606,17 @@ app.get('/states/:state/races/:race/years/:year/votes', (req, res) => {
   }, req, res)
 })
 
+// Method: topologies.get
+app.get('/states/:state/races/:race/years/:year/topology', (req, res) => {
+  topologyMethod(() => {
+    return topologyGetSQL({
+      state: req.params['state'],
+      race: req.params['race'],
+      year: req.params['year'],
+    })
+  }, req, res)
+})
+
 // Method: populations.list
 app.get('/states/:state/years/:year/populations', (req, res) => {
   listMethod(() => {
@@ -1651,6 +1627,7 @@ app.get('/states/:state/years/:year/populations', (req, res) => {
       within: req.query['within'],
       intersects: req.query['intersects'],
       contains: req.query['contains'],
+      zoom: req.query['zoom'],
       county: parseCountyURI(req.query['county']),
       assembly: parseAssemblyURI(req.query['assembly']),
       senate: parseSenateURI(req.query['senate']),
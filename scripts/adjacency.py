@@ -0,0 +1,221 @@
+import argparse
+import json
+import os
+
+import numpy as np
+
+import bulk
+import db
+import metrics
+import topology
+
+########################################################################################################################
+# Ward Adjacency
+########################################################################################################################
+
+# Two wards are (rook) adjacent when they share an arc of the shared-arc topology, i.e. a boundary of positive length;
+# wards that only touch at a point are not. Arcs that belong to a single ward are on the outside of the state's wards
+# (the state boundary, or water). Since the topology matches vertices exactly, wards whose common boundary is not
+# digitized with the same vertices on both sides are not found to be adjacent.
+
+TABLE_SQL = '''
+CREATE TABLE IF NOT EXISTS gm.ward_adjacencies (
+    state           VARCHAR NOT NULL,
+
+                    FOREIGN KEY (state)
+                     REFERENCES gm.states(name),
+
+    year            CHAR(4) NOT NULL,
+    ward            VARCHAR NOT NULL,
+    neighbor        VARCHAR,
+
+                    UNIQUE (state, year, ward, neighbor),
+
+    length          REAL    NOT NULL,
+    county_boundary BOOLEAN NOT NULL,
+    state_boundary  BOOLEAN NOT NULL
+);
+'''
+
+# Every adjacent pair is stored in both directions; a ward's boundary on the outside of the state is stored as one row
+# with a NULL `neighbor` and `state_boundary` set. Lengths are geodesic miles.
+
+COLUMNS = [
+    ('state', 'text'),
+    ('year', 'text'),
+    ('ward', 'text'),
+    ('neighbor', 'text'),
+    ('length', 'real'),
+    ('county_boundary', 'boolean'),
+    ('state_boundary', 'boolean'),
+]
+
+
+def create_table(cur, drop):
+    if drop:
+        cur.execute('DROP TABLE IF EXISTS gm.ward_adjacencies;')
+    cur.execute(TABLE_SQL)
+    cur.execute('CREATE INDEX IF NOT EXISTS ward_adjacencies_state_year_ward_idx '
+                'ON gm.ward_adjacencies(state, year, ward);')
+
+
+def arc_lengths(topo):
+    if not topo.arcs:
+        return np.empty(0)
+    counts = np.array([len(arc) for arc in topo.arcs])
+    indexes = np.concatenate(topo.arcs)
+    # Every vertex but the last of each arc starts a segment
+    starts = np.ones(len(indexes), dtype=bool)
+    starts[np.cumsum(counts) - 1] = False
+    first = topo.points[indexes[:-1][starts[:-1]]]
+    second = topo.points[indexes[1:][starts[:-1]]]
+    lengths = metrics.geodesic_lengths(first[:, 0], first[:, 1], second[:, 0], second[:, 1])
+    segment_arcs = np.repeat(np.arange(len(topo.arcs)), counts - 1)
+    return np.bincount(segment_arcs, weights=lengths, minlength=len(topo.arcs)) / metrics.METERS_PER_MILE
+
+########################################################################################################################
+# Graph
+########################################################################################################################
+
+# Returns the adjacency graph of `geometries` in CSR form: the neighbours of node i are `indices[indptr[i]:indptr[i +
+# 1]]` (sorted), sharing `weights` miles of boundary, with `county_boundary` set where `counties` differ. `exterior` is
+# the length of every node's boundary that no other node shares.
+
+def graph(geometries, counties):
+    count = len(geometries)
+    topo = topology.build(geometries)
+    lengths = arc_lengths(topo)
+
+    arc_ids = []
+    owners = []
+    for index, shape in enumerate(topo.shapes):
+        for polygon in shape:
+            for ring in polygon:
+                for reference in ring:
+                    arc_ids.append(reference if reference >= 0 else ~reference)
+                    owners.append(index)
+    uses = np.unique(np.array([arc_ids, owners], dtype=np.int64).reshape(2, -1).T, axis=0)
+    arc_ids, owners = uses[:, 0], uses[:, 1]
+
+    arc_owners = np.bincount(arc_ids, minlength=len(topo.arcs))
+    single = arc_owners[arc_ids] == 1
+    exterior = np.bincount(owners[single], weights=lengths[arc_ids[single]], minlength=count)
+
+    # Uses are sorted by arc, so the owners of an arc are consecutive
+    sources = []
+    targets = []
+    edge_arcs = []
+    group_starts = np.flatnonzero(np.r_[True, arc_ids[1:] != arc_ids[:-1]])
+    for start in group_starts[arc_owners[arc_ids[group_starts]] > 1]:
+        group = owners[start:start + arc_owners[arc_ids[start]]]
+        for first in range(len(group)):
+            for second in range(first + 1, len(group)):
+                sources.extend([group[first], group[second]])
+                targets.extend([group[second], group[first]])
+                edge_arcs.extend([arc_ids[start]] * 2)
+
+    sources = np.array(sources, dtype=np.int64)
+    targets = np.array(targets, dtype=np.int64)
+    pairs, inverse = np.unique(sources * count + targets, return_inverse=True)
+    weights = np.bincount(inverse.reshape(-1), weights=lengths[np.array(edge_arcs, dtype=np.int64)],
+                          minlength=len(pairs))
+    sources, targets = pairs // count, pairs % count
+    counties = np.asarray(counties, dtype=object)
+
+    return {
+        'indptr': np.r_[0, np.cumsum(np.bincount(sources, minlength=count))].astype(np.int64),
+        'indices': targets.astype(np.int32),
+        'weights': weights,
+        'county_boundary': counties[sources] != counties[targets] if len(pairs) else np.zeros(0, dtype=bool),
+        'exterior': exterior,
+    }
+
+
+def save(path, names, csr):
+    # Uncompressed, so loading is a plain read of each array
+    np.savez(path, names=np.asarray(names, dtype=str), **csr)
+
+
+def load(path):
+    with np.load(path) as arrays:
+        return {name: arrays[name] for name in arrays.files}
+
+########################################################################################################################
+# Adjacency Stage
+########################################################################################################################
+
+# Rebuilds the adjacency of every ward vintage of a state, in `gm.ward_adjacencies` and as `<state>-<year>.npz` in
+# `directory`, whose dense node index is the position of the ward in `names` (sorted by name).
+
+def states(summaries):
+    return sorted({key.split('/')[0] for summary in summaries if summary['table'] == 'wards'
+                   for key in summary['changed'] + summary['deleted']})
+
+
+def build_state(state, directory):
+    conn = db.connection()
+    nodes = 0
+    edges = 0
+    with conn.cursor() as cur:
+        cur.execute('DELETE FROM gm.ward_adjacencies WHERE state = %s;', (state,))
+        cur.execute('''
+        SELECT year,
+               name,
+               county,
+               ST_AsGeoJSON(geometry)
+
+          FROM gm.wards
+
+         WHERE state = %s
+
+         ORDER BY year,
+                  name;
+        ''', (state,))
+        years = {}
+        for year, name, county, geometry in cur.fetchall():
+            years.setdefault(year, []).append((name, county, json.loads(geometry)))
+
+        writer = bulk.CopyWriter(cur, 'gm.ward_adjacencies', COLUMNS)
+        for year, wards in years.items():
+            names = [name for name, _, _ in wards]
+            csr = graph([geometry for _, _, geometry in wards], [county for _, county, _ in wards])
+            for node, name in enumerate(names):
+                for edge in range(csr['indptr'][node], csr['indptr'][node + 1]):
+                    writer.write((state, year, name, names[csr['indices'][edge]], csr['weights'][edge],
+                                  csr['county_boundary'][edge], False))
+                if csr['exterior'][node] > 0:
+                    writer.write((state, year, name, None, csr['exterior'][node], False, True))
+            os.makedirs(directory, exist_ok=True)
+            save(os.path.join(directory, '{}-{}.npz'.format(state, year)), names, csr)
+            nodes += len(names)
+            edges += len(csr['indices']) // 2
+        writer.close()
+    conn.commit()
+    return [{'table': 'ward_adjacencies', 'derived': '{} wards, {} adjacent pairs'.format(nodes, edges)}]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rebuild the ward adjacency graph in `gm.ward_adjacencies` and as '
+                                                 'CSR arrays.')
+    parser.add_argument('states', nargs='*', help='states to rebuild (default: all)')
+    parser.add_argument('--output', default='adjacency', help='directory of the .npz files (default: adjacency)')
+    args = parser.parse_args()
+
+    conn = db.connect()
+    cur = conn.cursor()
+    create_table(cur, drop=False)
+    conn.commit()
+    selected = args.states
+    if not selected:
+        cur.execute('SELECT DISTINCT state FROM gm.wards ORDER BY state;')
+        selected = [row[0] for row in cur.fetchall()]
+    cur.close()
+    conn.close()
+
+    for state in selected:
+        for summary in build_state(state, args.output):
+            print('{} gm.{}: {}'.format(state, summary['table'], summary['derived']))
+
+
+if __name__ == '__main__':
+    main()
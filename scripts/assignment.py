@@ -0,0 +1,219 @@
+import argparse
+import json
+
+import numpy as np
+
+import bulk
+import db
+import features
+import incremental
+import layers
+import spatial
+
+########################################################################################################################
+# Overlay
+########################################################################################################################
+
+# Apportions every source polygon among the target polygons it overlaps, by area. Each source is sampled with the
+# centers of a `grid` x `grid` lattice over its bounding box, and the share of its samples inside each target
+# (tested only against the targets whose boxes the STR-tree finds overlapping the source's box) estimates the share of
+# its area inside that target. Samples are interior points, so boundaries that sources and targets share, which is
+# the common case of districts drawn along ward lines, never make a source look split; slivers smaller than about one
+# sample (1 / grid^2 of the box) are ignored. A source too thin to contain any sample falls back to the whole lattice.
+#
+# Returns (source, target, weight) arrays, the weights of a source summing to the share of it covered by any target.
+
+def overlay(sources, targets, grid=16):
+    source_index = spatial.EdgeIndex(sources)
+    target_index = spatial.EdgeIndex(targets)
+    boxes = source_index.boxes
+
+    offsets = (np.arange(grid) + 0.5) / grid
+    fractions = np.stack(np.meshgrid(offsets, offsets), axis=-1).reshape(-1, 2)
+    owners = np.repeat(np.arange(len(sources)), len(fractions))
+    points = boxes[owners, :2] + np.tile(fractions, (len(sources), 1)) * (boxes[owners, 2:] - boxes[owners, :2])
+    inside = source_index.contains(points, owners)
+    empty = np.bincount(owners[inside], minlength=len(sources)) == 0
+    inside |= empty[owners]
+    points, owners = points[inside], owners[inside]
+    samples = np.bincount(owners, minlength=len(sources))
+
+    tree = spatial.STRtree(target_index.boxes)
+    candidate_sources, candidate_targets = tree.query(boxes)
+    per_source = np.bincount(candidate_sources, minlength=len(sources))
+    source_starts = np.r_[0, np.cumsum(per_source)]
+
+    # Every (sample, candidate target of its source) pair
+    point_counts = per_source[owners]
+    point_ids = np.repeat(np.arange(len(points)), point_counts)
+    pair_targets = candidate_targets[np.repeat(source_starts[owners] - np.cumsum(point_counts) + point_counts,
+                                               point_counts) + np.arange(point_counts.sum())]
+    hits = target_index.contains(points[point_ids], pair_targets)
+
+    pairs, counts = np.unique(owners[point_ids[hits]] * len(targets) + pair_targets[hits], return_counts=True)
+    source, target = pairs // max(len(targets), 1), pairs % max(len(targets), 1)
+    return source, target, counts / samples[source]
+
+
+def apportion(source, target, weights, values, target_count):
+    # Source values (n, ...) -> target values (target_count, ...): one sparse multiply by the overlay weights
+    values = np.asarray(values, dtype=np.float64)
+    result = np.zeros((target_count,) + values.shape[1:])
+    np.add.at(result, target, values[source] * weights.reshape((-1,) + (1,) * (values.ndim - 1)))
+    return result
+
+########################################################################################################################
+# Plan Assignments
+########################################################################################################################
+
+# A plan is a set of district polygons that did not come with the wards, e.g. a proposed or court-ordered map, declared
+# under `plans` in `sources/<state>.json` with its `name`, `ward_year`, `name_property` and `geojson`. Every ward is
+# assigned to the districts it overlaps with the share of its area in each (`weight`), by which its votes and population
+# are apportioned. A ward split between districts has several rows; a ward outside every district has none.
+
+TABLE_SQL = '''
+CREATE TABLE IF NOT EXISTS gm.plan_assignments (
+    plan      VARCHAR NOT NULL,
+    state     VARCHAR NOT NULL,
+
+              FOREIGN KEY (state)
+               REFERENCES gm.states(name),
+
+    ward_year CHAR(4) NOT NULL,
+    ward      VARCHAR NOT NULL,
+    district  VARCHAR NOT NULL,
+
+              UNIQUE (plan, state, ward_year, ward, district),
+
+    weight    REAL    NOT NULL
+);
+'''
+
+COLUMNS = [
+    ('plan', 'text'),
+    ('state', 'text'),
+    ('ward_year', 'text'),
+    ('ward', 'text'),
+    ('district', 'text'),
+    ('weight', 'real'),
+]
+
+
+def create_table(cur, drop):
+    if drop:
+        cur.execute('DROP TABLE IF EXISTS gm.plan_assignments;')
+    cur.execute(TABLE_SQL)
+
+
+def read_plan(plan_meta):
+    names = []
+    geometries = []
+    for feature in features.read_features(plan_meta['geojson']):
+        names.append(layers.sanitize(str(feature['properties'][plan_meta['name_property']])))
+        geometries.append(feature['geometry'])
+    return names, geometries
+
+
+def read_wards(cur, state, ward_year):
+    cur.execute('''
+    SELECT name,
+           ST_AsGeoJSON(geometry)
+
+      FROM gm.wards
+
+     WHERE state = %s
+       AND year = %s
+
+     ORDER BY name;
+    ''', (state, ward_year))
+    rows = cur.fetchall()
+    return [name for name, _ in rows], [json.loads(geometry) for _, geometry in rows]
+
+
+def assign_plan(plan_meta, force=True):
+    # Skips a plan whose source is unchanged unless `force`d, e.g. because its state's wards changed
+    conn = db.connection()
+    with conn.cursor() as cur:
+        manifest = incremental.Manifest(cur)
+        layer = 'gm.plan_assignments'
+        source = plan_meta['geojson']
+        if not force and manifest.stored_source_hash(layer, source) == manifest.source_hash(source):
+            return []
+
+        state, ward_year, plan = plan_meta['state'], plan_meta['ward_year'], plan_meta['name']
+        district_names, district_geometries = read_plan(plan_meta)
+        ward_names, ward_geometries = read_wards(cur, state, ward_year)
+        ward, district, weights = overlay(ward_geometries, district_geometries)
+
+        cur.execute('DELETE FROM gm.plan_assignments WHERE plan = %s AND state = %s AND ward_year = %s;',
+                    (plan, state, ward_year))
+        writer = bulk.CopyWriter(cur, 'gm.plan_assignments', COLUMNS)
+        for ward_position, district_position, weight in zip(ward, district, weights):
+            writer.write((plan, state, ward_year, ward_names[ward_position], district_names[district_position],
+                          weight))
+        writer.close()
+        manifest.record_source(layer, source)
+    conn.commit()
+
+    split = int(np.sum(np.bincount(ward, minlength=len(ward_names)) > 1))
+    unassigned = int(np.sum(np.bincount(ward, minlength=len(ward_names)) == 0))
+    return [{'table': 'plan_assignments', 'derived': '{}: {} wards assigned to {} districts, {} split, {} outside the '
+                                                     'plan'.format(plan, len(ward_names), len(district_names), split,
+                                                                   unassigned)}]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Assign the wards of a state to the districts of a plan given as '
+                                                 'district polygons, with area-weighted shares for split wards, and '
+                                                 'print the apportioned population of every district.')
+    parser.add_argument('geojson', help='district polygons of the plan')
+    parser.add_argument('--plan', required=True, help='name of the plan')
+    parser.add_argument('--state', required=True, help='sanitized state name, e.g. wisconsin')
+    parser.add_argument('--ward-year', required=True, help='ward vintage to assign, e.g. 2011')
+    parser.add_argument('--name-property', required=True, help='feature property holding the district name')
+    args = parser.parse_args()
+
+    plan_meta = {'name': args.plan, 'state': args.state, 'ward_year': args.ward_year,
+                 'name_property': args.name_property, 'geojson': args.geojson}
+    conn = db.connect()
+    cur = conn.cursor()
+    create_table(cur, drop=False)
+    conn.commit()
+    cur.close()
+    conn.close()
+
+    for summary in assign_plan(plan_meta):
+        print('{} gm.{}: {}'.format(args.state, summary['table'], summary['derived']))
+
+    conn = db.connect()
+    cur = conn.cursor()
+    cur.execute('''
+    SELECT pa.district,
+           pop.year,
+           SUM(pop.total * pa.weight)
+
+      FROM gm.plan_assignments AS pa
+
+           JOIN gm.populations AS pop
+           ON pa.state = pop.state
+              AND pa.ward_year = pop.ward_year
+              AND pa.ward = pop.ward
+
+     WHERE pa.plan = %s
+       AND pa.state = %s
+       AND pa.ward_year = %s
+
+     GROUP BY pa.district,
+              pop.year
+
+     ORDER BY pa.district,
+              pop.year;
+    ''', (args.plan, args.state, args.ward_year))
+    for district, year, total in cur.fetchall():
+        print('    {} ({}): {:.0f}'.format(district, year, total))
+    cur.close()
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,417 @@
+import argparse
+import datetime
+import json
+import math
+import os
+import platform
+import statistics
+import subprocess
+import time
+
+import numpy as np
+
+import db
+import features
+import ingest
+import layers
+import schedule
+import spatial
+import staging
+
+########################################################################################################################
+# Scales
+########################################################################################################################
+
+# Wisconsin has about 7,000 wards and the country about 175,000 precincts. Every scale can be overridden from the
+# command line, e.g. `--scale national --vertices 32` for denser geometries.
+
+SCALES = {
+    'state': {'states': 1, 'wards': 7000},
+    'region': {'states': 10, 'wards': 50000},
+    'national': {'states': 50, 'wards': 175000},
+}
+
+STATES_GEOJSON = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data', 'us-states.geojson')
+TEMPLATE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sources', 'wisconsin.json')
+
+# A benchmark drops and rebuilds every table, so it runs in its own schema (created by `setup.sh`) rather than `gm`
+SCHEMA = 'gm_benchmark'
+
+# Roughly the wards per county and the number of districts of every plan
+WARDS_PER_COUNTY = 100
+DISTRICTS = {'assemblies': 99, 'senates': 33, 'congressionals': 8}
+
+########################################################################################################################
+# Synthetic Sources
+########################################################################################################################
+
+# Every state gets its share of the wards as a grid of rectangles over its bounding box, with `vertices` vertices per
+# side so that geometry costs can be scaled independently of the ward count. Neighboring wards share their side's
+# vertices exactly, like real ward files. Counties and districts are blocks of the grid. The wards carry the same
+# properties as the Wisconsin election file, `sources/wisconsin.json` is the template of every state's sources, and
+# `races` (race, year) pairs are taken from it (repeating its races under new names past its last pair), so the data
+# goes through exactly the same ingest path as the real sources.
+
+def race_metas(count):
+    with open(TEMPLATE, 'r') as template_file:
+        template = json.load(template_file)['votes'][0]['races']
+    pairs = [(race, meta) for race, metas in template.items() for meta in metas]
+    races = {}
+    for position in range(count):
+        race, meta = pairs[position % len(pairs)]
+        if position >= len(pairs):
+            race = '{}_{}'.format(race, position // len(pairs) + 1)
+            meta = {key: value if key == 'year' else '{}{}'.format(value, position // len(pairs) + 1)
+                    for key, value in meta.items()}
+        races.setdefault(race, []).append(meta)
+    return races
+
+
+def side(start, end, vertices):
+    # Points from `start` towards `end`, excluding `end`, computed the same way in both directions
+    if start <= end:
+        return [(start[0] + (end[0] - start[0]) * step / vertices, start[1] + (end[1] - start[1]) * step / vertices)
+                for step in range(vertices)]
+    return [start] + side(end, start, vertices)[:0:-1]
+
+
+def rectangle(box, vertices):
+    corners = [(box[0], box[1]), (box[2], box[1]), (box[2], box[3]), (box[0], box[3])]
+    ring = [point for first, second in zip(corners, corners[1:] + corners[:1])
+            for point in side(first, second, vertices)]
+    return {'type': 'Polygon', 'coordinates': [[list(point) for point in ring + ring[:1]]]}
+
+
+def blocks(rows, columns, count):
+    # Block of every grid cell when splitting the grid into about `count` blocks
+    across = max(int(round(math.sqrt(count * columns / rows))), 1)
+    down = max(-(-count // across), 1)
+    row, column = np.divmod(np.arange(rows * columns), columns)
+    return (row * down // rows) * across + column * across // columns
+
+
+def write_collection(path, collection):
+    # Streams (properties, geometry) pairs, so national-sized files are never held as one document
+    with open(path, 'w') as collection_file:
+        collection_file.write('{"type": "FeatureCollection", "features": [\n')
+        for position, (properties, geometry) in enumerate(collection):
+            collection_file.write(',\n' if position else '')
+            json.dump({'type': 'Feature', 'properties': properties, 'geometry': geometry}, collection_file)
+        collection_file.write('\n]}\n')
+
+
+def write_state(directory, state, box, count, vertices, races, rng):
+    columns = max(int(math.ceil(math.sqrt(count))), 1)
+    rows = max(-(-count // columns), 1)
+    xs = np.linspace(box[0], box[2], columns + 1)
+    ys = np.linspace(box[1], box[3], rows + 1)
+    row, column = np.divmod(np.arange(count), columns)
+    cells = np.stack([xs[column], ys[row], xs[column + 1], ys[row + 1]], axis=1)
+
+    groups = {'counties': blocks(rows, columns, max(count // WARDS_PER_COUNTY, 1))[:count]}
+    for table, districts in DISTRICTS.items():
+        groups[table] = blocks(rows, columns, min(districts, count))[:count]
+    paths = {}
+    for table, group in groups.items():
+        ids = np.unique(group)
+        group_boxes = np.full((len(ids), 4), np.nan)
+        positions = np.searchsorted(ids, group)
+        for axis, reduce in enumerate([np.fmin, np.fmin, np.fmax, np.fmax]):
+            reduce.at(group_boxes[:, axis], positions, cells[:, axis])
+        groups[table] = positions
+        paths[table] = os.path.join(directory, 'data', '{}-{}.geojson'.format(state, table))
+        name_property = 'COUNTY_NAME' if table == 'counties' else 'NAME'
+        write_collection(paths[table], (({name_property: ('County {}' if table == 'counties' else '{}').format(
+            position + 1)}, rectangle(group_box, 1)) for position, group_box in enumerate(group_boxes)))
+
+    # Partisanship varies by county and by ward, turnout by ward
+    lean = rng.normal(0.5, 0.1, groups['counties'].max() + 1)[groups['counties']]
+    election_properties = [{} for _ in range(count)]
+    for metas in races.values():
+        for meta in metas:
+            totals = rng.poisson(600, count)
+            democrat = np.rint(totals * 0.97 * np.clip(rng.normal(lean, 0.05), 0, 1)).astype(int)
+            republican = np.rint(totals * 0.97).astype(int) - democrat
+            for properties, values in zip(election_properties, zip(totals, democrat, republican)):
+                for key, value in zip(['total_property', 'democrat_property', 'republican_property'], values):
+                    properties[meta[key]] = int(value)
+    persons = rng.poisson(1200, count)
+    shares = rng.dirichlet([60, 8, 1, 4, 0.2, 10], count)
+
+    population_properties = ['WHITE18', 'BLACK18', 'AMINDIAN18', 'ASIAN18', 'PISLAND18', 'HISPANIC18']
+
+    def wards():
+        for position in range(count):
+            properties = {
+                'CNTY_NAME': 'County {}'.format(groups['counties'][position] + 1),
+                'LABEL': 'Ward {}'.format(position + 1),
+                'ASM': str(groups['assemblies'][position] + 1),
+                'SEN': str(groups['senates'][position] + 1),
+                'CON': str(groups['congressionals'][position] + 1),
+                'PERSONS18': int(persons[position]),
+            }
+            properties.update(election_properties[position])
+            properties.update({key: int(value) for key, value in zip(population_properties,
+                                                                     np.rint(persons[position] * shares[position]))})
+            yield properties, rectangle(cells[position], vertices)
+
+    wards_path = os.path.join(directory, 'data', '{}-wards.geojson'.format(state))
+    write_collection(wards_path, wards())
+
+    with open(TEMPLATE, 'r') as template_file:
+        sources = json.load(template_file)
+    sources['state'] = state
+    sources['counties'][0]['geojson'] = paths['counties']
+    for table in DISTRICTS:
+        sources[table][0].update(name_property='NAME', geojson=paths[table])
+    sources['wards'][0]['geojson'] = wards_path
+    sources['votes'][0].update(geojson=wards_path, races=races)
+    sources['populations'][0]['geojson'] = wards_path
+    with open(os.path.join(directory, 'sources', state + '.json'), 'w') as sources_file:
+        json.dump(sources, sources_file, indent=4)
+
+
+def generate(directory, states, wards, vertices, races, seed):
+    # Deterministic for the same arguments, so a generated directory is reused by later runs
+    os.makedirs(os.path.join(directory, 'data'), exist_ok=True)
+    os.makedirs(os.path.join(directory, 'sources'), exist_ok=True)
+    rng = np.random.default_rng(seed)
+    state_features = list(features.read_features(STATES_GEOJSON))[:states]
+    boxes = spatial.bounds([feature['geometry'] for feature in state_features])
+    metas = race_metas(races)
+    for position, (feature, box) in enumerate(zip(state_features, boxes)):
+        count = wards // len(state_features) + (1 if position < wards % len(state_features) else 0)
+        write_state(directory, layers.sanitize(feature['properties']['name']), box, count, vertices, metas, rng)
+    with open(os.path.join(directory, 'sources', 'states.json'), 'w') as sources_file:
+        json.dump([{'name_property': 'name', 'geojson': os.path.abspath(STATES_GEOJSON)}], sources_file, indent=4)
+
+########################################################################################################################
+# Queries
+########################################################################################################################
+
+# The grouped votes the API serves, from the rollups and (for wards and for comparison) aggregated from `gm.votes`,
+# for one race of one state.
+
+QUERIES = {
+    'votes by state': '''
+    SELECT vt.total, vt.democrat, vt.republican, vt.competitiveness, st.area, st.perimeter, st.npi
+      FROM gm.vote_rollups AS vt
+           JOIN gm.states AS st
+           ON vt.state = st.name
+     WHERE vt.state = %(state)s AND vt.race = %(race)s AND vt.year = %(year)s AND vt.level = 'state';
+    ''',
+    'votes by county': '''
+    SELECT cty.name, vt.total, vt.democrat, vt.republican, vt.competitiveness, cty.area, cty.perimeter, cty.npi
+      FROM gm.vote_rollups AS vt
+           JOIN gm.counties AS cty
+           ON vt.state = cty.state AND vt.name = cty.name
+     WHERE vt.state = %(state)s AND vt.race = %(race)s AND vt.year = %(year)s AND vt.level = 'county';
+    ''',
+    'votes by assembly': '''
+    SELECT asm.name, vt.total, vt.democrat, vt.republican, vt.competitiveness, asm.area, asm.perimeter, asm.npi
+      FROM gm.vote_rollups AS vt
+           JOIN gm.assemblies AS asm
+           ON vt.state = asm.state AND vt.ward_year = asm.year AND vt.name = asm.name
+     WHERE vt.state = %(state)s AND vt.race = %(race)s AND vt.year = %(year)s AND vt.level = 'assembly';
+    ''',
+    'votes by assembly, aggregated': '''
+    SELECT wrd.assembly, SUM(vt.total), SUM(vt.democrat), SUM(vt.republican)
+      FROM gm.votes AS vt
+           JOIN gm.wards AS wrd
+           ON vt.state = wrd.state AND vt.ward_year = wrd.year AND vt.ward = wrd.name
+     WHERE vt.state = %(state)s AND vt.race = %(race)s AND vt.year = %(year)s
+     GROUP BY wrd.assembly;
+    ''',
+    'votes by ward': '''
+    SELECT wrd.name, vt.total, vt.democrat, vt.republican, vt.competitiveness, wrd.area, wrd.perimeter, wrd.npi,
+           ST_AsGeoJSON(wrd.geometry)
+      FROM gm.votes AS vt
+           JOIN gm.wards AS wrd
+           ON vt.state = wrd.state AND vt.ward_year = wrd.year AND vt.ward = wrd.name
+     WHERE vt.state = %(state)s AND vt.race = %(race)s AND vt.year = %(year)s;
+    ''',
+    'populations by state': '''
+    SELECT SUM(total), SUM(white), SUM(black), SUM(american_indian), SUM(asian), SUM(pacific_islander), SUM(hispanic)
+      FROM gm.populations
+     WHERE state = %(state)s;
+    ''',
+}
+
+
+def time_queries(cur, parameters, repeat):
+    timings = {}
+    for name, query in QUERIES.items():
+        seconds = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            cur.execute(query, parameters)
+            rows = len(cur.fetchall())
+            seconds.append(time.perf_counter() - start)
+        timings[name] = {'min': min(seconds), 'median': statistics.median(seconds), 'rows': rows}
+    return timings
+
+########################################################################################################################
+# Runs
+########################################################################################################################
+
+# A run times every stage of a full ingest of the synthetic sources separately, each with all workers: creating the
+# tables, loading (with partition attaches), building the indexes, every kind of derived task (rollups, simplification,
+# adjacency, snapshots, crosswalks, lookups, topologies) and analyzing, then the queries, each `repeat` times.
+
+def run(directory, options, workers, repeat):
+    states_meta, state_sources = ingest.read_sources(os.path.join(directory, 'sources'))
+    db.use_schema(SCHEMA)
+    conn = db.connect()
+    cur = conn.cursor()
+    stages = {}
+
+    def timed(stage, function, *args):
+        start = time.perf_counter()
+        result = function(*args)
+        conn.commit()
+        stages[stage] = time.perf_counter() - start
+        print('{}: {:.2f} s'.format(stage, stages[stage]))
+        return result
+
+    staging.clear(cur, SCHEMA)
+    conn.commit()
+    timed('tables', ingest.create_tables, cur, options, state_sources)
+
+    tasks = ingest.build_tasks(options, states_meta, state_sources)
+    loads = {name: task for name, task in tasks.items() if not name.startswith('indexes/')}
+    indexes = {name: task._replace(dependencies=[]) for name, task in tasks.items() if name.startswith('indexes/')}
+    results = timed('load', schedule.run, loads, workers)
+    timed('indexes', schedule.run, indexes, workers)
+
+    # Every kind of derived task is timed on its own; kinds that depend on another kind (the topologies on the rollups)
+    # run after the others
+    kinds = {}
+    dependent = set()
+    for name, task in ingest.build_derived_tasks(options, state_sources, results).items():
+        kinds.setdefault(name.split('/')[1], {})[name] = task._replace(dependencies=[])
+        if task.dependencies:
+            dependent.add(name.split('/')[1])
+    for kind, kind_tasks in sorted(kinds.items(), key=lambda item: (item[0] in dependent, item[0])):
+        timed('derived/' + kind, schedule.run, kind_tasks, workers)
+    timed('analyze', staging.analyze, cur, SCHEMA)
+
+    rows = {}
+    for table in layers.TABLES:
+        cur.execute('SELECT COUNT(*) FROM gm.{};'.format(table))
+        rows[table] = cur.fetchone()[0]
+
+    state = sorted(state_sources)[0]
+    race, metas = next(iter(state_sources[state]['votes'][0]['races'].items()))
+    queries = time_queries(cur, {'state': state, 'race': race, 'year': metas[0]['year']}, repeat)
+    cur.close()
+    conn.close()
+    db.use_schema(db.SCHEMA)
+    return stages, queries, rows
+
+
+def commit():
+    # Commit the tree was at, marked `+` when it had uncommitted changes
+    scripts = os.path.dirname(os.path.abspath(__file__))
+    try:
+        head = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=scripts, capture_output=True, text=True,
+                              check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=scripts,
+                               capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return head + ('+' if dirty else '')
+
+
+def compare(path, scale, parameters, count):
+    # Stage and query times of the last `count` runs with the same parameters, oldest first
+    with open(path, 'r') as results_file:
+        records = [json.loads(line) for line in results_file if line.strip()]
+    records = [record for record in records if record['scale'] == scale and record['parameters'] == parameters]
+    records = records[-count:]
+    if not records:
+        print('No {} runs with {} in {}'.format(scale, json.dumps(parameters), path))
+        return
+
+    rows = [(stage, [record['stages'].get(stage) for record in records]) for stage in records[-1]['stages']]
+    rows += [(query, [record['queries'].get(query, {}).get('median') for record in records])
+             for query in records[-1]['queries']]
+    width = max(len(name) for name, _ in rows)
+    print(' ' * width + ''.join('{:>12}'.format(record['commit']) for record in records) + '{:>10}'.format('change'))
+    for name, seconds in rows:
+        cells = ''.join('{:>12}'.format('-' if value is None else '{:.3f}'.format(value)) for value in seconds)
+        change = '-'
+        if seconds[0] and seconds[-1] is not None:
+            change = '{:+.0%}'.format(seconds[-1] / seconds[0] - 1)
+        print(name.ljust(width) + cells + '{:>10}'.format(change))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark a full ingest and the API queries against synthetic '
+                                                 'sources in the `{}` schema, appending the results to a JSON lines '
+                                                 'file so runs can be compared across commits.'.format(SCHEMA))
+    parser.add_argument('--scale', choices=sorted(SCALES), default='state', help='preset size (default: state)')
+    parser.add_argument('--states', type=int, help='number of states (default: from the scale)')
+    parser.add_argument('--wards', type=int, help='number of wards over all states (default: from the scale)')
+    parser.add_argument('--vertices', type=int, default=8, help='vertices per ward side (default: 8)')
+    parser.add_argument('--races', type=int, default=10, help='(race, year) pairs per ward (default: 10)')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic data (default: 0)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='number of worker processes (default: CPU count)')
+    parser.add_argument('--repeat', type=int, default=5, help='runs of every query (default: 5)')
+    parser.add_argument('--insert', action='store_true', help='benchmark `ingest.py --insert`')
+    parser.add_argument('--pipeline-depth', type=int, default=4, help='benchmark `ingest.py --pipeline-depth`')
+    parser.add_argument('--client-metrics', action='store_true', help='benchmark `ingest.py --client-metrics`')
+    parser.add_argument('--surrogate-keys', action='store_true', help='benchmark `ingest.py --surrogate-keys`')
+    parser.add_argument('--partitioned', action='store_true', help='benchmark `ingest.py --partitioned`')
+    parser.add_argument('--directory', default='benchmark',
+                        help='directory of the generated sources and derived files (default: benchmark)')
+    parser.add_argument('--results', default=os.path.join('benchmark', 'results.jsonl'),
+                        help='JSON lines file the results are appended to (default: benchmark/results.jsonl)')
+    parser.add_argument('--compare', type=int, metavar='RUNS',
+                        help='instead of running, print the last RUNS results with the same parameters side by side')
+    args = parser.parse_args()
+    if args.surrogate_keys and args.partitioned:
+        parser.error('--surrogate-keys cannot be combined with --partitioned')
+
+    parameters = dict(SCALES[args.scale], vertices=args.vertices, races=args.races, seed=args.seed)
+    parameters.update({key: getattr(args, key) for key in ['states', 'wards'] if getattr(args, key) is not None})
+    flags = {key: getattr(args, key) for key in ['insert', 'pipeline_depth', 'client_metrics', 'surrogate_keys',
+                                                 'partitioned']}
+    parameters.update(flags)
+    if args.compare:
+        compare(args.results, args.scale, parameters, args.compare)
+        return
+
+    data = os.path.join(args.directory, '{states}-{wards}-{vertices}-{races}-{seed}'.format(**parameters))
+    if not os.path.exists(os.path.join(data, 'sources', 'states.json')):
+        start = time.perf_counter()
+        generate(data, parameters['states'], parameters['wards'], args.vertices, args.races, args.seed)
+        print('generated {}: {:.2f} s'.format(data, time.perf_counter() - start))
+
+    options = dict(flags, incremental=False, batch_size=10000, adjacency=os.path.join(data, 'adjacency'),
+                   snapshot=os.path.join(data, 'snapshot'), crosswalk=os.path.join(data, 'crosswalk'),
+                   lookup=os.path.join(data, 'lookup'))
+    stages, queries, rows = run(data, options, args.workers, args.repeat)
+    for name, timing in queries.items():
+        print('{}: {:.4f} s median, {:.4f} s min, {} rows'.format(name, timing['median'], timing['min'],
+                                                                  timing['rows']))
+
+    os.makedirs(os.path.dirname(args.results) or '.', exist_ok=True)
+    with open(args.results, 'a') as results_file:
+        results_file.write(json.dumps({
+            'commit': commit(),
+            'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'host': platform.node(),
+            'cpus': os.cpu_count(),
+            'workers': args.workers,
+            'scale': args.scale,
+            'parameters': parameters,
+            'rows': rows,
+            'stages': stages,
+            'queries': queries,
+        }) + '\n')
+    print('appended to {}'.format(args.results))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+import io
+import queue
+import struct
+import threading
+
+import psycopg2
+
+import wkb
+
+########################################################################################################################
+# Binary COPY Field Encoders
+########################################################################################################################
+
+def encode_text(value):
+    return str(value).encode('utf-8')
+
+
+def encode_integer(value):
+    return struct.pack('!i', int(value))
+
+
+def encode_real(value):
+    return struct.pack('!f', float(value))
+
+
+def encode_boolean(value):
+    return b'\x01' if value else b'\x00'
+
+
+def encode_geometry(value):
+    return wkb.encode(value)
+
+
+ENCODERS = {
+    'text': encode_text,
+    'integer': encode_integer,
+    'real': encode_real,
+    'boolean': encode_boolean,
+    'geometry': encode_geometry,
+}
+
+COPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('!ii', 0, 0)
+COPY_TRAILER = struct.pack('!h', -1)
+COPY_NULL = struct.pack('!i', -1)
+
+########################################################################################################################
+# Writers
+########################################################################################################################
+
+# Both writers take rows whose `geometry` columns hold GeoJSON geometry objects and whose other columns hold plain
+# Python values. `begin(source)` is called before the rows of each source file and returns whether they need loading
+# at all (see `incremental.IncrementalWriter`). `parents` are writers whose rows must reach the database before this
+# writer's rows (i.e. the tables referenced by this table's foreign keys), so they are always flushed first.
+
+
+class CopyWriter:
+
+    def __init__(self, cur, table, columns, batch_size=10000, parents=()):
+        self.cur = cur
+        self.table = table
+        self.names = [name for name, _ in columns]
+        self.encoders = [ENCODERS[column_type] for _, column_type in columns]
+        self.batch_size = batch_size
+        self.parents = list(parents)
+        self.query = 'COPY {} ({}) FROM STDIN WITH (FORMAT BINARY);'.format(table, ', '.join(self.names))
+        self.field_count = struct.pack('!h', len(columns))
+        self.buffer = io.BytesIO()
+        self.rows = 0
+        self.total_rows = 0
+        self.total_bytes = 0
+
+    def begin(self, source):
+        return True
+
+    def write(self, row):
+        parts = [self.field_count]
+        for encoder, value in zip(self.encoders, row):
+            if value is None:
+                parts.append(COPY_NULL)
+            else:
+                data = encoder(value)
+                parts.append(struct.pack('!i', len(data)))
+                parts.append(data)
+        self.buffer.write(b''.join(parts))
+        self.rows += 1
+        if self.rows >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        for parent in self.parents:
+            parent.flush()
+        if self.rows == 0:
+            return
+        data = COPY_HEADER + self.buffer.getvalue() + COPY_TRAILER
+        self.cur.copy_expert(self.query, io.BytesIO(data))
+        self.total_rows += self.rows
+        self.total_bytes += len(data)
+        self.buffer = io.BytesIO()
+        self.rows = 0
+
+    def close(self):
+        self.flush()
+
+
+class InsertWriter:
+
+    def __init__(self, cur, table, columns, batch_size=None, parents=()):
+        self.cur = cur
+        self.table = table
+        self.names = [name for name, _ in columns]
+        self.geometries = [column_type == 'geometry' for _, column_type in columns]
+        self.parents = list(parents)
+        self.query = 'INSERT INTO {} ({}) VALUES ({});'.format(table, ', '.join(self.names), ', '.join(
+            'ST_GeomFromEWKB(%s)' if geometry else '%s' for geometry in self.geometries
+        ))
+        self.total_rows = 0
+        self.total_bytes = 0
+
+    def begin(self, source):
+        return True
+
+    def write(self, row):
+        self.cur.execute(self.query, tuple(
+            psycopg2.Binary(wkb.encode(value)) if geometry and value is not None else value
+            for geometry, value in zip(self.geometries, row)
+        ))
+        self.total_rows += 1
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+########################################################################################################################
+# Pipelined Cursor
+########################################################################################################################
+
+# Without pipelining, a load task alternates between parsing and encoding a batch and waiting for the database to copy
+# it, leaving one idle while the other works. `Pipeline` wraps a cursor so that `copy_expert()` only queues the batch
+# for a background thread that copies it while the task goes on parsing and encoding (psycopg2 releases the GIL while
+# it waits on the server). The queue holds at most `depth` batches, so a task that encodes faster than the database
+# copies blocks on a full queue rather than growing its memory.
+#
+# The thread is the only user of the connection while batches are queued: every other statement first waits for the
+# queue to drain, so statements still reach the server in the order they were issued, within the task's one
+# transaction. `close()` drains the queue too, so closing the cursor before committing commits every queued batch. An
+# error in the thread is raised by the next call that waits for it and stays set, so the batches queued behind it are
+# skipped rather than sent into the aborted transaction; closing while that error unwinds does not raise it again.
+# With instrumentation (see `instrument.py`) the thread's copies still count as database time, which now overlaps with
+# the task's other time.
+
+
+class Pipeline:
+
+    def __init__(self, cur, depth=4):
+        self.cur = cur
+        self.batches = queue.Queue(maxsize=depth)
+        self.error = None
+        self.thread = threading.Thread(target=self.copy, daemon=True)
+        self.thread.start()
+
+    def copy(self):
+        while True:
+            batch = self.batches.get()
+            try:
+                if batch is not None and self.error is None:
+                    self.cur.copy_expert(*batch)
+            except Exception as error:
+                self.error = error
+            finally:
+                self.batches.task_done()
+            if batch is None:
+                return
+
+    def check(self):
+        if self.error is not None:
+            raise self.error
+
+    def drain(self):
+        self.batches.join()
+        self.check()
+
+    def copy_expert(self, sql, file, size=8192):
+        self.check()
+        self.batches.put((sql, file, size))
+
+    def execute(self, query, vars=None):
+        self.drain()
+        return self.cur.execute(query, vars)
+
+    def close(self, raise_error=True):
+        if self.thread.is_alive():
+            self.batches.put(None)
+            self.thread.join()
+        self.cur.close()
+        if raise_error:
+            self.check()
+
+    def __getattr__(self, name):
+        # `fetchone()`, `rowcount`, ... refer to the last `execute()`, which already waited for the queue
+        return getattr(self.cur, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # An exception already in flight (usually the thread's error, raised by `check()`) is the one to report
+        self.close(raise_error=exc_type is None)
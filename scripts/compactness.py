@@ -0,0 +1,153 @@
+import argparse
+import json
+import os
+
+import numpy as np
+
+import adjacency
+import db
+import recom
+
+########################################################################################################################
+# District Geometry From Ward Topology
+########################################################################################################################
+
+# A district's area is the sum of its wards' areas and its perimeter is the boundary its wards do not share with each
+# other: their exterior boundary (see `adjacency.graph`) plus every shared edge to a ward of another district. Both
+# come straight from the ward adjacency graph, so no polygon is ever unioned, and moving wards between districts only
+# touches the edges of the wards that moved.
+#
+# Scores match the district tables' columns: `npi` is 2 * sqrt(pi * area) / perimeter, `polsby_popper` its square
+# (4 * pi * area / perimeter^2) and `schwartzberg` its inverse (perimeter / circumference of the circle of equal area).
+
+
+class Compactness:
+
+    def __init__(self, csr, areas, assignment, district_count):
+        self.indptr = csr['indptr']
+        self.indices = csr['indices'].astype(np.int64)
+        self.weights = csr['weights']
+        self.exterior = csr['exterior']
+        self.sources = np.repeat(np.arange(len(self.indptr) - 1), np.diff(self.indptr))
+        self.areas = np.asarray(areas, dtype=np.float64)
+        self.assignment = np.asarray(assignment, dtype=np.int64).copy()
+        self.district_count = district_count
+
+        self.area = np.bincount(self.assignment, weights=self.areas, minlength=district_count)
+        self.perimeter = np.bincount(self.assignment, weights=self.exterior, minlength=district_count)
+        self.perimeter += self.boundary(self.sources, self.indices, self.weights)
+
+    def boundary(self, sources, targets, weights):
+        # Length of the directed edges `sources -> targets` crossing a district line, credited to the source's district
+        districts = self.assignment[sources]
+        cut = districts != self.assignment[targets]
+        return np.bincount(districts[cut], weights=weights[cut], minlength=self.district_count)
+
+    def move(self, wards, districts):
+        wards = np.asarray(wards, dtype=np.int64)
+        if len(wards) == 0:
+            return
+        starts = self.indptr[wards]
+        degrees = self.indptr[wards + 1] - starts
+        positions = np.repeat(starts - np.cumsum(degrees) + degrees, degrees) + np.arange(degrees.sum())
+        sources = self.sources[positions]
+        targets = self.indices[positions]
+        weights = self.weights[positions]
+
+        # Every directed edge with an end in `wards`: their own edges, plus the reverse of those whose other end stays
+        moved = np.zeros(len(self.assignment), dtype=bool)
+        moved[wards] = True
+        outside = ~moved[targets]
+        sources, targets = np.concatenate([sources, targets[outside]]), np.concatenate([targets, sources[outside]])
+        weights = np.concatenate([weights, weights[outside]])
+
+        self.perimeter -= self.boundary(sources, targets, weights)
+        self.perimeter -= np.bincount(self.assignment[wards], weights=self.exterior[wards],
+                                      minlength=self.district_count)
+        self.area -= np.bincount(self.assignment[wards], weights=self.areas[wards], minlength=self.district_count)
+        self.assignment[wards] = districts
+        self.area += np.bincount(self.assignment[wards], weights=self.areas[wards], minlength=self.district_count)
+        self.perimeter += np.bincount(self.assignment[wards], weights=self.exterior[wards],
+                                      minlength=self.district_count)
+        self.perimeter += self.boundary(sources, targets, weights)
+
+    def scores(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            npi = np.where(self.perimeter > 0, 2 * np.sqrt(np.pi * self.area) / self.perimeter, 0.0)
+        return {
+            'npi': npi,
+            'polsby_popper': npi ** 2,
+            'schwartzberg': np.where(npi > 0, 1 / np.where(npi > 0, npi, 1), 0.0),
+        }
+
+########################################################################################################################
+# Ensemble Report
+########################################################################################################################
+
+DISTRICT_TABLES = {'assembly': 'assemblies', 'senate': 'senates', 'congressional': 'congressionals'}
+
+
+def load_areas(cur, state, year, names):
+    cur.execute('SELECT name, area FROM gm.wards WHERE state = %s AND year = %s;', (state, year))
+    areas = dict(cur.fetchall())
+    return np.array([areas.get(name, 0.0) for name in names], dtype=np.float64)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Score district compactness for the enacted plan and every plan of '
+                                                 'a ReCom ensemble (see `recom.py`) from ward areas and shared-edge '
+                                                 'lengths, updating scores incrementally as wards move.')
+    parser.add_argument('ensemble', help='directory written by `recom.py`')
+    parser.add_argument('--every', type=int, default=1, help='keep the scores of every n-th plan (default: 1)')
+    parser.add_argument('--adjacency', default='adjacency',
+                        help='directory of the ward adjacency graphs (default: adjacency)')
+    parser.add_argument('--output', help='.npz to save every score to (default: <ensemble>/compactness.npz)')
+    args = parser.parse_args()
+
+    with open(os.path.join(args.ensemble, 'ensemble.json'), 'r') as ensemble_file:
+        ensemble = json.load(ensemble_file)
+    state, year, level = ensemble['state'], ensemble['year'], ensemble['level']
+    csr = adjacency.load(os.path.join(args.adjacency, '{}-{}.npz'.format(state, year)))
+    if [str(name) for name in csr['names']] != ensemble['wards']:
+        raise ValueError('The adjacency graph of {} {} does not match the ensemble\'s wards'.format(state, year))
+
+    conn = db.connect()
+    cur = conn.cursor()
+    areas = load_areas(cur, state, year, ensemble['wards'])
+    cur.execute('SELECT name, npi FROM gm.{} WHERE state = %s AND year = %s;'.format(DISTRICT_TABLES[level]),
+                (state, year))
+    enacted_npi = dict(cur.fetchall())
+    cur.close()
+    conn.close()
+
+    district_count = len(ensemble['districts'])
+    initial = np.load(os.path.join(args.ensemble, 'initial.npy'))
+    enacted = Compactness(csr, areas, initial, district_count).scores()
+
+    print('Enacted {} districts, npi from ward topology vs. from district geometry:'.format(level))
+    for district, npi in zip(ensemble['districts'], enacted['npi']):
+        print('    {}: {:.4f} vs. {}'.format(district, npi, '{:.4f}'.format(enacted_npi[district])
+                                             if district in enacted_npi else 'n/a'))
+
+    scores = {name: [] for name in enacted}
+    for chain in range(ensemble['chains']):
+        paths = recom.chain_paths(args.ensemble, chain)
+        offsets = np.load(paths['offsets'], mmap_mode='r')
+        wards = np.load(paths['wards'], mmap_mode='r')
+        districts = np.load(paths['districts'], mmap_mode='r')
+        plan = Compactness(csr, areas, initial, district_count)
+        for step, (start, end) in enumerate(zip(offsets[:-1], offsets[1:]), start=1):
+            plan.move(wards[start:end], districts[start:end])
+            if step % args.every == 0:
+                for name, values in plan.scores().items():
+                    scores[name].append(values)
+
+    np.savez(args.output or os.path.join(args.ensemble, 'compactness.npz'),
+             **{'enacted_' + name: values for name, values in enacted.items()},
+             **{name: np.array(values).reshape(-1, district_count) for name, values in scores.items()})
+    print('{} plans scored; mean district npi {:.4f} enacted, {:.4f} across the ensemble'.format(
+        len(scores['npi']), enacted['npi'].mean(), np.mean(scores['npi']) if scores['npi'] else float('nan')))
+
+
+if __name__ == '__main__':
+    main()
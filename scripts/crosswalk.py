@@ -0,0 +1,242 @@
+import argparse
+import csv
+import os
+import sys
+
+import numpy as np
+
+import assignment
+import db
+import snapshot
+
+########################################################################################################################
+# Crosswalks
+########################################################################################################################
+
+# Wards are redrawn every decade while results keep coming, so comparing elections across decades means moving counts
+# from one ward vintage of a state to another. A crosswalk from vintage `source_year` to `target_year` is the sparse
+# (target wards x source wards) matrix of the share of every source ward that goes to every target ward, from the same
+# sampled overlay as the plan assignments (see `assignment.py`), stored as COO arrays in
+# `<directory>/<state>-<source_year>-<target_year>-<weighting>.npz` with both vintages' ward names (sorted by name).
+# Re-projecting any number of count columns is then one sparse multiply (`project()`) instead of a spatial join.
+#
+# With `area` weighting a source ward's counts are split by area. With `population` weighting the area shares are
+# scaled by the population density of each target ward (in the latest census year loaded on the target vintage) and
+# renormalized, so counts follow where people live rather than empty land; a source ward whose overlapping targets
+# have no population keeps its area shares. Either way a source ward's shares sum to the part of it inside the target
+# vintage, so counts outside it are dropped.
+#
+# The overlay is the expensive part, so a crosswalk is cached and only recomputed when the hash of either vintage's
+# names and geometries (computed by the database, without transferring the geometries) differs from the hashes it was
+# built from.
+
+WEIGHTINGS = ['area', 'population']
+
+
+def path(directory, state, source_year, target_year, weighting):
+    return os.path.join(directory, '{}-{}-{}-{}.npz'.format(state, source_year, target_year, weighting))
+
+
+def vintage_hash(cur, state, year):
+    cur.execute('''
+    SELECT MD5(STRING_AGG(name || ':' || MD5(ST_AsBinary(geometry)), ',' ORDER BY name))
+
+      FROM gm.wards
+
+     WHERE state = %s
+       AND year = %s;
+    ''', (state, year))
+    row = cur.fetchone()
+    return row[0] if row and row[0] else ''
+
+
+def target_densities(cur, state, target_year, names):
+    # Population per square mile of every target ward in the latest census year on the vintage, or None without any
+    cur.execute('''
+    SELECT w.name,
+           w.area,
+           pop.total
+
+      FROM gm.wards AS w
+
+           JOIN gm.populations AS pop
+           ON w.state = pop.state
+              AND w.year = pop.ward_year
+              AND w.name = pop.ward
+
+     WHERE w.state = %s
+       AND w.year = %s
+       AND pop.year = (SELECT MAX(year) FROM gm.populations WHERE state = %s AND ward_year = %s);
+    ''', (state, target_year, state, target_year))
+    rows = cur.fetchall()
+    if not rows:
+        return None
+    index = {name: position for position, name in enumerate(names)}
+    densities = np.zeros(len(names))
+    for name, area, total in rows:
+        if name in index and area:
+            densities[index[name]] = total / area
+    return densities
+
+
+def weigh_by_population(source, target, weights, densities, source_count):
+    scaled = weights * densities[target]
+    covered = np.bincount(source, weights=weights, minlength=source_count)
+    totals = np.bincount(source, weights=scaled, minlength=source_count)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        reweighted = scaled / totals[source] * covered[source]
+    return np.where(totals[source] > 0, reweighted, weights)
+
+
+def load(path):
+    with np.load(path) as arrays:
+        return {name: arrays[name] for name in arrays.files}
+
+
+def build(cur, state, source_year, target_year, directory, weighting='area'):
+    # Returns the crosswalk and whether it came from the cache
+    hashes = vintage_hash(cur, state, source_year), vintage_hash(cur, state, target_year)
+    crosswalk_path = path(directory, state, source_year, target_year, weighting)
+    if os.path.exists(crosswalk_path):
+        crosswalk = load(crosswalk_path)
+        if (str(crosswalk['source_hash']), str(crosswalk['target_hash'])) == hashes:
+            return crosswalk, True
+
+    source_names, source_geometries = assignment.read_wards(cur, state, source_year)
+    target_names, target_geometries = assignment.read_wards(cur, state, target_year)
+    source, target, weights = assignment.overlay(source_geometries, target_geometries)
+    if weighting == 'population':
+        densities = target_densities(cur, state, target_year, target_names)
+        if densities is not None:
+            weights = weigh_by_population(source, target, weights, densities, len(source_names))
+
+    crosswalk = {
+        'source_names': np.asarray(source_names, dtype=str),
+        'target_names': np.asarray(target_names, dtype=str),
+        'source': source.astype(np.int32),
+        'target': target.astype(np.int32),
+        'weights': weights,
+        'source_hash': np.array(hashes[0]),
+        'target_hash': np.array(hashes[1]),
+    }
+    os.makedirs(directory, exist_ok=True)
+    temporary_path = crosswalk_path[:-len('.npz')] + '.tmp.npz'
+    np.savez(temporary_path, **crosswalk)
+    os.replace(temporary_path, crosswalk_path)
+    return crosswalk, False
+
+
+def project(crosswalk, values):
+    # (source wards, ...) counts -> (target wards, ...) counts
+    return assignment.apportion(crosswalk['source'], crosswalk['target'], crosswalk['weights'], values,
+                                len(crosswalk['target_names']))
+
+########################################################################################################################
+# Tables
+########################################################################################################################
+
+# Re-projects every (race and) year of `gm.votes` or `gm.populations` on the source vintage at once: all of their count
+# columns are laid side by side in one (source wards x columns) matrix and multiplied together.
+
+KEY_COLUMNS = {
+    'votes': ['race', 'year'],
+    'populations': ['year'],
+}
+
+COUNT_COLUMNS = {
+    'votes': snapshot.VOTE_COLUMNS,
+    'populations': snapshot.POPULATION_COLUMNS,
+}
+
+
+def project_table(cur, crosswalk, table, state, source_year):
+    # Returns the (key, target ward names, (target wards x count columns) counts) of every key of the table
+    key_columns, count_columns = KEY_COLUMNS[table], COUNT_COLUMNS[table]
+    cur.execute('SELECT {}, ward, {} FROM gm.{} WHERE state = %s AND ward_year = %s;'.format(
+        ', '.join(key_columns), ', '.join(count_columns), table), (state, source_year))
+    rows = cur.fetchall()
+    keys = sorted({tuple(row[:len(key_columns)]) for row in rows})
+    key_index = {key: position for position, key in enumerate(keys)}
+    ward_index = {str(name): position for position, name in enumerate(crosswalk['source_names'])}
+
+    values = np.zeros((len(crosswalk['source_names']), len(keys), len(count_columns)))
+    for row in rows:
+        ward = row[len(key_columns)]
+        if ward in ward_index:
+            values[ward_index[ward], key_index[tuple(row[:len(key_columns)])]] = row[len(key_columns) + 1:]
+    projected = project(crosswalk, values.reshape(len(values), -1)).reshape(-1, len(keys), len(count_columns))
+    return [(key, crosswalk['target_names'], projected[:, position]) for position, key in enumerate(keys)]
+
+########################################################################################################################
+# Crosswalk Stage
+########################################################################################################################
+
+# Keeps the crosswalks from every ward vintage of a state to the next one (and back) current, with both weightings.
+# Unchanged vintages are answered from the cache, so the stage runs for every state on every ingest.
+
+def build_state(state, directory):
+    conn = db.connection()
+    built = []
+    cached = 0
+    with conn.cursor() as cur:
+        cur.execute('SELECT DISTINCT year FROM gm.wards WHERE state = %s ORDER BY year;', (state,))
+        years = [row[0] for row in cur.fetchall()]
+        pairs = list(zip(years[:-1], years[1:])) + list(zip(years[1:], years[:-1]))
+        for source_year, target_year in pairs:
+            for weighting in WEIGHTINGS:
+                _, hit = build(cur, state, source_year, target_year, directory, weighting)
+                if hit:
+                    cached += 1
+                else:
+                    built.append('{} -> {} ({})'.format(source_year, target_year, weighting))
+    conn.commit()
+
+    current = {os.path.basename(path(directory, state, *pair, weighting)) for pair in pairs for weighting in WEIGHTINGS}
+    if os.path.isdir(directory):
+        for name in os.listdir(directory):
+            if name.startswith(state + '-') and name.endswith('.npz') and name not in current:
+                os.remove(os.path.join(directory, name))
+
+    if not pairs:
+        return [{'table': 'crosswalk', 'path': directory, 'derived': 'fewer than two ward vintages'}]
+    return [{'table': 'crosswalk', 'path': directory, 'derived': '{} built{}{}, {} cached'.format(
+        len(built), ': ' if built else '', ', '.join(built), cached)}]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Re-project the votes or populations of one ward vintage of a state '
+                                                 'onto another through a cached areal-interpolation crosswalk.')
+    parser.add_argument('state', help='sanitized state name, e.g. wisconsin')
+    parser.add_argument('source_year', help='ward vintage the counts are on')
+    parser.add_argument('target_year', help='ward vintage to re-project them onto')
+    parser.add_argument('--table', choices=sorted(KEY_COLUMNS), default='votes', help='table to re-project')
+    parser.add_argument('--weighting', choices=WEIGHTINGS, default='area',
+                        help='how a source ward is split between target wards (default: area)')
+    parser.add_argument('--directory', default='crosswalk', help='directory of the cached crosswalks '
+                                                                 '(default: crosswalk)')
+    parser.add_argument('--output', help='CSV file of the re-projected rows (default: standard output)')
+    args = parser.parse_args()
+
+    conn = db.connect()
+    cur = conn.cursor()
+    crosswalk, cached = build(cur, args.state, args.source_year, args.target_year, args.directory, args.weighting)
+    projections = project_table(cur, crosswalk, args.table, args.state, args.source_year)
+    cur.close()
+    conn.close()
+
+    print('{} {} -> {} ({}): {} crosswalk, {} source wards, {} target wards, {} pairs'.format(
+        args.state, args.source_year, args.target_year, args.weighting, 'cached' if cached else 'built',
+        len(crosswalk['source_names']), len(crosswalk['target_names']), len(crosswalk['weights'])), file=sys.stderr)
+
+    output_file = open(args.output, 'w', newline='') if args.output else sys.stdout
+    writer = csv.writer(output_file)
+    writer.writerow(['state'] + KEY_COLUMNS[args.table] + ['ward_year', 'ward'] + COUNT_COLUMNS[args.table])
+    for key, names, counts in projections:
+        for name, row in zip(names, counts):
+            writer.writerow([args.state, *key, args.target_year, name] + ['{:.2f}'.format(count) for count in row])
+    if args.output:
+        output_file.close()
+
+
+if __name__ == '__main__':
+    main()
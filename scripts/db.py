@@ -0,0 +1,102 @@
+import os
+import re
+import time
+
+import psycopg2
+import psycopg2.extensions
+
+import instrument
+
+########################################################################################################################
+# Connections
+########################################################################################################################
+
+PARAMETERS = {
+    'user': 'gm_ingest',
+    'host': '127.0.0.1',
+    'port': '5432',
+    'database': 'gm',
+}
+
+_connection = None
+
+
+def connect():
+    if schema() != SCHEMA or instrument.enabled:
+        return psycopg2.connect(**PARAMETERS, connection_factory=Connection, cursor_factory=Cursor)
+    return psycopg2.connect(**PARAMETERS)
+
+
+def connection():
+    # One connection per (worker) process, opened on first use and reused by every task that process runs
+    global _connection
+    if _connection is None or _connection.closed:
+        _connection = connect()
+    return _connection
+
+########################################################################################################################
+# Build Schema
+########################################################################################################################
+
+# Every query names its relations `gm.<name>`. To build into another schema (see `staging.py`), `use_schema()` sets an
+# environment variable, which worker processes spawned afterwards inherit, and connections opened while it is set
+# rewrite the `gm.` qualifier of every query to that schema. Unqualified names, such as the PostGIS functions, still
+# resolve through the search path.
+
+SCHEMA = 'gm'
+SCHEMA_VARIABLE = 'GM_SCHEMA'
+
+
+def schema():
+    return os.environ.get(SCHEMA_VARIABLE, SCHEMA)
+
+
+def use_schema(name):
+    global _connection
+    os.environ[SCHEMA_VARIABLE] = name
+    _connection = None
+
+
+def qualify(query):
+    return re.sub(r'\bgm\.', schema() + '.', query)
+
+
+########################################################################################################################
+# Cursors
+########################################################################################################################
+
+# Connections opened while building into another schema or with instrumentation enabled (see `instrument.py`) use
+# these classes, which qualify every query and time every statement and commit as needed; others use psycopg2's own.
+
+class Cursor(psycopg2.extensions.cursor):
+
+    def execute(self, query, vars=None):
+        if schema() != SCHEMA:
+            query = qualify(query)
+        if not instrument.enabled:
+            return super().execute(query, vars)
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            instrument.statement(query, time.perf_counter() - start)
+
+    def copy_expert(self, sql, file, size=8192):
+        if schema() != SCHEMA:
+            sql = qualify(sql)
+        if not instrument.enabled:
+            return super().copy_expert(sql, file, size)
+        start = time.perf_counter()
+        try:
+            return super().copy_expert(sql, file, size)
+        finally:
+            instrument.statement(sql, time.perf_counter() - start)
+
+
+class Connection(psycopg2.extensions.connection):
+
+    def commit(self):
+        if not instrument.enabled:
+            return super().commit()
+        with instrument.timed('commit'):
+            return super().commit()
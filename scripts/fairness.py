@@ -0,0 +1,165 @@
+import argparse
+import json
+import os
+
+import numpy as np
+
+import db
+import recom
+
+########################################################################################################################
+# Vote Matrix
+########################################################################################################################
+
+# `democrat` and `republican` are (ward x race) matrices of the votes in `gm.votes`, with wards in the dense order of
+# `names` (see `adjacency.py`) and races as the sorted `(race, year)` pairs of the ward vintage.
+
+def load_votes(cur, state, ward_year, names):
+    index = {name: position for position, name in enumerate(names)}
+    cur.execute('''
+    SELECT race,
+           year,
+           ward,
+           democrat,
+           republican
+
+      FROM gm.votes
+
+     WHERE state = %s
+       AND ward_year = %s;
+    ''', (state, ward_year))
+    rows = cur.fetchall()
+    races = sorted({(race, year) for race, year, _, _, _ in rows})
+    race_index = {race: position for position, race in enumerate(races)}
+
+    democrat = np.zeros((len(names), len(races)), dtype=np.float64)
+    republican = np.zeros((len(names), len(races)), dtype=np.float64)
+    for race, year, ward, democrat_votes, republican_votes in rows:
+        if ward in index:
+            democrat[index[ward], race_index[(race, year)]] = democrat_votes
+            republican[index[ward], race_index[(race, year)]] = republican_votes
+    return races, democrat, republican
+
+########################################################################################################################
+# Metrics
+########################################################################################################################
+
+# Scores a (plan x ward) matrix of district codes against every race at once. District totals come from one `bincount`
+# per race over `plan * district_count + district`, and every metric is then an array operation over (plan x race x
+# district). All metrics are from the Democratic side of the two-party vote:
+#
+# - `seats`: districts won by Democrats
+# - `efficiency_gap`: (Democratic - Republican wasted votes) / votes; positive favors Republicans
+# - `mean_median`: mean - median district Democratic share; positive means the median district is more Republican
+#   than the average one, which favors Republicans
+# - `partisan_bias`: Democratic seat share at a 50% statewide vote under uniform swing, minus 0.5
+# - `seats_votes`: Democratic seat share at every statewide Democratic vote share in `vote_shares`, under uniform swing
+
+VOTE_SHARES = np.round(np.arange(0.30, 0.7001, 0.01), 2)
+
+
+def district_votes(assignments, votes, district_count):
+    plans, wards = assignments.shape
+    bins = (np.arange(plans)[:, None] * district_count + assignments).reshape(-1)
+    totals = np.empty((plans * district_count, votes.shape[1]))
+    for race in range(votes.shape[1]):
+        totals[:, race] = np.bincount(bins, weights=np.broadcast_to(votes[:, race], (plans, wards)).reshape(-1),
+                                      minlength=plans * district_count)
+    # (plan x race x district)
+    return totals.reshape(plans, district_count, -1).transpose(0, 2, 1)
+
+
+def score(assignments, democrat, republican, district_count, vote_shares=VOTE_SHARES):
+    assignments = np.asarray(assignments, dtype=np.int64)
+    dem = district_votes(assignments, democrat, district_count)
+    rep = district_votes(assignments, republican, district_count)
+    total = dem + rep
+    with np.errstate(invalid='ignore', divide='ignore'):
+        shares = np.where(total > 0, dem / total, 0.5)
+    statewide = dem.sum(axis=2) / np.maximum(total.sum(axis=2), 1)
+
+    won = dem > rep
+    threshold = total / 2
+    wasted_dem = np.where(won, dem - threshold, dem)
+    wasted_rep = np.where(won, rep, rep - threshold)
+
+    swing = 0.5 - statewide
+    curves = ((shares[:, :, :, None] + (vote_shares - statewide[:, :, None])[:, :, None, :]) > 0.5).mean(axis=2)
+    return {
+        'seats': won.sum(axis=2),
+        'efficiency_gap': (wasted_dem - wasted_rep).sum(axis=2) / np.maximum(total.sum(axis=2), 1),
+        'mean_median': shares.mean(axis=2) - np.median(shares, axis=2),
+        'partisan_bias': ((shares + swing[:, :, None]) > 0.5).mean(axis=2) - 0.5,
+        'seats_votes': curves,
+        'vote_share': statewide,
+    }
+
+
+def score_chunks(plans, democrat, republican, district_count, chunk_size=256):
+    # Scores an iterable of plans `chunk_size` at a time and concatenates the results
+    results = []
+    chunk = []
+    for plan in plans:
+        chunk.append(np.array(plan))
+        if len(chunk) == chunk_size:
+            results.append(score(np.stack(chunk), democrat, republican, district_count))
+            chunk = []
+    if chunk:
+        results.append(score(np.stack(chunk), democrat, republican, district_count))
+    if not results:
+        raise ValueError('No plans to score')
+    return {name: np.concatenate([result[name] for result in results]) for name in results[0]}
+
+########################################################################################################################
+# Ensemble Report
+########################################################################################################################
+
+def sample_plans(directory, chains, every):
+    for chain in range(chains):
+        for step, plan in enumerate(recom.read_plans(directory, chain)):
+            if step > 0 and step % every == 0:
+                yield plan
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Score the enacted plan and a ReCom ensemble (see `recom.py`) on '
+                                                 'efficiency gap, mean-median, partisan bias, seats and seats-votes '
+                                                 'curves for every race.')
+    parser.add_argument('ensemble', help='directory written by `recom.py`')
+    parser.add_argument('--every', type=int, default=10, help='score every n-th plan of each chain (default: 10)')
+    parser.add_argument('--chunk-size', type=int, default=256, help='plans scored per pass (default: 256)')
+    parser.add_argument('--output', help='.npz to save every score to (default: <ensemble>/fairness.npz)')
+    args = parser.parse_args()
+
+    with open(os.path.join(args.ensemble, 'ensemble.json'), 'r') as ensemble_file:
+        ensemble = json.load(ensemble_file)
+
+    conn = db.connect()
+    cur = conn.cursor()
+    races, democrat, republican = load_votes(cur, ensemble['state'], ensemble['year'], ensemble['wards'])
+    cur.close()
+    conn.close()
+
+    district_count = len(ensemble['districts'])
+    enacted = score(np.load(os.path.join(args.ensemble, 'initial.npy'))[None, :], democrat, republican,
+                    district_count)
+    sampled = score_chunks(sample_plans(args.ensemble, ensemble['chains'], args.every), democrat, republican,
+                           district_count, chunk_size=args.chunk_size)
+
+    np.savez(args.output or os.path.join(args.ensemble, 'fairness.npz'),
+             races=np.array(['{}/{}'.format(race, year) for race, year in races]),
+             vote_shares=VOTE_SHARES,
+             **{'enacted_' + name: values[0] for name, values in enacted.items()},
+             **sampled)
+
+    print('{} plans scored; enacted plan (percentile within the ensemble)'.format(len(sampled['seats'])))
+    for index, (race, year) in enumerate(races):
+        scores = []
+        for name in ['seats', 'efficiency_gap', 'mean_median', 'partisan_bias']:
+            value = enacted[name][0, index]
+            scores.append('{} {:.3f} ({:.0f}%)'.format(name, value, 100 * np.mean(sampled[name][:, index] < value)))
+        print('{} {}: {}'.format(race, year, ', '.join(scores)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+import json
+import resource
+import sys
+
+import instrument
+
+########################################################################################################################
+# Streaming GeoJSON Reader
+########################################################################################################################
+
+# Yields the members of a FeatureCollection's `features` array one at a time. Only the current feature and one read
+# chunk are ever held in memory, so peak memory is independent of the size of the file. Top-level members other than
+# `features` (`type`, `name`, `crs`, ...) are parsed and discarded.
+
+CHUNK_SIZE = 1 << 20
+
+WHITESPACE = ' \t\n\r'
+
+decoder = json.JSONDecoder()
+
+
+class _Stream:
+
+    def __init__(self, file, chunk_size):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.buffer = ''
+        self.index = 0
+        self.eof = False
+
+    def fill(self):
+        if self.eof:
+            return False
+        chunk = self.file.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.index:] + chunk
+        self.index = 0
+        return True
+
+    def peek(self):
+        while True:
+            while self.index < len(self.buffer) and self.buffer[self.index] in WHITESPACE:
+                self.index += 1
+            if self.index < len(self.buffer):
+                return self.buffer[self.index]
+            if not self.fill():
+                raise ValueError('Unexpected end of GeoJSON in \'{}\''.format(self.file.name))
+
+    def expect(self, character):
+        if self.peek() != character:
+            raise ValueError('Expected \'{}\' at offset {} of the buffered GeoJSON in \'{}\''.format(
+                character, self.index, self.file.name))
+        self.index += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = decoder.raw_decode(self.buffer, self.index)
+            except json.JSONDecodeError:
+                if not self.fill():
+                    raise
+                continue
+            # A number that ends exactly at the end of the buffer may continue in the next chunk
+            if end == len(self.buffer) and self.fill():
+                continue
+            self.index = end
+            return value
+
+
+def read_features(path, chunk_size=CHUNK_SIZE):
+    if instrument.enabled:
+        return instrument.timed_iterator('parse', _read_features(path, chunk_size))
+    return _read_features(path, chunk_size)
+
+
+def _read_features(path, chunk_size):
+    with open(path, 'r', encoding='utf-8') as geojson_file:
+        stream = _Stream(geojson_file, chunk_size)
+        stream.expect('{')
+        if stream.peek() == '}':
+            return
+        while True:
+            key = stream.value()
+            stream.expect(':')
+            if key == 'features':
+                stream.expect('[')
+                if stream.peek() == ']':
+                    stream.index += 1
+                else:
+                    while True:
+                        yield stream.value()
+                        if stream.peek() == ']':
+                            stream.index += 1
+                            break
+                        stream.expect(',')
+            else:
+                stream.value()
+            if stream.peek() == '}':
+                return
+            stream.expect(',')
+
+
+########################################################################################################################
+# Memory Reporting
+########################################################################################################################
+
+def peak_memory():
+    # `ru_maxrss` is reported in kilobytes on Linux and in bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
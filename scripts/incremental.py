@@ -0,0 +1,263 @@
+import hashlib
+
+import bulk
+import wkb
+
+########################################################################################################################
+# Fingerprints
+########################################################################################################################
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as source_file:
+        for chunk in iter(lambda: source_file.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def row_hash(row, geometries):
+    digest = hashlib.blake2b(digest_size=16)
+    for geometry, value in zip(geometries, row):
+        if geometry and value is not None:
+            digest.update(wkb.encode(value))
+        else:
+            digest.update(repr(value).encode('utf-8'))
+        digest.update(b'\x00')
+    return digest.hexdigest()
+
+
+def row_key(row, key_indexes):
+    # Every key column is either sanitized (`[a-z0-9_]`), a year or a race name, so `/` never occurs inside a value
+    return '/'.join(str(row[index]) for index in key_indexes)
+
+########################################################################################################################
+# Ingest Manifest
+########################################################################################################################
+
+# `gm.ingest_sources` records the content hash of every source file per table and `gm.ingest_features` records the
+# content hash of every row loaded from it, keyed by the row's unique key.
+
+def create_tables(cur):
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS gm.ingest_sources (
+        layer       VARCHAR     NOT NULL,
+        source      VARCHAR     NOT NULL,
+
+                    UNIQUE (layer, source),
+
+        hash        CHAR(64)    NOT NULL,
+        ingested_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+    );
+    ''')
+
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS gm.ingest_features (
+        layer      VARCHAR     NOT NULL,
+        key        VARCHAR     NOT NULL,
+
+                   UNIQUE (layer, key),
+
+        source     VARCHAR     NOT NULL,
+        hash       CHAR(32)    NOT NULL,
+        updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+    );
+    ''')
+
+    cur.execute('CREATE INDEX IF NOT EXISTS ingest_features_layer_source_idx ON gm.ingest_features(layer, source);')
+
+
+def reset(cur, table):
+    cur.execute('DELETE FROM gm.ingest_sources WHERE layer = %s;', (table,))
+    cur.execute('DELETE FROM gm.ingest_features WHERE layer = %s;', (table,))
+
+
+class Manifest:
+
+    def __init__(self, cur):
+        self.cur = cur
+        self.file_hashes = {}
+
+    def source_hash(self, source):
+        if source not in self.file_hashes:
+            self.file_hashes[source] = file_hash(source)
+        return self.file_hashes[source]
+
+    def stored_source_hash(self, layer, source):
+        self.cur.execute('SELECT hash FROM gm.ingest_sources WHERE layer = %s AND source = %s;', (layer, source))
+        row = self.cur.fetchone()
+        return row[0] if row else None
+
+    def stored_row_hashes(self, layer, source):
+        self.cur.execute('SELECT key, hash FROM gm.ingest_features WHERE layer = %s AND source = %s;', (layer, source))
+        return dict(self.cur.fetchall())
+
+    def stored_sources(self, layer):
+        self.cur.execute('SELECT source FROM gm.ingest_sources WHERE layer = %s;', (layer,))
+        return [row[0] for row in self.cur.fetchall()]
+
+    def key_sources(self, layer, keys):
+        self.cur.execute('SELECT key, source FROM gm.ingest_features WHERE layer = %s AND key = ANY(%s);',
+                         (layer, list(keys)))
+        return dict(self.cur.fetchall())
+
+    def forget_source(self, layer, source):
+        self.cur.execute('DELETE FROM gm.ingest_sources WHERE layer = %s AND source = %s;', (layer, source))
+
+    def record_source(self, layer, source):
+        self.cur.execute('''
+        INSERT INTO gm.ingest_sources (layer, source, hash)
+             VALUES (%s, %s, %s)
+        ON CONFLICT (layer, source)
+                 DO UPDATE SET hash = EXCLUDED.hash,
+                               ingested_at = NOW();
+        ''', (layer, source, self.source_hash(source)))
+
+########################################################################################################################
+# Incremental Writer
+########################################################################################################################
+
+# Drop-in replacement for `bulk.CopyWriter` that only loads rows whose content hash differs from the manifest. Changed
+# rows are copied into a temporary table and upserted into the target on `close()` and their keys are collected in
+# `changed`; keys that were in the manifest but were not written again are collected in `unwritten`, with their source.
+# Such a key may have moved to a file that another writer loads, so what to delete is only decided once every writer of
+# the layer has closed (see below).
+
+
+class IncrementalWriter:
+
+    def __init__(self, cur, manifest, table, columns, key, batch_size=10000, parents=()):
+        self.cur = cur
+        self.manifest = manifest
+        self.table = table
+        self.names = [name for name, _ in columns]
+        self.geometries = [column_type == 'geometry' for _, column_type in columns]
+        self.key = list(key)
+        self.key_indexes = [self.names.index(name) for name in self.key]
+        self.parents = list(parents)
+        self.changes_table = 'ingest_changes_' + table.split('.')[-1]
+        self.features_table = 'ingest_features_' + table.split('.')[-1]
+
+        cur.execute('CREATE TEMPORARY TABLE {} ON COMMIT DROP AS SELECT {} FROM {} WITH NO DATA;'.format(
+            self.changes_table, ', '.join(self.names), table))
+        cur.execute('CREATE TEMPORARY TABLE {} ON COMMIT DROP AS SELECT key, source, hash FROM gm.ingest_features '
+                    'WITH NO DATA;'.format(self.features_table))
+
+        self.changes = bulk.CopyWriter(cur, self.changes_table, columns, batch_size=batch_size)
+        self.features = bulk.CopyWriter(cur, self.features_table, [
+            ('key', 'text'),
+            ('source', 'text'),
+            ('hash', 'text'),
+        ], batch_size=batch_size)
+
+        self.source = None
+        self.sources = []
+        self.stored = {}
+        self.changed = []
+        self.unwritten = []
+        self.total_rows = 0
+        self.inserted = 0
+        self.updated = 0
+        self.unchanged = 0
+
+    @property
+    def total_bytes(self):
+        return self.changes.total_bytes + self.features.total_bytes
+
+    def begin(self, source):
+        if self.manifest.stored_source_hash(self.table, source) == self.manifest.source_hash(source):
+            return False
+        if source not in self.stored:
+            self.stored[source] = self.manifest.stored_row_hashes(self.table, source)
+            self.sources.append(source)
+        self.source = source
+        return True
+
+    def write(self, row):
+        key = row_key(row, self.key_indexes)
+        digest = row_hash(row, self.geometries)
+        stored = self.stored[self.source].pop(key, None)
+        if stored == digest:
+            self.unchanged += 1
+            return
+        if stored is None:
+            self.inserted += 1
+        else:
+            self.updated += 1
+        self.changed.append(key)
+        self.changes.write(row)
+        self.features.write((key, self.source, digest))
+        self.total_rows += 1
+
+    def flush(self):
+        self.changes.flush()
+
+    def close(self):
+        self.changes.close()
+        self.features.close()
+
+        updates = [name for name in self.names if name not in self.key]
+        self.cur.execute('''
+        INSERT INTO {table} ({columns})
+             SELECT {columns}
+               FROM {changes}
+        ON CONFLICT ({key})
+                 DO UPDATE SET {updates};
+        '''.format(
+            table=self.table,
+            columns=', '.join(self.names),
+            changes=self.changes_table,
+            key=', '.join(self.key),
+            updates=', '.join('{0} = EXCLUDED.{0}'.format(name) for name in updates),
+        ))
+
+        self.cur.execute('''
+        INSERT INTO gm.ingest_features (layer, key, source, hash)
+             SELECT %s, key, source, hash
+               FROM {features}
+        ON CONFLICT (layer, key)
+                 DO UPDATE SET source = EXCLUDED.source,
+                               hash = EXCLUDED.hash,
+                               updated_at = NOW();
+        '''.format(features=self.features_table), (self.table,))
+
+        for source in self.sources:
+            self.unwritten.extend((key, source) for key in self.stored[source])
+            self.manifest.record_source(self.table, source)
+        self.stored = {}
+
+
+########################################################################################################################
+# Deletes
+########################################################################################################################
+
+# Once every source has been loaded, the keys of a layer that no current source wrote are deleted: the `unwritten` keys
+# of changed sources that are still theirs in the manifest (a source that wrote a key since took it over) and every
+# key of a source that is no longer `listed`, e.g. a file that was removed or renamed. Callers delete the rows of every
+# table with `delete_rows()`, children before parents, so that foreign keys never dangle, and then `forget_source()`
+# every source that is gone.
+
+def stale_keys(manifest, layer, unwritten, listed):
+    # Returns the keys to delete and the sources that are no longer listed
+    owners = manifest.key_sources(layer, {key for key, _ in unwritten})
+    deleted = {key for key, source in unwritten if owners.get(key) == source}
+    removed = sorted(set(manifest.stored_sources(layer)) - set(listed))
+    for source in removed:
+        deleted.update(manifest.stored_row_hashes(layer, source))
+    return sorted(deleted), removed
+
+
+def delete_rows(cur, table, key, deleted):
+    if not deleted:
+        return
+    keys = [row_key.split('/') for row_key in deleted]
+    cur.execute('''
+    DELETE FROM {table} AS t
+          USING UNNEST({arrays}) AS d({key})
+          WHERE {conditions};
+    '''.format(
+        table=table,
+        arrays=', '.join(['%s::VARCHAR[]'] * len(key)),
+        key=', '.join(key),
+        conditions=' AND '.join('t.{0} = d.{0}'.format(name) for name in key),
+    ), [[row[index] for row in keys] for index in range(len(key))])
+    cur.execute('DELETE FROM gm.ingest_features WHERE layer = %s AND key = ANY(%s);', (table, list(deleted)))
@@ -1,676 +1,394 @@
-import psycopg2
-import re
+import argparse
+import glob
 import json
-
-
-def sanitize(name):
-    name = re.sub(r'[^a-zA-Z0-9]+', '_', name)
-    name = re.sub(r'(^_+|_+$)', '', name)
-    return name.lower()
-
-
-conn = psycopg2.connect(user='gm_ingest', host='127.0.0.1', port='5432', database='gm')
-cur = conn.cursor()
-
-########################################################################################################################
-# Ingest States
-########################################################################################################################
-
-cur.execute('DROP TABLE IF EXISTS gm.states CASCADE;')
-
-cur.execute('''
-CREATE TABLE gm.states (
-    name      VARCHAR  NOT NULL,
-
-              UNIQUE (name),
-
-    geometry  GEOMETRY NOT NULL,
-
-    area      REAL GENERATED ALWAYS AS (ST_Area(geometry, true) / 2589988.11) STORED,
-    perimeter REAL GENERATED ALWAYS AS (ST_Perimeter(geometry, true) / 1609.34) STORED,
-    npi       REAL GENERATED ALWAYS AS ((2 * SQRT(PI() * ST_Area(geometry, true))) / ST_Perimeter(geometry, true)) STORED
-);
-''')
-
-cur.execute('CREATE INDEX states_geometry_idx ON gm.states USING GIST (geometry);')
-
-states_meta = [{
-    'name_property': 'name',
-    'geojson': '../data/simplified/us-states.geojson',
-}]
-
-query = 'INSERT INTO gm.states (name, geometry) VALUES (%s, ST_GeomFromGeoJSON(%s));'
-
-for state_meta in states_meta:
-    with open(state_meta['geojson'], 'r') as geojson_file:
-        geojson = json.load(geojson_file)
-    for feature in geojson['features']:
-        state = (
-            sanitize(feature['properties'][state_meta['name_property']]),
-            json.dumps(feature['geometry'])
-        )
-        cur.execute(query, state)
-
-conn.commit()
-
-#########################################################################################################################
-# Ingest Counties
-########################################################################################################################
-
-cur.execute('DROP TABLE IF EXISTS gm.counties CASCADE;')
-
-cur.execute('''
-CREATE TABLE gm.counties (
-    state     VARCHAR  NOT NULL,
-
-              FOREIGN KEY (state)
-               REFERENCES gm.states(name),
-
-    name      VARCHAR  NOT NULL,
-
-              UNIQUE (state, name),
-
-    geometry  GEOMETRY NOT NULL,
-
-    area      REAL GENERATED ALWAYS AS (ST_Area(geometry, true) / 2589988.11) STORED,
-    perimeter REAL GENERATED ALWAYS AS (ST_Perimeter(geometry, true) / 1609.34) STORED,
-    npi       REAL GENERATED ALWAYS AS ((2 * SQRT(PI() * ST_Area(geometry, true))) / ST_Perimeter(geometry, true)) STORED
-);
-''')
-
-cur.execute('CREATE INDEX counties_state_fkey ON gm.counties(state);')
-cur.execute('CREATE INDEX counties_geometry_idx ON gm.counties USING GIST (geometry);')
-
-counties_meta = [{
-    'state': 'wisconsin',
-    'name_property': 'COUNTY_NAME',
-    'geojson': '../data/simplified/County_Boundaries_24K.geojson',
-}]
-
-query = 'INSERT INTO gm.counties (state, name, geometry) VALUES (%s, %s, ST_GeomFromGeoJSON(%s));'
-
-for county_meta in counties_meta:
-    with open(county_meta['geojson'], 'r') as geojson_file:
-        geojson = json.load(geojson_file)
-    for feature in geojson['features']:
-        county = (
-            county_meta['state'],
-            sanitize(feature['properties'][county_meta['name_property']]),
-            json.dumps(feature['geometry']),
-        )
-        cur.execute(query, county)
-
-conn.commit()
-
-########################################################################################################################
-# Ingest Assembly Districts
-########################################################################################################################
-
-cur.execute('DROP TABLE IF EXISTS gm.assemblies CASCADE;')
-
-cur.execute('''
-CREATE TABLE gm.assemblies (
-    state     VARCHAR  NOT NULL,
-
-              FOREIGN KEY (state)
-               REFERENCES gm.states(name),
-
-    year      CHAR(4)  NOT NULL,
-    name      VARCHAR  NOT NULL,
-
-              UNIQUE (state, year, name),
-
-    geometry  GEOMETRY NOT NULL,
-
-    area      REAL GENERATED ALWAYS AS (ST_Area(geometry, true) / 2589988.11) STORED,
-    perimeter REAL GENERATED ALWAYS AS (ST_Perimeter(geometry, true) / 1609.34) STORED,
-    npi       REAL GENERATED ALWAYS AS ((2 * SQRT(PI() * ST_Area(geometry, true))) / ST_Perimeter(geometry, true)) STORED
-);
-''')
-
-cur.execute('CREATE INDEX assemblies_state_fkey ON gm.assemblies(state);')
-cur.execute('CREATE INDEX assemblies_geometry_idx ON gm.assemblies USING GIST (geometry);')
-
-assemblies_meta = [{
-    'state': 'wisconsin',
-    'year': '2011',
-    'name_property': 'District_S',
-    'geojson': '../data/simplified/Wisconsin_Assembly_Districts_2012.geojson',
-}]
-
-query = 'INSERT INTO gm.assemblies (state, year, name, geometry) VALUES (%s, %s, %s, ST_GeomFromGeoJSON(%s));'
-
-for assembly_meta in assemblies_meta:
-    with open(assembly_meta['geojson'], 'r') as geojson_file:
-        geojson = json.load(geojson_file)
-    for feature in geojson['features']:
-        assembly = (
-            assembly_meta['state'],
-            assembly_meta['year'],
-            sanitize(feature['properties'][assembly_meta['name_property']]),
-            json.dumps(feature['geometry']),
-        )
-        cur.execute(query, assembly)
-
-conn.commit()
+import os
+
+import adjacency
+import assignment
+import crosswalk
+import db
+import incremental
+import instrument
+import layers
+import lookup
+import partitions
+import rollups
+import schedule
+import simplify
+import snapshot
+import staging
+import surrogate
+import tiles
+import topojson
 
 ########################################################################################################################
-# Ingest Senate Districts
+# Sources
 ########################################################################################################################
 
-cur.execute('DROP TABLE IF EXISTS gm.senates CASCADE;')
-
-cur.execute('''
-CREATE TABLE gm.senates (
-    state     VARCHAR  NOT NULL,
-
-              FOREIGN KEY (state)
-               REFERENCES gm.states(name),
-
-    year      CHAR(4)  NOT NULL,
-    name      VARCHAR  NOT NULL,
-
-              UNIQUE (state, year, name),
-
-    geometry  GEOMETRY NOT NULL,
-
-    area      REAL GENERATED ALWAYS AS (ST_Area(geometry, true) / 2589988.11) STORED,
-    perimeter REAL GENERATED ALWAYS AS (ST_Perimeter(geometry, true) / 1609.34) STORED,
-    npi       REAL GENERATED ALWAYS AS ((2 * SQRT(PI() * ST_Area(geometry, true))) / ST_Perimeter(geometry, true)) STORED
-);
-''')
-
-cur.execute('CREATE INDEX senates_state_fkey ON gm.senates(state);')
-cur.execute('CREATE INDEX senates_geometry_idx ON gm.senates USING GIST (geometry);')
-
-senates_meta = [{
-    'state': 'wisconsin',
-    'year': '2011',
-    'name_property': 'SEN_NUM',
-    'geojson': '../data/simplified/Wisconsin_Senate_Districts.geojson',
-}]
-
-query = 'INSERT INTO gm.senates (state, year, name, geometry) VALUES (%s, %s, %s, ST_GeomFromGeoJSON(%s));'
-
-for senate_meta in senates_meta:
-    with open(senate_meta['geojson'], 'r') as geojson_file:
-        geojson = json.load(geojson_file)
-    for feature in geojson['features']:
-        senate = (
-            senate_meta['state'],
-            senate_meta['year'],
-            sanitize(feature['properties'][senate_meta['name_property']]),
-            json.dumps(feature['geometry']),
-        )
-        cur.execute(query, senate)
-
-conn.commit()
+# `sources/states.json` lists the national state boundary files and every other `sources/<state>.json` declares the
+# counties, districts, wards, votes and populations of one state, keyed by table, and the district plans its wards are
+# assigned to under `plans`. Each entry is the same `*_meta` object the loaders take, minus `state`, which is filled in
+# from the file.
+
+def read_sources(directory):
+    with open(os.path.join(directory, 'states.json'), 'r') as sources_file:
+        states_meta = json.load(sources_file)
+
+    state_sources = {}
+    for path in sorted(glob.glob(os.path.join(directory, '*.json'))):
+        if os.path.basename(path) == 'states.json':
+            continue
+        with open(path, 'r') as sources_file:
+            sources = json.load(sources_file)
+        for table in layers.TABLES[1:] + ['plans']:
+            for meta in sources.get(table, []):
+                meta['state'] = sources['state']
+        state_sources[sources['state']] = sources
+
+    return states_meta, state_sources
+
+
+def listed_sources(states_meta, state_sources):
+    # The source files every table is currently loaded from
+    listed = {'states': [meta['geojson'] for meta in states_meta]}
+    for sources in state_sources.values():
+        for table in layers.TABLES[1:]:
+            listed.setdefault(table, []).extend(meta['geojson'] for meta in sources.get(table, []))
+    return listed
 
 ########################################################################################################################
-# Ingest Congressional Districts
+# Tables
 ########################################################################################################################
 
-cur.execute('DROP TABLE IF EXISTS gm.congressionals CASCADE;')
-
-cur.execute('''
-CREATE TABLE gm.congressionals (
-    state     VARCHAR  NOT NULL,
-
-              FOREIGN KEY (state)
-               REFERENCES gm.states(name),
-
-    year      CHAR(4)  NOT NULL,
-    name      VARCHAR  NOT NULL,
-
-              UNIQUE (state, year, name),
-
-    geometry  GEOMETRY NOT NULL,
-
-    area      REAL GENERATED ALWAYS AS (ST_Area(geometry, true) / 2589988.11) STORED,
-    perimeter REAL GENERATED ALWAYS AS (ST_Perimeter(geometry, true) / 1609.34) STORED,
-    npi       REAL GENERATED ALWAYS AS ((2 * SQRT(PI() * ST_Area(geometry, true))) / ST_Perimeter(geometry, true)) STORED
-);
-''')
-
-cur.execute('CREATE INDEX congressionals_state_fkey ON gm.congressionals(state);')
-cur.execute('CREATE INDEX congressionals_geometry_idx ON gm.congressionals USING GIST (geometry);')
-
-congressionals_meta = [{
-    'state': 'wisconsin',
-    'year': '2011',
-    'name_property': 'District_N',
-    'geojson': '../data/simplified/Wisconsin_Congressional_Districts_2011.geojson',
-}]
-
-query = 'INSERT INTO gm.congressionals (state, year, name, geometry) VALUES (%s, %s, %s, ST_GeomFromGeoJSON(%s));'
-
-for congressional_meta in congressionals_meta:
-    with open(congressional_meta['geojson'], 'r') as geojson_file:
-        geojson = json.load(geojson_file)
-    for feature in geojson['features']:
-        congressional = (
-            congressional_meta['state'],
-            congressional_meta['year'],
-            sanitize(feature['properties'][congressional_meta['name_property']]),
-            json.dumps(feature['geometry']),
-        )
-        cur.execute(query, congressional)
-
-conn.commit()
+# A full ingest drops and recreates every table; an incremental one keeps them and only creates what is missing.
+
+def create_tables(cur, options, state_sources):
+    drop = not options['incremental']
+    layers.create_tables(cur, drop=drop, client_metrics=options['client_metrics'],
+                         surrogate_keys=options['surrogate_keys'], partitioned=options['partitioned'])
+    if options['partitioned']:
+        partitions.create_partitions(cur, partitions.partition_keys(state_sources), load=drop)
+    if options['surrogate_keys']:
+        surrogate.insert_races(cur, state_sources)
+    simplify.create_columns(cur)
+    rollups.create_table(cur, drop=drop)
+    adjacency.create_table(cur, drop=drop)
+    assignment.create_table(cur, drop=drop)
+    topojson.create_table(cur, drop=drop)
+    incremental.create_tables(cur)
+    if drop:
+        for table in layers.TABLES:
+            incremental.reset(cur, 'gm.' + table)
 
 ########################################################################################################################
-# Ingest Wards
+# Tasks
 ########################################################################################################################
 
-cur.execute('DROP TABLE IF EXISTS gm.wards CASCADE;')
-
-cur.execute('''
-CREATE TABLE gm.wards (
-    state         VARCHAR  NOT NULL,
-
-                  FOREIGN KEY (state)
-                   REFERENCES gm.states(name),
-
-    year          CHAR(4)  NOT NULL,
-    name          VARCHAR  NOT NULL,
-
-                  UNIQUE (state, year, name),
-
-    county        VARCHAR  NOT NULL,
-
-                  FOREIGN KEY (state, county)
-                   REFERENCES gm.counties(state, name),
-
-    assembly      VARCHAR  NOT NULL,
-
-                  FOREIGN KEY (state, year, assembly)
-                   REFERENCES gm.assemblies(state, year, name),
-
-    senate        VARCHAR  NOT NULL,
-
-                  FOREIGN KEY (state, year, senate)
-                   REFERENCES gm.senates(state, year, name),
-
-    congressional VARCHAR  NOT NULL,
-
-                  FOREIGN KEY (state, year, congressional)
-                   REFERENCES gm.congressionals(state, year, name),
-
-    geometry      GEOMETRY NOT NULL,
-
-    area          REAL GENERATED ALWAYS AS (ST_Area(geometry, true) / 2589988.11) STORED,
-    perimeter     REAL GENERATED ALWAYS AS (ST_Perimeter(geometry, true) / 1609.34) STORED,
-    npi           REAL GENERATED ALWAYS AS ((2 * SQRT(PI() * ST_Area(geometry, true))) / ST_Perimeter(geometry, true)) STORED
-);
-''')
-
-cur.execute('CREATE INDEX wards_state_fkey ON gm.wards(state);')
-cur.execute('CREATE INDEX wards_state_county_fkey ON gm.wards(state, county);')
-cur.execute('CREATE INDEX wards_state_year_assembly_fkey ON gm.wards(state, year, assembly);')
-cur.execute('CREATE INDEX wards_state_year_senate_fkey ON gm.wards(state, year, senate);')
-cur.execute('CREATE INDEX wards_state_year_congressional_fkey ON gm.wards(state, year, congressional);')
-cur.execute('CREATE INDEX wards_geometry_idx ON gm.wards USING GIST (geometry);')
-
-wards_meta = [{
-    'state': 'wisconsin',
-    'county_property': 'CNTY_NAME',
-    'year': '2011',
-    'name_property': 'LABEL',
-    'assembly_property': 'ASM',
-    'senate_property': 'SEN',
-    'congressional_property': 'CON',
-    'geojson': '../data/simplified/2018-2012_Election_Data_with_2011_Wards.geojson',
-}]
-
-query = '''
-INSERT INTO gm.wards (
-    state,
-    year,
-    name,
-    county,
-    assembly,
-    senate,
-    congressional,
-    geometry
-) VALUES (%s, %s, %s, %s, %s, %s, %s, ST_GeomFromGeoJSON(%s));
-'''
-
-for ward_meta in wards_meta:
-    with open(ward_meta['geojson'], 'r') as geojson_file:
-        geojson = json.load(geojson_file)
-    for feature in geojson['features']:
-        ward = (
-            ward_meta['state'],
-            ward_meta['year'],
-            sanitize(feature['properties'][ward_meta['county_property']]) + '_' + sanitize(feature['properties'][ward_meta['name_property']]),
-            sanitize(feature['properties'][ward_meta['county_property']]),
-            sanitize(feature['properties'][ward_meta['assembly_property']]),
-            sanitize(feature['properties'][ward_meta['senate_property']]),
-            sanitize(feature['properties'][ward_meta['congressional_property']]),
-            json.dumps(feature['geometry']),
-        )
-        cur.execute(query, ward)
-
-conn.commit()
+# The foreign keys form a DAG: states, then each state's counties and districts, then its wards, then its votes and
+# populations. Votes and populations that are read from the same file as wards share that file's (fan-out) task;
+# those read from another file get their own task that waits for the state's ward tasks. Indexes are built once every
+# load task of their table has finished (or, with `--partitioned`, once its partitions are attached).
+
+def build_tasks(options, states_meta, state_sources):
+    tasks = {'states': schedule.Task(layers.load_states, (options, states_meta), [])}
+    tables = {'states': ['states']}
+
+    for state, sources in state_sources.items():
+        tasks[state + '/counties'] = schedule.Task(layers.load_counties, (
+            options,
+            sources.get('counties', []),
+        ), ['states'])
+        tables.setdefault('counties', []).append(state + '/counties')
+
+        for table in ['assemblies', 'senates', 'congressionals']:
+            tasks[state + '/' + table] = schedule.Task(layers.load_districts, (
+                options,
+                table,
+                sources.get(table, []),
+            ), ['states'])
+            tables.setdefault(table, []).append(state + '/' + table)
+
+        metas_by_geojson = {}
+        for table in ['wards', 'votes', 'populations']:
+            for meta in sources.get(table, []):
+                metas_by_geojson.setdefault(meta['geojson'], {}).setdefault(table, []).append(meta)
+
+        names = {}
+        for geojson, metas in metas_by_geojson.items():
+            kind = 'wards' if 'wards' in metas else 'votes_populations'
+            names[geojson] = '{}/{}:{}'.format(state, kind, os.path.basename(geojson))
+        ward_tasks = [names[geojson] for geojson, metas in metas_by_geojson.items() if 'wards' in metas]
+
+        for geojson, metas in metas_by_geojson.items():
+            name = names[geojson]
+            dependencies = [state + '/counties', state + '/assemblies', state + '/senates', state + '/congressionals']
+            if 'wards' not in metas:
+                dependencies.extend(ward_tasks)
+            tasks[name] = schedule.Task(layers.load_wards, (
+                options,
+                geojson,
+                metas.get('wards', []),
+                metas.get('votes', []),
+                metas.get('populations', []),
+            ), dependencies)
+            for table in metas:
+                tables.setdefault(table, []).append(name)
+
+    # Partitioned tables are loaded into detached tables, attached per state once all of its load tasks are done
+    if options['partitioned'] and not options['incremental']:
+        keys = partitions.partition_keys(state_sources)
+        for table in partitions.TABLES:
+            attach_tasks = []
+            for state in sorted({state for state, _ in keys[table]}):
+                name = '{}/{}:attach'.format(state, table)
+                tasks[name] = schedule.Task(partitions.attach_state, (
+                    table,
+                    layers.KEYS[table],
+                    state,
+                    [year for key_state, year in keys[table] if key_state == state],
+                ), [task for task in tables.get(table, []) if task.startswith(state + '/')])
+                attach_tasks.append(name)
+            tables[table] = attach_tasks
+
+    for table in layers.TABLES:
+        tasks['indexes/' + table] = schedule.Task(layers.create_indexes, (table, options['surrogate_keys']),
+                                                  tables.get(table, []))
+
+    return tasks
+
+
+# Derived tables and columns are refreshed once every load has finished and deleted rows are gone. A full ingest
+# rebuilds every state; an incremental one only the rollup slices whose votes or wards changed, the simplification
+# groups whose geometries changed, the adjacency graphs and lookup indexes of states whose wards changed, the
+# snapshots of states whose wards, votes or populations changed and the TopoJSON of states whose geometries, votes or
+# populations changed (after their rollups). Plans are reassigned when their file or their state's wards changed. The
+# crosswalks between ward vintages of every state are checked, and only rebuilt where a vintage changed.
+
+def build_derived_tasks(options, state_sources, results):
+    if options['incremental']:
+        summaries = [summary for summaries in results.values() for summary in summaries]
+        slices = rollups.slices(summaries)
+        groups = simplify.groups(summaries)
+        graphs = adjacency.states(summaries)
+        snapshots = snapshot.states(summaries)
+        topologies = topojson.states(summaries)
+    else:
+        slices = [(state, None, None, None) for state in state_sources]
+        groups = ['states'] + list(state_sources)
+        graphs = list(state_sources)
+        snapshots = list(state_sources)
+        topologies = list(state_sources)
+
+    state_slices = {}
+    for state_slice in slices:
+        state_slices.setdefault(state_slice[0], []).append(state_slice)
+
+    tasks = {}
+    for state, refreshes in state_slices.items():
+        tasks[state + '/vote_rollups'] = schedule.Task(rollups.refresh, (refreshes,), [])
+    for group in groups:
+        tasks[group + '/simplify'] = schedule.Task(simplify.simplify_group, (group,), [])
+    for state in graphs:
+        tasks[state + '/ward_adjacencies'] = schedule.Task(adjacency.build_state, (state, options['adjacency']), [])
+        tasks[state + '/lookup'] = schedule.Task(lookup.build_state, (state, options['lookup']), [])
+    for state in snapshots:
+        tasks[state + '/snapshot'] = schedule.Task(snapshot.build_state, (state, options['snapshot']), [])
+    for state in topologies:
+        # Properties come from the rollups, so the state's rollups must be refreshed first
+        dependencies = [state + '/vote_rollups'] if state + '/vote_rollups' in tasks else []
+        tasks[state + '/topology'] = schedule.Task(topojson.build_state, (state,), dependencies)
+    for state in state_sources:
+        tasks[state + '/crosswalk'] = schedule.Task(crosswalk.build_state, (state, options['crosswalk']), [])
+    for state, sources in state_sources.items():
+        for plan_meta in sources.get('plans', []):
+            force = not options['incremental'] or state in graphs
+            tasks['{}/plans/{}'.format(state, plan_meta['name'])] = schedule.Task(assignment.assign_plan,
+                                                                                 (plan_meta, force), [])
+    return tasks
 
 ########################################################################################################################
-# Ingest Votes
+# Reporting
 ########################################################################################################################
 
-cur.execute('DROP TABLE IF EXISTS gm.votes CASCADE;')
-
-cur.execute('''
-CREATE TABLE gm.votes (
-    state           VARCHAR NOT NULL,
-
-                    FOREIGN KEY (state)
-                     REFERENCES gm.states(name),
-
-    race            VARCHAR NOT NULL,
-    year            CHAR(4) NOT NULL,
-    ward_year       CHAR(4) NOT NULL,
-    ward            VARCHAR NOT NULL,
-
-                    UNIQUE (state, race, year, ward_year, ward),
-
-                    FOREIGN KEY (state, ward_year, ward)
-                     REFERENCES gm.wards(state, year, name),
-
-    total           INTEGER NOT NULL,
-    democrat        INTEGER NOT NULL,
-    republican      INTEGER NOT NULL,
-
-    competitiveness REAL GENERATED ALWAYS AS (CASE
-                                                WHEN democrat + republican > 0
-                                                  THEN ((democrat::REAL / (democrat + republican)) - 0.5) / 0.5
-                                                ELSE 0
-                                              END) STORED
-);
-''')
-
-cur.execute('CREATE INDEX votes_state_fkey ON gm.votes(state);')
-cur.execute('CREATE INDEX votes_state_ward_year_ward_fkey ON gm.votes(state, ward_year, ward);')
-
-votes_meta = [{
-    'state': 'wisconsin',
-    'county_property': 'CNTY_NAME',
-    'ward_year': '2011',
-    'ward_property': 'LABEL',
-    'races': {
-        'president': [{
-            'year': '2012',
-            'total_property': 'PRETOT12',
-            'democrat_property': 'PREDEM12',
-            'republican_property': 'PREREP12',
-        }, {
-            'year': '2016',
-            'total_property': 'PRETOT16',
-            'democrat_property': 'PREDEM16',
-            'republican_property': 'PREREP16',
-        }],
-        'senate': [{
-            'year': '2012',
-            'total_property': 'USSTOT12',
-            'democrat_property': 'USSDEM12',
-            'republican_property': 'USSREP12',
-        }, {
-            'year': '2016',
-            'total_property': 'USSTOT16',
-            'democrat_property': 'USSDEM16',
-            'republican_property': 'USSREP16',
-        }, {
-            'year': '2018',
-            'total_property': 'USSTOT18',
-            'democrat_property': 'USSDEM18',
-            'republican_property': 'USSREP18',
-        }],
-        'house': [{
-            'year': '2012',
-            'total_property': 'USHTOT12',
-            'democrat_property': 'USHDEM12',
-            'republican_property': 'USHREP12',
-        }, {
-            'year': '2014',
-            'total_property': 'USHTOT14',
-            'democrat_property': 'USHDEM14',
-            'republican_property': 'USHREP14',
-        }, {
-            'year': '2016',
-            'total_property': 'USHTOT16',
-            'democrat_property': 'USHDEM16',
-            'republican_property': 'USHREP16',
-        }, {
-            'year': '2018',
-            'total_property': 'USHTOT18',
-            'democrat_property': 'USHDEM18',
-            'republican_property': 'USHREP18',
-        }],
-        'governor': [{
-            'year': '2012',
-            'total_property': 'GOVTOT12',
-            'democrat_property': 'GOVDEM12',
-            'republican_property': 'GOVREP12',
-        }, {
-            'year': '2014',
-            'total_property': 'GOVTOT14',
-            'democrat_property': 'GOVDEM14',
-            'republican_property': 'GOVREP14',
-        }, {
-            'year': '2018',
-            'total_property': 'GOVTOT18',
-            'democrat_property': 'GOVDEM18',
-            'republican_property': 'GOVREP18',
-        }],
-        'state_senate': [{
-            'year': '2012',
-            'total_property': 'WSSTOT12',
-            'democrat_property': 'WSSDEM12',
-            'republican_property': 'WSSREP12',
-        }, {
-            'year': '2014',
-            'total_property': 'WSSTOT14',
-            'democrat_property': 'WSSDEM14',
-            'republican_property': 'WSSREP14',
-        }, {
-            'year': '2016',
-            'total_property': 'WSSTOT16',
-            'democrat_property': 'WSSDEM16',
-            'republican_property': 'WSSREP16',
-        }, {
-            'year': '2018',
-            'total_property': 'WSSTOT18',
-            'democrat_property': 'WSSDEM18',
-            'republican_property': 'WSSREP18',
-        }],
-        'state_assembly': [{
-            'year': '2012',
-            'total_property': 'WSATOT12',
-            'democrat_property': 'WSADEM12',
-            'republican_property': 'WSAREP12',
-        }, {
-            'year': '2014',
-            'total_property': 'WSATOT14',
-            'democrat_property': 'WSADEM14',
-            'republican_property': 'WSAREP14',
-        }, {
-            'year': '2016',
-            'total_property': 'WSATOT16',
-            'democrat_property': 'WSADEM16',
-            'republican_property': 'WSAREP16',
-        }, {
-            'year': '2018',
-            'total_property': 'WSATOT18',
-            'democrat_property': 'WSADEM18',
-            'republican_property': 'WSAREP18',
-        }],
-        'county_district_attorney': [{
-            'year': '2012',
-            'total_property': 'CDATOT12',
-            'democrat_property': 'CDADEM12',
-            'republican_property': 'CDAREP12',
-        }, {
-            'year': '2016',
-            'total_property': 'CDATOT16',
-            'democrat_property': 'CDADEM16',
-            'republican_property': 'CDAREP16',
-        }],
-        'state_attorney_general': [{
-            'year': '2014',
-            'total_property': 'WAGTOT14',
-            'democrat_property': 'WAGDEM14',
-            'republican_property': 'WAGREP14',
-        }, {
-            'year': '2018',
-            'total_property': 'WAGTOT18',
-            'democrat_property': 'WAGDEM18',
-            'republican_property': 'WAGREP18',
-        }],
-        'state_treasurer': [{
-            'year': '2014',
-            'total_property': 'TRSTOT14',
-            'democrat_property': 'TRSDEM14',
-            'republican_property': 'TRSREP14',
-        }, {
-            'year': '2018',
-            'total_property': 'TRSTOT18',
-            'democrat_property': 'TRSDEM18',
-            'republican_property': 'TRSREP18',
-        }],
-        'state_secretary_of_state': [{
-            'year': '2014',
-            'total_property': 'SOSTOT14',
-            'democrat_property': 'SOSDEM14',
-            'republican_property': 'SOSREP14',
-        }, {
-            'year': '2018',
-            'total_property': 'SOSTOT18',
-            'democrat_property': 'SOSDEM18',
-            'republican_property': 'SOSREP18',
-        }],
-    },
-    'geojson': '../data/simplified/2018-2012_Election_Data_with_2011_Wards.geojson',
-}]
-
-query = '''
-INSERT INTO gm.votes (
-    state,
-    race,
-    year,
-    ward_year,
-    ward,
-    total,
-    democrat,
-    republican
-) VALUES (%s, %s, %s, %s, %s, %s, %s, %s);
-'''
-
-for vote_meta in votes_meta:
-    with open(vote_meta['geojson'], 'r') as geojson_file:
-        geojson = json.load(geojson_file)
-    for feature in geojson['features']:
-        for race, years in vote_meta['races'].items():
-            for year in years:
-                vote = (
-                    vote_meta['state'],
-                    race,
-                    year['year'],
-                    vote_meta['ward_year'],
-                    sanitize(feature['properties'][vote_meta['county_property']]) + '_' + sanitize(feature['properties'][vote_meta['ward_property']]),
-                    feature['properties'][year['total_property']],
-                    feature['properties'][year['democrat_property']],
-                    feature['properties'][year['republican_property']],
-                )
-                cur.execute(query, vote)
-
-conn.commit()
+def report(options, task, summaries):
+    for summary in summaries:
+        if 'derived' in summary:
+            print('{} {}: {}'.format(task, summary.get('path', 'gm.' + summary['table']), summary['derived']))
+        elif options['incremental']:
+            print('{} gm.{}: {} inserted, {} updated, {} unchanged, {} no longer in the source, peak RSS {:.1f} '
+                  'MiB'.format(task, summary['table'], summary['inserted'], summary['updated'], summary['unchanged'],
+                               len(summary['unwritten']), summary['peak_memory'] / 2 ** 20))
+        else:
+            print('{} gm.{}: {} rows, peak RSS {:.1f} MiB'.format(
+                task, summary['table'], summary['rows'], summary['peak_memory'] / 2 ** 20))
 
 ########################################################################################################################
-# Ingest Populations
+# Ingest
 ########################################################################################################################
 
-cur.execute('DROP TABLE IF EXISTS gm.populations CASCADE;')
-
-cur.execute('''
-CREATE TABLE gm.populations (
-    state            VARCHAR NOT NULL,
-
-                     FOREIGN KEY (state)
-                      REFERENCES gm.states(name),
-
-    year             CHAR(4) NOT NULL,
-    ward_year        CHAR(4) NOT NULL,
-    ward             VARCHAR NOT NULL,
-
-                     UNIQUE (state, year, ward_year, ward),
-
-                     FOREIGN KEY (state, ward_year, ward)
-                      REFERENCES gm.wards(state, year, name),
-
-    total            INTEGER NOT NULL,
-    white            INTEGER NOT NULL,
-    black            INTEGER NOT NULL,
-    american_indian  INTEGER NOT NULL,
-    asian            INTEGER NOT NULL,
-    pacific_islander INTEGER NOT NULL,
-    hispanic         INTEGER NOT NULL
-);
-''')
-
-cur.execute('CREATE INDEX populations_state_fkey ON gm.populations(state);')
-cur.execute('CREATE INDEX populations_state_ward_year_ward_fkey ON gm.populations(state, ward_year, ward);')
-
-populations_meta = [{
-    'state': 'wisconsin',
-    'year': '2010',
-    'county_property': 'CNTY_NAME',
-    'ward_year': '2011',
-    'ward_property': 'LABEL',
-    'total_property': 'PERSONS18',
-    'white_property': 'WHITE18',
-    'black_property': 'BLACK18',
-    'american_indian_property': 'AMINDIAN18',
-    'asian_property': 'ASIAN18',
-    'pacific_islander_property': 'PISLAND18',
-    'hispanic_property': 'HISPANIC18',
-    'geojson': '../data/simplified/2018-2012_Election_Data_with_2011_Wards.geojson',
-}]
-
-query = '''
-INSERT INTO gm.populations (
-    state,
-    year,
-    ward_year,
-    ward,
-    total,
-    white,
-    black,
-    american_indian,
-    asian,
-    pacific_islander,
-    hispanic
-) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s);
-'''
-
-for population_meta in populations_meta:
-    with open(population_meta['geojson'], 'r') as geojson_file:
-        geojson = json.load(geojson_file)
-    for feature in geojson['features']:
-        population = (
-            population_meta['state'],
-            population_meta['year'],
-            population_meta['ward_year'],
-            sanitize(feature['properties'][population_meta['county_property']]) + '_' + sanitize(feature['properties'][population_meta['ward_property']]),
-            feature['properties'][population_meta['total_property']],
-            feature['properties'][population_meta['white_property']],
-            feature['properties'][population_meta['black_property']],
-            feature['properties'][population_meta['american_indian_property']],
-            feature['properties'][population_meta['asian_property']],
-            feature['properties'][population_meta['pacific_islander_property']],
-            feature['properties'][population_meta['hispanic_property']],
-        )
-        cur.execute(query, population)
-
-conn.commit()
-
-cur.close()
-conn.close()
+def main():
+    parser = argparse.ArgumentParser(description='Ingest the gm schema from the GeoJSON sources declared in '
+                                                 '`sources/`.')
+    parser.add_argument('--sources', default='sources', help='directory of source manifests (default: sources)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='number of worker processes, each with its own connection (default: CPU count)')
+    parser.add_argument('--batch-size', type=int, default=10000, help='rows per COPY batch (default: 10000)')
+    parser.add_argument('--insert', action='store_true', help='load with one INSERT per row instead of binary COPY')
+    parser.add_argument('--pipeline-depth', type=int, default=4,
+                        help='COPY batches every load task may queue for a background thread to send while it goes on '
+                             'parsing and encoding, 0 to send them synchronously (default: 4)')
+    parser.add_argument('--incremental', action='store_true',
+                        help='keep existing tables and only upsert/delete rows whose content changed, skipping '
+                             'source files whose hash is unchanged (the first run after a full ingest rewrites every '
+                             'row once)')
+    parser.add_argument('--client-metrics', action='store_true',
+                        help='compute area, perimeter and npi during ingest with vectorized geodesic math and store '
+                             'them as plain columns instead of PostGIS generated columns (switching requires a full '
+                             'ingest; compare with `python metrics.py`)')
+    parser.add_argument('--surrogate-keys', action='store_true',
+                        help='key votes and populations on integer ward and race ids in `gm.vote_facts` and '
+                             '`gm.population_facts`, with `gm.votes` and `gm.populations` as views that resolve them '
+                             'back to names (full ingests only; switching requires a full ingest)')
+    parser.add_argument('--partitioned', action='store_true',
+                        help='partition `gm.votes` and `gm.populations` by state and year, loading every partition '
+                             'detached and attaching it once loaded (switching requires a full ingest)')
+    parser.add_argument('--staging', action='store_true',
+                        help='build everything, with indexes and statistics, in the `gm_staging` schema while the API '
+                             'keeps reading `gm`, then swap it in with one short transaction, keeping the replaced '
+                             'version in `gm_previous` (undo with `python staging.py`)')
+    parser.add_argument('--adjacency', default='adjacency',
+                        help='directory of the ward adjacency graphs in CSR form, one `<state>-<year>.npz` per ward '
+                             'vintage (default: adjacency)')
+    parser.add_argument('--snapshot', default='snapshot',
+                        help='directory of the memory-mappable columnar snapshots of every ward vintage, one '
+                             '`<state>-<year>/` per vintage (default: snapshot)')
+    parser.add_argument('--lookup', default='lookup',
+                        help='directory of the memory-mappable ward indexes for point lookups (see `lookup.py`), one '
+                             '`<state>-<year>/` per vintage (default: lookup)')
+    parser.add_argument('--crosswalk', default='crosswalk',
+                        help='directory of the cached crosswalks between ward vintages, one '
+                             '`<state>-<source year>-<target year>-<weighting>.npz` per pair (default: crosswalk)')
+    parser.add_argument('--tiles', metavar='MBTILES',
+                        help='afterwards, re-render the vector tiles affected by this ingest into the given MBTiles '
+                             'file at zoom levels 0-12 (run `python tiles.py` directly for other levels)')
+    parser.add_argument('--profile', metavar='REPORT',
+                        help='time every stage and task, split into parsing, transforming, database round trips and '
+                             'commits, with rows and bytes per second of every table and the slowest statements (from '
+                             '`pg_stat_statements` when installed), and write them to the given JSON file')
+    parser.add_argument('--metrics-textfile', metavar='PROM',
+                        help='write the same metrics as `--profile` to the given Prometheus textfile, e.g. in the node '
+                             'exporter\'s textfile collector directory')
+    args = parser.parse_args()
+    if args.surrogate_keys and args.incremental:
+        parser.error('--surrogate-keys cannot be combined with --incremental')
+    if args.surrogate_keys and args.partitioned:
+        parser.error('--surrogate-keys cannot be combined with --partitioned')
+    if args.staging and args.incremental:
+        parser.error('--staging cannot be combined with --incremental')
+
+    options = {
+        'incremental': args.incremental,
+        'insert': args.insert,
+        'batch_size': args.batch_size,
+        'pipeline_depth': args.pipeline_depth,
+        'client_metrics': args.client_metrics,
+        'surrogate_keys': args.surrogate_keys,
+        'partitioned': args.partitioned,
+        'adjacency': args.adjacency,
+        'snapshot': args.snapshot,
+        'crosswalk': args.crosswalk,
+        'lookup': args.lookup,
+    }
+
+    states_meta, state_sources = read_sources(args.sources)
+
+    # Stages are always timed, but tasks and statements only when a report is requested
+    profile = instrument.Report(options, args.workers)
+    profiling = bool(args.profile or args.metrics_textfile)
+    if profiling:
+        instrument.enable()
+
+    def done(task, summaries):
+        report(options, task, summaries)
+        profile.summaries(task, summaries)
+
+    on_metrics = profile.task if profiling else None
+
+    if args.staging:
+        db.use_schema(staging.STAGING)
+
+    conn = db.connect()
+    cur = conn.cursor()
+    statements = instrument.statement_snapshot(cur) if profiling else None
+    conn.commit()
+
+    with profile.stage('tables'):
+        if args.staging:
+            staging.clear(cur, staging.STAGING)
+        create_tables(cur, options, state_sources)
+        conn.commit()
+
+    with profile.stage('load'):
+        results = schedule.run(build_tasks(options, states_meta, state_sources), workers=args.workers, on_done=done,
+                               on_metrics=on_metrics)
+
+    # Rows are only deleted once every table has been upserted, children before parents, so that no foreign key ever
+    # points at a deleted row, and once every source has been loaded, so that a row that moved to another file is kept
+    # (see `incremental.stale_keys()`). The deleted keys are summarized like a load task's, for the derived tasks.
+    if args.incremental:
+        with profile.stage('deletes'):
+            manifest = incremental.Manifest(cur)
+            listed = listed_sources(states_meta, state_sources)
+            unwritten = {}
+            for summaries in results.values():
+                for summary in summaries:
+                    unwritten.setdefault(summary['table'], []).extend(summary['unwritten'])
+            results['deletes'] = []
+            for table in reversed(layers.TABLES):
+                deleted, removed = incremental.stale_keys(manifest, 'gm.' + table, unwritten.get(table, []),
+                                                          listed.get(table, []))
+                incremental.delete_rows(cur, 'gm.' + table, layers.KEYS[table], deleted)
+                for source in removed:
+                    manifest.forget_source('gm.' + table, source)
+                results['deletes'].append({'table': table, 'changed': [], 'deleted': deleted})
+                print('deletes gm.{}: {} deleted, {} sources no longer listed'.format(table, len(deleted),
+                                                                                     len(removed)))
+            conn.commit()
+
+    with profile.stage('derived'):
+        schedule.run(build_derived_tasks(options, state_sources, results), workers=args.workers, on_done=done,
+                     on_metrics=on_metrics)
+
+    if args.staging:
+        with profile.stage('analyze'):
+            print('{}: {} tables analyzed'.format(staging.STAGING, staging.analyze(cur, staging.STAGING)))
+            conn.commit()
+
+    if profiling:
+        profile.server_statements = instrument.statement_difference(statements, instrument.statement_snapshot(cur))
+        conn.commit()
+
+    cur.close()
+    conn.close()
+
+    if args.staging:
+        with profile.stage('swap'):
+            db.use_schema(db.SCHEMA)
+            conn = db.connect()
+            print('{}: {} relations swapped into {}, replaced ones kept in {}'.format(
+                staging.STAGING, staging.swap(conn), db.SCHEMA, staging.PREVIOUS))
+            conn.close()
+
+    if args.tiles:
+        with profile.stage('tiles'):
+            result = tiles.build(args.tiles, workers=args.workers)
+        print('{}: {} tiles rendered, {} non-empty'.format(args.tiles, result['tiles'], result['written']))
+
+    if profiling:
+        summary = profile.write(args.profile, args.metrics_textfile)
+        print('{:.1f} s: {}'.format(summary['seconds'], ', '.join(
+            '{} {:.1f} s'.format(stage, seconds) for stage, seconds in summary['stages'].items())))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,269 @@
+import collections
+import contextlib
+import datetime
+import json
+import os
+import re
+import time
+
+import features
+
+########################################################################################################################
+# Timers
+########################################################################################################################
+
+# With instrumentation enabled every process accumulates where its time goes: parsing GeoJSON (`parse`, timed by
+# `features.read_features`), database round trips (`database`, every statement and COPY, timed by `db.Cursor`) and
+# commits (`commit`, timed by `db.Connection`). `measure()` runs a task with fresh timers and attributes whatever is
+# left of its wall time to `transform`: sanitizing names, encoding rows and client-side metrics. Like the build schema
+# (see `db.py`), enabling sets an environment variable, which worker processes spawned afterwards inherit; a disabled
+# process does no timing at all.
+
+VARIABLE = 'GM_INSTRUMENT'
+CATEGORIES = ['parse', 'transform', 'database', 'commit']
+
+enabled = os.environ.get(VARIABLE) == '1'
+
+_timers = collections.Counter()
+_statements = {}
+
+
+def enable():
+    global enabled
+    os.environ[VARIABLE] = '1'
+    enabled = True
+
+
+def add(category, seconds):
+    _timers[category] += seconds
+
+
+def statement(query, seconds):
+    # Client-side time per statement, keyed by its normalized text (parameters are not part of it)
+    key = re.sub(r'\s+', ' ', query).strip()[:200]
+    calls, total = _statements.get(key, (0, 0.0))
+    _statements[key] = (calls + 1, total + seconds)
+    _timers['database'] += seconds
+
+
+@contextlib.contextmanager
+def timed(category):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add(category, time.perf_counter() - start)
+
+
+def timed_iterator(category, iterator):
+    # Attributes the time spent producing every item, but not consuming it, to `category`
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            add(category, time.perf_counter() - start)
+            return
+        add(category, time.perf_counter() - start)
+        yield item
+
+
+def reset():
+    _timers.clear()
+    _statements.clear()
+
+
+def collect(seconds):
+    # Metrics of the work since the last `reset()`, which took `seconds` of wall time
+    metrics = {'seconds': seconds}
+    for category in CATEGORIES:
+        metrics[category] = _timers[category]
+    metrics['transform'] = max(seconds - _timers['parse'] - _timers['database'] - _timers['commit'], 0.0)
+    metrics['peak_memory'] = features.peak_memory()
+    metrics['statements'] = {query: {'calls': calls, 'seconds': total} for query, (calls, total) in _statements.items()}
+    return metrics
+
+
+def measure(function, *args):
+    # Runs a task in a worker, returning its result and its metrics (see `schedule.run`)
+    reset()
+    start = time.perf_counter()
+    result = function(*args)
+    return result, collect(time.perf_counter() - start)
+
+########################################################################################################################
+# Server-Side Statements
+########################################################################################################################
+
+# `pg_stat_statements` (see `setup.sh`) adds the time the server spent on every statement, which the client-side time
+# includes along with the network and the client. Its counters are cumulative, so a run reports the difference between
+# snapshots taken before and after it, limited to the statements of the ingest user in this database. Without the
+# extension only client-side times are reported.
+
+def statement_snapshot(cur):
+    cur.execute("SELECT TO_REGCLASS('pg_stat_statements') IS NOT NULL;")
+    if not cur.fetchone()[0]:
+        return None
+    cur.execute('SELECT * FROM pg_stat_statements LIMIT 0;')
+    # Renamed in PostgreSQL 13
+    time_column = 'total_exec_time' if 'total_exec_time' in [column[0] for column in cur.description] else 'total_time'
+    cur.execute('''
+    SELECT queryid,
+           query,
+           calls,
+           {} / 1000,
+           rows
+
+      FROM pg_stat_statements
+
+     WHERE dbid = (SELECT oid FROM pg_database WHERE datname = CURRENT_DATABASE())
+       AND userid = (SELECT oid FROM pg_roles WHERE rolname = CURRENT_USER);
+    '''.format(time_column))
+    return {queryid: (query, calls, seconds, rows) for queryid, query, calls, seconds, rows in cur.fetchall()}
+
+
+def statement_difference(before, after, limit=20):
+    if before is None or after is None:
+        return None
+    statements = []
+    for queryid, (query, calls, seconds, rows) in after.items():
+        _, calls_before, seconds_before, rows_before = before.get(queryid, (None, 0, 0.0, 0))
+        if calls > calls_before:
+            statements.append({'query': re.sub(r'\s+', ' ', query).strip()[:200], 'calls': calls - calls_before,
+                               'seconds': seconds - seconds_before, 'rows': rows - rows_before})
+    return sorted(statements, key=lambda statement: -statement['seconds'])[:limit]
+
+########################################################################################################################
+# Run Report
+########################################################################################################################
+
+# Collects the wall time of every stage of an ingest, the metrics of every task and the rows and bytes of every table,
+# and writes them as a JSON report and as a Prometheus textfile (for the node exporter's textfile collector). A table's
+# throughput is its rows and bytes over the time of the tasks that loaded it; the ward files load wards, votes and
+# populations in the same tasks, so those share their time.
+
+PREFIX = 'gm_ingest'
+
+
+class Report:
+
+    def __init__(self, options, workers):
+        self.options = options
+        self.workers = workers
+        self.started = datetime.datetime.now(datetime.timezone.utc)
+        self.start = time.perf_counter()
+        self.stages = {}
+        self.tasks = {}
+        self.tables = {}
+        self.server_statements = None
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = time.perf_counter() - start
+
+    def task(self, name, metrics):
+        self.tasks[name] = metrics
+
+    def summaries(self, name, summaries):
+        for summary in summaries:
+            if 'derived' in summary:
+                continue
+            table = self.tables.setdefault(summary['table'], {'rows': 0, 'bytes': 0, 'tasks': []})
+            table['rows'] += summary['rows']
+            table['bytes'] += summary.get('bytes', 0)
+            table['tasks'].append(name)
+
+    def report(self):
+        tables = {}
+        for table, totals in self.tables.items():
+            seconds = sum(self.tasks[name]['seconds'] for name in totals['tasks'] if name in self.tasks)
+            tables[table] = {
+                'rows': totals['rows'],
+                'bytes': totals['bytes'],
+                'seconds': seconds,
+                'rows_per_second': totals['rows'] / seconds if seconds else None,
+                'bytes_per_second': totals['bytes'] / seconds if seconds else None,
+            }
+
+        client_statements = {}
+        for metrics in self.tasks.values():
+            for query, counts in metrics['statements'].items():
+                totals = client_statements.setdefault(query, {'query': query, 'calls': 0, 'seconds': 0.0})
+                totals['calls'] += counts['calls']
+                totals['seconds'] += counts['seconds']
+
+        return {
+            'started': self.started.isoformat(),
+            'seconds': time.perf_counter() - self.start,
+            'workers': self.workers,
+            'options': self.options,
+            'stages': self.stages,
+            'tables': tables,
+            'tasks': {name: {key: value for key, value in metrics.items() if key != 'statements'}
+                      for name, metrics in self.tasks.items()},
+            'statements': {
+                'client': sorted(client_statements.values(), key=lambda statement: -statement['seconds'])[:20],
+                'server': self.server_statements,
+            },
+        }
+
+    def write(self, json_path=None, textfile_path=None):
+        report = self.report()
+        if json_path:
+            write_atomically(json_path, json.dumps(report, indent=2) + '\n')
+        if textfile_path:
+            write_atomically(textfile_path, textfile(report, self.started))
+        return report
+
+
+def textfile(report, started):
+    lines = []
+
+    def metric(name, kind, description, samples):
+        lines.append('# HELP {}_{} {}'.format(PREFIX, name, description))
+        lines.append('# TYPE {}_{} {}'.format(PREFIX, name, kind))
+        for labels, value in samples:
+            if value is None:
+                continue
+            label_text = ','.join('{}="{}"'.format(key, escape(label)) for key, label in labels.items())
+            lines.append('{}_{}{} {}'.format(PREFIX, name, '{' + label_text + '}' if labels else '', repr(value)))
+
+    metric('last_run_timestamp_seconds', 'gauge', 'Start of the last instrumented ingest.',
+           [({}, started.timestamp())])
+    metric('duration_seconds', 'gauge', 'Wall time of the last instrumented ingest.', [({}, report['seconds'])])
+    metric('stage_seconds', 'gauge', 'Wall time of every ingest stage.',
+           [({'stage': stage}, seconds) for stage, seconds in report['stages'].items()])
+    metric('task_seconds', 'gauge', 'Time of every task, by what it was spent on.',
+           [({'task': task, 'category': category}, metrics[category])
+            for task, metrics in report['tasks'].items() for category in CATEGORIES])
+    metric('task_peak_rss_bytes', 'gauge', 'Peak resident memory of the worker that ran every task.',
+           [({'task': task}, metrics['peak_memory']) for task, metrics in report['tasks'].items()])
+    for name, description in [('rows', 'Rows loaded into every table.'),
+                              ('bytes', 'COPY bytes sent for every table.'),
+                              ('rows_per_second', 'Rows loaded into every table per second of its tasks.'),
+                              ('bytes_per_second', 'COPY bytes sent for every table per second of its tasks.')]:
+        metric('table_' + name, 'gauge', description,
+               [({'table': table}, totals[name]) for table, totals in report['tables'].items()])
+    metric('statement_seconds', 'gauge', 'Time of the slowest statements, measured by the client and by '
+                                         'pg_stat_statements.',
+           [({'side': side, 'query': statement['query'][:100]}, statement['seconds'])
+            for side in ['client', 'server'] for statement in report['statements'][side] or []])
+    return '\n'.join(lines) + '\n'
+
+
+def escape(label):
+    return str(label).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def write_atomically(path, text):
+    # The textfile collector may read at any time, so it must never see a half-written file
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'w') as report_file:
+        report_file.write(text)
+    os.replace(temporary_path, path)
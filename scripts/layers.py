@@ -0,0 +1,608 @@
+import re
+
+import bulk
+import db
+import features
+import incremental
+import metrics
+import partitions
+import surrogate
+
+
+def sanitize(name):
+    name = re.sub(r'[^a-zA-Z0-9]+', '_', name)
+    name = re.sub(r'(^_+|_+$)', '', name)
+    return name.lower()
+
+########################################################################################################################
+# Tables
+########################################################################################################################
+
+# In foreign-key dependency order
+TABLES = [
+    'states',
+    'counties',
+    'assemblies',
+    'senates',
+    'congressionals',
+    'wards',
+    'votes',
+    'populations',
+]
+
+TABLES_SQL = {
+    'states': '''
+CREATE TABLE IF NOT EXISTS gm.states (
+    name      VARCHAR  NOT NULL,
+
+              UNIQUE (name),
+
+    geometry  GEOMETRY NOT NULL,
+
+    area      REAL GENERATED ALWAYS AS (ST_Area(geometry, true) / 2589988.11) STORED,
+    perimeter REAL GENERATED ALWAYS AS (ST_Perimeter(geometry, true) / 1609.34) STORED,
+    npi       REAL GENERATED ALWAYS AS ((2 * SQRT(PI() * ST_Area(geometry, true))) / ST_Perimeter(geometry, true)) STORED
+);
+''',
+    'counties': '''
+CREATE TABLE IF NOT EXISTS gm.counties (
+    state     VARCHAR  NOT NULL,
+
+              FOREIGN KEY (state)
+               REFERENCES gm.states(name),
+
+    name      VARCHAR  NOT NULL,
+
+              UNIQUE (state, name),
+
+    geometry  GEOMETRY NOT NULL,
+
+    area      REAL GENERATED ALWAYS AS (ST_Area(geometry, true) / 2589988.11) STORED,
+    perimeter REAL GENERATED ALWAYS AS (ST_Perimeter(geometry, true) / 1609.34) STORED,
+    npi       REAL GENERATED ALWAYS AS ((2 * SQRT(PI() * ST_Area(geometry, true))) / ST_Perimeter(geometry, true)) STORED
+);
+''',
+    'assemblies': '''
+CREATE TABLE IF NOT EXISTS gm.assemblies (
+    state     VARCHAR  NOT NULL,
+
+              FOREIGN KEY (state)
+               REFERENCES gm.states(name),
+
+    year      CHAR(4)  NOT NULL,
+    name      VARCHAR  NOT NULL,
+
+              UNIQUE (state, year, name),
+
+    geometry  GEOMETRY NOT NULL,
+
+    area      REAL GENERATED ALWAYS AS (ST_Area(geometry, true) / 2589988.11) STORED,
+    perimeter REAL GENERATED ALWAYS AS (ST_Perimeter(geometry, true) / 1609.34) STORED,
+    npi       REAL GENERATED ALWAYS AS ((2 * SQRT(PI() * ST_Area(geometry, true))) / ST_Perimeter(geometry, true)) STORED
+);
+''',
+    'senates': '''
+CREATE TABLE IF NOT EXISTS gm.senates (
+    state     VARCHAR  NOT NULL,
+
+              FOREIGN KEY (state)
+               REFERENCES gm.states(name),
+
+    year      CHAR(4)  NOT NULL,
+    name      VARCHAR  NOT NULL,
+
+              UNIQUE (state, year, name),
+
+    geometry  GEOMETRY NOT NULL,
+
+    area      REAL GENERATED ALWAYS AS (ST_Area(geometry, true) / 2589988.11) STORED,
+    perimeter REAL GENERATED ALWAYS AS (ST_Perimeter(geometry, true) / 1609.34) STORED,
+    npi       REAL GENERATED ALWAYS AS ((2 * SQRT(PI() * ST_Area(geometry, true))) / ST_Perimeter(geometry, true)) STORED
+);
+''',
+    'congressionals': '''
+CREATE TABLE IF NOT EXISTS gm.congressionals (
+    state     VARCHAR  NOT NULL,
+
+              FOREIGN KEY (state)
+               REFERENCES gm.states(name),
+
+    year      CHAR(4)  NOT NULL,
+    name      VARCHAR  NOT NULL,
+
+              UNIQUE (state, year, name),
+
+    geometry  GEOMETRY NOT NULL,
+
+    area      REAL GENERATED ALWAYS AS (ST_Area(geometry, true) / 2589988.11) STORED,
+    perimeter REAL GENERATED ALWAYS AS (ST_Perimeter(geometry, true) / 1609.34) STORED,
+    npi       REAL GENERATED ALWAYS AS ((2 * SQRT(PI() * ST_Area(geometry, true))) / ST_Perimeter(geometry, true)) STORED
+);
+''',
+    'wards': '''
+CREATE TABLE IF NOT EXISTS gm.wards (
+    state         VARCHAR  NOT NULL,
+
+                  FOREIGN KEY (state)
+                   REFERENCES gm.states(name),
+
+    year          CHAR(4)  NOT NULL,
+    name          VARCHAR  NOT NULL,
+
+                  UNIQUE (state, year, name),
+
+    county        VARCHAR  NOT NULL,
+
+                  FOREIGN KEY (state, county)
+                   REFERENCES gm.counties(state, name),
+
+    assembly      VARCHAR  NOT NULL,
+
+                  FOREIGN KEY (state, year, assembly)
+                   REFERENCES gm.assemblies(state, year, name),
+
+    senate        VARCHAR  NOT NULL,
+
+                  FOREIGN KEY (state, year, senate)
+                   REFERENCES gm.senates(state, year, name),
+
+    congressional VARCHAR  NOT NULL,
+
+                  FOREIGN KEY (state, year, congressional)
+                   REFERENCES gm.congressionals(state, year, name),
+
+    geometry      GEOMETRY NOT NULL,
+
+    area          REAL GENERATED ALWAYS AS (ST_Area(geometry, true) / 2589988.11) STORED,
+    perimeter     REAL GENERATED ALWAYS AS (ST_Perimeter(geometry, true) / 1609.34) STORED,
+    npi           REAL GENERATED ALWAYS AS ((2 * SQRT(PI() * ST_Area(geometry, true))) / ST_Perimeter(geometry, true)) STORED
+);
+''',
+    'votes': '''
+CREATE TABLE IF NOT EXISTS gm.votes (
+    state           VARCHAR NOT NULL,
+
+                    FOREIGN KEY (state)
+                     REFERENCES gm.states(name),
+
+    race            VARCHAR NOT NULL,
+    year            CHAR(4) NOT NULL,
+    ward_year       CHAR(4) NOT NULL,
+    ward            VARCHAR NOT NULL,
+
+                    UNIQUE (state, race, year, ward_year, ward),
+
+                    FOREIGN KEY (state, ward_year, ward)
+                     REFERENCES gm.wards(state, year, name),
+
+    total           INTEGER NOT NULL,
+    democrat        INTEGER NOT NULL,
+    republican      INTEGER NOT NULL,
+
+    competitiveness REAL GENERATED ALWAYS AS (CASE
+                                                WHEN democrat + republican > 0
+                                                  THEN ((democrat::REAL / (democrat + republican)) - 0.5) / 0.5
+                                                ELSE 0
+                                              END) STORED
+);
+''',
+    'populations': '''
+CREATE TABLE IF NOT EXISTS gm.populations (
+    state            VARCHAR NOT NULL,
+
+                     FOREIGN KEY (state)
+                      REFERENCES gm.states(name),
+
+    year             CHAR(4) NOT NULL,
+    ward_year        CHAR(4) NOT NULL,
+    ward             VARCHAR NOT NULL,
+
+                     UNIQUE (state, year, ward_year, ward),
+
+                     FOREIGN KEY (state, ward_year, ward)
+                      REFERENCES gm.wards(state, year, name),
+
+    total            INTEGER NOT NULL,
+    white            INTEGER NOT NULL,
+    black            INTEGER NOT NULL,
+    american_indian  INTEGER NOT NULL,
+    asian            INTEGER NOT NULL,
+    pacific_islander INTEGER NOT NULL,
+    hispanic         INTEGER NOT NULL
+);
+''',
+}
+
+INDEXES_SQL = {
+    'states': [
+        'CREATE INDEX IF NOT EXISTS states_geometry_idx ON gm.states USING GIST (geometry);',
+    ],
+    'counties': [
+        'CREATE INDEX IF NOT EXISTS counties_state_fkey ON gm.counties(state);',
+        'CREATE INDEX IF NOT EXISTS counties_geometry_idx ON gm.counties USING GIST (geometry);',
+    ],
+    'assemblies': [
+        'CREATE INDEX IF NOT EXISTS assemblies_state_fkey ON gm.assemblies(state);',
+        'CREATE INDEX IF NOT EXISTS assemblies_geometry_idx ON gm.assemblies USING GIST (geometry);',
+    ],
+    'senates': [
+        'CREATE INDEX IF NOT EXISTS senates_state_fkey ON gm.senates(state);',
+        'CREATE INDEX IF NOT EXISTS senates_geometry_idx ON gm.senates USING GIST (geometry);',
+    ],
+    'congressionals': [
+        'CREATE INDEX IF NOT EXISTS congressionals_state_fkey ON gm.congressionals(state);',
+        'CREATE INDEX IF NOT EXISTS congressionals_geometry_idx ON gm.congressionals USING GIST (geometry);',
+    ],
+    'wards': [
+        'CREATE INDEX IF NOT EXISTS wards_state_fkey ON gm.wards(state);',
+        'CREATE INDEX IF NOT EXISTS wards_state_county_fkey ON gm.wards(state, county);',
+        'CREATE INDEX IF NOT EXISTS wards_state_year_assembly_fkey ON gm.wards(state, year, assembly);',
+        'CREATE INDEX IF NOT EXISTS wards_state_year_senate_fkey ON gm.wards(state, year, senate);',
+        'CREATE INDEX IF NOT EXISTS wards_state_year_congressional_fkey ON gm.wards(state, year, congressional);',
+        'CREATE INDEX IF NOT EXISTS wards_geometry_idx ON gm.wards USING GIST (geometry);',
+    ],
+    'votes': [
+        'CREATE INDEX IF NOT EXISTS votes_state_fkey ON gm.votes(state);',
+        'CREATE INDEX IF NOT EXISTS votes_state_ward_year_ward_fkey ON gm.votes(state, ward_year, ward);',
+    ],
+    'populations': [
+        'CREATE INDEX IF NOT EXISTS populations_state_fkey ON gm.populations(state);',
+        'CREATE INDEX IF NOT EXISTS populations_state_ward_year_ward_fkey ON gm.populations(state, ward_year, ward);',
+    ],
+}
+
+COLUMNS = {
+    'states': [
+        ('name', 'text'),
+        ('geometry', 'geometry'),
+    ],
+    'counties': [
+        ('state', 'text'),
+        ('name', 'text'),
+        ('geometry', 'geometry'),
+    ],
+    'assemblies': [
+        ('state', 'text'),
+        ('year', 'text'),
+        ('name', 'text'),
+        ('geometry', 'geometry'),
+    ],
+    'senates': [
+        ('state', 'text'),
+        ('year', 'text'),
+        ('name', 'text'),
+        ('geometry', 'geometry'),
+    ],
+    'congressionals': [
+        ('state', 'text'),
+        ('year', 'text'),
+        ('name', 'text'),
+        ('geometry', 'geometry'),
+    ],
+    'wards': [
+        ('state', 'text'),
+        ('year', 'text'),
+        ('name', 'text'),
+        ('county', 'text'),
+        ('assembly', 'text'),
+        ('senate', 'text'),
+        ('congressional', 'text'),
+        ('geometry', 'geometry'),
+    ],
+    'votes': [
+        ('state', 'text'),
+        ('race', 'text'),
+        ('year', 'text'),
+        ('ward_year', 'text'),
+        ('ward', 'text'),
+        ('total', 'integer'),
+        ('democrat', 'integer'),
+        ('republican', 'integer'),
+    ],
+    'populations': [
+        ('state', 'text'),
+        ('year', 'text'),
+        ('ward_year', 'text'),
+        ('ward', 'text'),
+        ('total', 'integer'),
+        ('white', 'integer'),
+        ('black', 'integer'),
+        ('american_indian', 'integer'),
+        ('asian', 'integer'),
+        ('pacific_islander', 'integer'),
+        ('hispanic', 'integer'),
+    ],
+}
+
+GEOMETRY_TABLES = ['states', 'counties', 'assemblies', 'senates', 'congressionals', 'wards']
+
+# With `client_metrics` the geometry tables store `area`, `perimeter` and `npi` as plain columns computed during ingest
+# by `metrics.MetricsWriter` instead of as columns generated by PostGIS on insert
+METRIC_COLUMNS = [
+    ('area', 'real'),
+    ('perimeter', 'real'),
+    ('npi', 'real'),
+]
+
+# The unique key of every table, used for upserts and the ingest manifest
+KEYS = {
+    'states': ['name'],
+    'counties': ['state', 'name'],
+    'assemblies': ['state', 'year', 'name'],
+    'senates': ['state', 'year', 'name'],
+    'congressionals': ['state', 'year', 'name'],
+    'wards': ['state', 'year', 'name'],
+    'votes': ['state', 'race', 'year', 'ward_year', 'ward'],
+    'populations': ['state', 'year', 'ward_year', 'ward'],
+}
+
+
+def table_sql(table, client_metrics, partitioned=False):
+    if partitioned and table in partitions.TABLES:
+        return partitions.partition_sql(TABLES_SQL[table])
+    if not client_metrics:
+        return TABLES_SQL[table]
+    return re.sub(r'^(\s*(?:area|perimeter|npi)\s+)REAL GENERATED ALWAYS AS .* STORED', r'\1REAL', TABLES_SQL[table],
+                  flags=re.MULTILINE)
+
+
+def create_tables(cur, drop, client_metrics=False, surrogate_keys=False, partitioned=False):
+    if not drop and surrogate.relation_kind(cur, 'votes') not in [None, 'VIEW' if surrogate_keys else 'BASE TABLE']:
+        raise ValueError('gm.votes was {}created with surrogate keys; switching requires a full ingest'.format(
+            'not ' if surrogate_keys else ''))
+    if not drop and surrogate.relation_kind(cur, 'votes') and partitions.is_partitioned(cur, 'votes') != partitioned:
+        raise ValueError('gm.votes was {}created partitioned; switching requires a full ingest'.format(
+            'not ' if partitioned else ''))
+    if drop:
+        # `gm.votes` and `gm.populations` are views in surrogate key mode (see `surrogate.py`)
+        for table in reversed(TABLES):
+            surrogate.drop_relation(cur, table)
+        surrogate.drop_tables(cur)
+    for table in TABLES:
+        if not (surrogate_keys and table in surrogate.FACT_TABLES):
+            cur.execute(table_sql(table, client_metrics, partitioned))
+    if surrogate_keys:
+        surrogate.create_tables(cur, drop=False)
+
+
+def create_indexes(table, surrogate_keys=False):
+    conn = db.connection()
+    with conn.cursor() as cur:
+        if surrogate_keys and table in surrogate.FACT_TABLES:
+            queries = surrogate.INDEXES_SQL[table]
+        else:
+            queries = INDEXES_SQL[table]
+        for query in queries:
+            cur.execute(query)
+    conn.commit()
+    return []
+
+########################################################################################################################
+# Writers
+########################################################################################################################
+
+# `options` carries the command line flags that affect loading: `incremental`, `insert`, `batch_size`,
+# `client_metrics`, `surrogate_keys`, `partitioned` and `pipeline_depth`. Loaders close their cursor before committing,
+# which waits for the batches a pipelined cursor (see `bulk.Pipeline`) still has queued.
+
+def cursor(conn, options):
+    if options['pipeline_depth']:
+        return bulk.Pipeline(conn.cursor(), depth=options['pipeline_depth'])
+    return conn.cursor()
+
+
+def writer(cur, manifest, options, table, parents=()):
+    client_metrics = options['client_metrics'] and table in GEOMETRY_TABLES
+    columns = COLUMNS[table] + METRIC_COLUMNS if client_metrics else COLUMNS[table]
+    if options['surrogate_keys'] and table in surrogate.FACT_TABLES:
+        table_writer = surrogate.FactWriter(cur, table, columns, batch_size=options['batch_size'], parents=parents)
+    elif options['incremental']:
+        # Partitioned tables are upserted through their parent (see `partitions.py`)
+        table_writer = incremental.IncrementalWriter(cur, manifest, 'gm.' + table, columns, KEYS[table],
+                                                     batch_size=options['batch_size'], parents=parents)
+    elif options['partitioned'] and table in partitions.TABLES:
+        table_writer = partitions.PartitionWriter(cur, table, columns, batch_size=options['batch_size'],
+                                                  parents=parents)
+    elif options['insert']:
+        table_writer = bulk.InsertWriter(cur, 'gm.' + table, columns, parents=parents)
+    else:
+        table_writer = bulk.CopyWriter(cur, 'gm.' + table, columns, batch_size=options['batch_size'], parents=parents)
+    if client_metrics:
+        return metrics.MetricsWriter(table_writer, batch_size=options['batch_size'])
+    return table_writer
+
+
+def summarize(writer, table):
+    return {
+        'table': table,
+        'rows': writer.total_rows,
+        'bytes': getattr(writer, 'total_bytes', 0),
+        'inserted': getattr(writer, 'inserted', writer.total_rows),
+        'updated': getattr(writer, 'updated', 0),
+        'unchanged': getattr(writer, 'unchanged', 0),
+        'changed': getattr(writer, 'changed', []),
+        'deleted': getattr(writer, 'deleted', []),
+        'unwritten': getattr(writer, 'unwritten', []),
+        'peak_memory': features.peak_memory(),
+    }
+
+########################################################################################################################
+# Load States
+########################################################################################################################
+
+def load_states(options, states_meta):
+    conn = db.connection()
+    cur = cursor(conn, options)
+    manifest = incremental.Manifest(cur)
+
+    states = writer(cur, manifest, options, 'states')
+
+    for state_meta in states_meta:
+        if not states.begin(state_meta['geojson']):
+            continue
+        for feature in features.read_features(state_meta['geojson']):
+            state = (
+                sanitize(feature['properties'][state_meta['name_property']]),
+                feature['geometry'],
+            )
+            states.write(state)
+
+    states.close()
+    cur.close()
+    conn.commit()
+
+    return [summarize(states, 'states')]
+
+########################################################################################################################
+# Load Counties
+########################################################################################################################
+
+def load_counties(options, counties_meta):
+    conn = db.connection()
+    cur = cursor(conn, options)
+    manifest = incremental.Manifest(cur)
+
+    counties = writer(cur, manifest, options, 'counties')
+
+    for county_meta in counties_meta:
+        if not counties.begin(county_meta['geojson']):
+            continue
+        for feature in features.read_features(county_meta['geojson']):
+            county = (
+                county_meta['state'],
+                sanitize(feature['properties'][county_meta['name_property']]),
+                feature['geometry'],
+            )
+            counties.write(county)
+
+    counties.close()
+    cur.close()
+    conn.commit()
+
+    return [summarize(counties, 'counties')]
+
+########################################################################################################################
+# Load Assembly, Senate and Congressional Districts
+########################################################################################################################
+
+def load_districts(options, table, districts_meta):
+    conn = db.connection()
+    cur = cursor(conn, options)
+    manifest = incremental.Manifest(cur)
+
+    districts = writer(cur, manifest, options, table)
+
+    for district_meta in districts_meta:
+        if not districts.begin(district_meta['geojson']):
+            continue
+        for feature in features.read_features(district_meta['geojson']):
+            district = (
+                district_meta['state'],
+                district_meta['year'],
+                sanitize(feature['properties'][district_meta['name_property']]),
+                feature['geometry'],
+            )
+            districts.write(district)
+
+    districts.close()
+    cur.close()
+    conn.commit()
+
+    return [summarize(districts, table)]
+
+########################################################################################################################
+# Load Wards, Votes and Populations
+########################################################################################################################
+
+# Wards, votes and populations usually come from the same GeoJSON file, so each distinct file is read exactly once and
+# every feature is fanned out to all of the writers that consume it. The `county_label` ward key is computed once per
+# feature (per distinct pair of county/ward properties) and shared by every writer.
+
+def write_ward(wards, feature, ward_meta, county, name):
+    ward = (
+        ward_meta['state'],
+        ward_meta['year'],
+        name,
+        county,
+        sanitize(feature['properties'][ward_meta['assembly_property']]),
+        sanitize(feature['properties'][ward_meta['senate_property']]),
+        sanitize(feature['properties'][ward_meta['congressional_property']]),
+        feature['geometry'],
+    )
+    wards.write(ward)
+
+
+def write_votes(votes, feature, vote_meta, county, ward):
+    for race, years in vote_meta['races'].items():
+        for year in years:
+            vote = (
+                vote_meta['state'],
+                race,
+                year['year'],
+                vote_meta['ward_year'],
+                ward,
+                feature['properties'][year['total_property']],
+                feature['properties'][year['democrat_property']],
+                feature['properties'][year['republican_property']],
+            )
+            votes.write(vote)
+
+
+def write_population(populations, feature, population_meta, county, ward):
+    population = (
+        population_meta['state'],
+        population_meta['year'],
+        population_meta['ward_year'],
+        ward,
+        feature['properties'][population_meta['total_property']],
+        feature['properties'][population_meta['white_property']],
+        feature['properties'][population_meta['black_property']],
+        feature['properties'][population_meta['american_indian_property']],
+        feature['properties'][population_meta['asian_property']],
+        feature['properties'][population_meta['pacific_islander_property']],
+        feature['properties'][population_meta['hispanic_property']],
+    )
+    populations.write(population)
+
+
+def load_wards(options, geojson, wards_meta, votes_meta, populations_meta):
+    conn = db.connection()
+    cur = cursor(conn, options)
+    manifest = incremental.Manifest(cur)
+
+    wards = writer(cur, manifest, options, 'wards')
+    votes = writer(cur, manifest, options, 'votes', parents=[wards])
+    populations = writer(cur, manifest, options, 'populations', parents=[wards])
+
+    consumers = []
+    consumers.extend((wards, write_ward, ward_meta, ward_meta['county_property'], ward_meta['name_property'])
+                     for ward_meta in wards_meta)
+    consumers.extend((votes, write_votes, vote_meta, vote_meta['county_property'], vote_meta['ward_property'])
+                     for vote_meta in votes_meta)
+    consumers.extend((populations, write_population, population_meta, population_meta['county_property'],
+                      population_meta['ward_property']) for population_meta in populations_meta)
+    consumers = [consumer for consumer in consumers if consumer[0].begin(geojson)]
+
+    if consumers:
+        for feature in features.read_features(geojson):
+            keys = {}
+            for table, write, meta, county_property, ward_property in consumers:
+                if (county_property, ward_property) not in keys:
+                    county = sanitize(feature['properties'][county_property])
+                    keys[(county_property, ward_property)] = (
+                        county,
+                        county + '_' + sanitize(feature['properties'][ward_property]),
+                    )
+                write(table, feature, meta, *keys[(county_property, ward_property)])
+
+    summaries = []
+    for table, name, metas in [(wards, 'wards', wards_meta), (votes, 'votes', votes_meta),
+                               (populations, 'populations', populations_meta)]:
+        table.close()
+        if metas:
+            summaries.append(summarize(table, name))
+
+    cur.close()
+    conn.commit()
+
+    return summaries
@@ -0,0 +1,257 @@
+import argparse
+import csv
+import datetime
+import json
+import os
+import shutil
+import sys
+import time
+
+import numpy as np
+
+import db
+import snapshot
+import spatial
+
+########################################################################################################################
+# Layout
+########################################################################################################################
+
+# Every ward vintage of a state is indexed in `<directory>/<state>-<year>/<version>/` as one `.npy` file per array plus
+# a `manifest.json`, so lookups open it with `np.load(..., mmap_mode='r')` and processes share its pages:
+#
+# - `tree_*`: the packed STR-tree over the ward bounding boxes (see `spatial.STRtree.arrays()`)
+# - `edge_*`: the banded ring edges of every ward for the point-in-polygon test (see `spatial.EdgeIndex.arrays()`)
+# - `names`: the ward names, sorted by name like the snapshots (see `snapshot.py`)
+# - `county`, `assembly`, `senate`, `congressional`: int32 codes into the sorted labels listed in the manifest
+#
+# Like the snapshots, a rebuild writes a new version and atomically replaces `CURRENT`, so a reader never sees a
+# half-written index, and older versions are pruned.
+
+FORMAT = 1
+
+
+def load(directory, state, year):
+    path = snapshot.vintage_directory(directory, state, year)
+    with open(os.path.join(path, 'CURRENT'), 'r') as current_file:
+        path = os.path.join(path, current_file.read().strip())
+    with open(os.path.join(path, 'manifest.json'), 'r') as manifest_file:
+        manifest = json.load(manifest_file)
+    if manifest['format'] != FORMAT:
+        raise ValueError('Unsupported lookup index format {} in {}'.format(manifest['format'], path))
+    return WardIndex(manifest, {name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+                                for name in manifest['columns']})
+
+
+def write_vintage(directory, state, year, wards, keep=2):
+    # `wards` are (name, county, assembly, senate, congressional, geometry) rows sorted by name
+    geometries = [row[5] for row in wards]
+    columns = {'names': np.asarray([row[0] for row in wards], dtype=str)}
+    labels = {}
+    for position, column in enumerate(snapshot.DISTRICT_COLUMNS, start=1):
+        labels[column], codes = np.unique(np.asarray([row[position] for row in wards], dtype=str), return_inverse=True)
+        columns[column] = codes.reshape(-1).astype(np.int32)
+    edges = spatial.EdgeIndex(geometries)
+    columns.update(edges.arrays())
+    columns.update(spatial.STRtree(edges.boxes).arrays())
+
+    path = snapshot.vintage_directory(directory, state, year)
+    os.makedirs(path, exist_ok=True)
+    versions = sorted(int(name) for name in os.listdir(path) if name.isdigit())
+    version = '{:06d}'.format(versions[-1] + 1 if versions else 1)
+    os.makedirs(os.path.join(path, version))
+    for name, values in columns.items():
+        np.save(os.path.join(path, version, name + '.npy'), values)
+    with open(os.path.join(path, version, 'manifest.json'), 'w') as manifest_file:
+        json.dump({
+            'format': FORMAT,
+            'state': state,
+            'year': year,
+            'version': version,
+            'created': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'wards': len(wards),
+            'labels': {column: [str(label) for label in values] for column, values in labels.items()},
+            'columns': {name: np.asarray(values).dtype.str for name, values in columns.items()},
+        }, manifest_file, indent=2)
+
+    with open(os.path.join(path, 'CURRENT.tmp'), 'w') as current_file:
+        current_file.write(version)
+    os.replace(os.path.join(path, 'CURRENT.tmp'), os.path.join(path, 'CURRENT'))
+    for old in versions[:max(len(versions) + 1 - keep, 0)]:
+        shutil.rmtree(os.path.join(path, '{:06d}'.format(old)))
+    return version
+
+########################################################################################################################
+# Lookups
+########################################################################################################################
+
+# `locate()` resolves a whole array of (longitude, latitude) points at once: the STR-tree yields the wards whose boxes
+# hold every point, and the even-odd test against those wards' edges keeps the ones that contain it. A point on the
+# boundary between two wards is assigned to the first of them by name; a point outside every ward gets -1. Counties and
+# districts are then a gather of the ward's codes, with no further geometry.
+
+
+class WardIndex:
+
+    def __init__(self, manifest, arrays):
+        self.manifest = manifest
+        self.arrays = arrays
+        self.tree = spatial.STRtree.from_arrays(arrays)
+        self.edges = spatial.EdgeIndex.from_arrays(arrays)
+        self.names = arrays['names']
+        self.labels = {column: np.asarray(labels, dtype=str) for column, labels in manifest['labels'].items()}
+
+    def bounds(self):
+        boxes = self.edges.boxes
+        if len(boxes) == 0:
+            return np.array(spatial.EMPTY)
+        return np.concatenate([boxes[:, :2].min(axis=0), boxes[:, 2:].max(axis=0)])
+
+    def locate(self, points):
+        # Position of the ward containing every point, or -1
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        wards = np.full(len(points), -1, dtype=np.int64)
+        queries, candidates = self.tree.query_points(points)
+        hits = self.edges.contains(points[queries], candidates)
+        queries, candidates = queries[hits], candidates[hits]
+        order = np.lexsort((candidates, queries))
+        located, first = np.unique(queries[order], return_index=True)
+        wards[located] = candidates[order][first]
+        return wards
+
+    def resolve(self, wards):
+        # Ward name and county and district labels of every ward position, '' for -1
+        if len(self.names) == 0:
+            return {column: np.full(len(wards), '') for column in ['ward'] + snapshot.DISTRICT_COLUMNS}
+        found = wards >= 0
+        positions = np.maximum(wards, 0)
+        resolved = {'ward': np.where(found, self.names[positions], '')}
+        for column in snapshot.DISTRICT_COLUMNS:
+            resolved[column] = np.where(found, self.labels[column][self.arrays[column][positions]], '')
+        return resolved
+
+
+def locate(indexes, points):
+    # Locates the points in the first of `indexes` (e.g. one per state) that has a ward containing them, returning the
+    # position of that index and of the ward in it, or -1 for both
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    index_ids = np.full(len(points), -1, dtype=np.int64)
+    wards = np.full(len(points), -1, dtype=np.int64)
+    for index_id, index in enumerate(indexes):
+        box = index.bounds()
+        pending = np.flatnonzero((index_ids < 0) & (points[:, 0] >= box[0]) & (points[:, 0] <= box[2]) &
+                                 (points[:, 1] >= box[1]) & (points[:, 1] <= box[3]))
+        if len(pending) == 0:
+            continue
+        located = index.locate(points[pending])
+        found = located >= 0
+        index_ids[pending[found]] = index_id
+        wards[pending[found]] = located[found]
+    return index_ids, wards
+
+########################################################################################################################
+# Lookup Stage
+########################################################################################################################
+
+# Rebuilds the index of every ward vintage of a state whose wards changed (see `adjacency.states()`); vintages that no
+# longer have any wards are removed.
+
+def build_state(state, directory):
+    conn = db.connection()
+    with conn.cursor() as cur:
+        cur.execute('''
+        SELECT year,
+               name,
+               county,
+               assembly,
+               senate,
+               congressional,
+               ST_AsGeoJSON(geometry)
+
+          FROM gm.wards
+
+         WHERE state = %s
+
+         ORDER BY year,
+                  name;
+        ''', (state,))
+        years = {}
+        for year, *row, geometry in cur.fetchall():
+            years.setdefault(year, []).append(tuple(row) + (json.loads(geometry),))
+    conn.commit()
+
+    if os.path.isdir(directory):
+        for name in os.listdir(directory):
+            year = name[len(state) + 1:]
+            if name.startswith(state + '-') and year.isdigit() and year not in years:
+                shutil.rmtree(os.path.join(directory, name))
+
+    written = []
+    for year, wards in years.items():
+        version = write_vintage(directory, state, year, wards)
+        written.append('{} v{} ({} wards)'.format(year, int(version), len(wards)))
+    return [{'table': 'lookup', 'path': directory, 'derived': ', '.join(written) or 'no wards'}]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Locate the ward, county and districts of every (longitude, '
+                                                 'latitude) point of a CSV file with the ward indexes built by '
+                                                 'ingest, or time the lookup of random points.')
+    parser.add_argument('points', nargs='?', help='CSV file with a header and longitude and latitude columns')
+    parser.add_argument('--year', required=True, help='ward vintage, e.g. 2011')
+    parser.add_argument('--states', nargs='*', help='states to search (default: every indexed state)')
+    parser.add_argument('--longitude', default='longitude', help='longitude column (default: longitude)')
+    parser.add_argument('--latitude', default='latitude', help='latitude column (default: latitude)')
+    parser.add_argument('--directory', default='lookup', help='directory of the indexes (default: lookup)')
+    parser.add_argument('--output', help='CSV file of the input rows with the located ward, state, county and '
+                                         'districts appended (default: standard output)')
+    parser.add_argument('--random', type=int, metavar='COUNT',
+                        help='instead of reading points, locate COUNT uniformly random points within the bounds of '
+                             'the indexed wards and only report the throughput')
+    args = parser.parse_args()
+    if args.points is None and args.random is None:
+        parser.error('either a points file or --random is required')
+
+    states = args.states or sorted(name[:-len(args.year) - 1] for name in os.listdir(args.directory)
+                                   if name.endswith('-' + args.year))
+    indexes = [load(args.directory, state, args.year) for state in states]
+
+    if args.random:
+        boxes = np.array([index.bounds() for index in indexes])
+        low, high = boxes[:, :2].min(axis=0), boxes[:, 2:].max(axis=0)
+        points = np.random.default_rng(0).uniform(low, high, (args.random, 2))
+        rows = None
+    else:
+        with open(args.points, 'r', newline='') as points_file:
+            reader = csv.reader(points_file)
+            header = next(reader)
+            rows = list(reader)
+        columns = [header.index(args.longitude), header.index(args.latitude)]
+        points = np.array([[float(row[column]) for column in columns] for row in rows]).reshape(-1, 2)
+
+    start = time.perf_counter()
+    index_ids, wards = locate(indexes, points)
+    seconds = time.perf_counter() - start
+    print('{} points in {:.2f} s ({:,.0f} points/s), {} located'.format(
+        len(points), seconds, len(points) / seconds if seconds else 0, int(np.sum(wards >= 0))), file=sys.stderr)
+    if rows is None:
+        return
+
+    columns = ['ward'] + snapshot.DISTRICT_COLUMNS
+    resolved = {column: np.full(len(rows), '', dtype=object) for column in columns}
+    for index_id, index in enumerate(indexes):
+        selected = index_ids == index_id
+        for column, values in index.resolve(wards[selected]).items():
+            resolved[column][selected] = values
+    output_file = open(args.output, 'w', newline='') if args.output else sys.stdout
+    writer = csv.writer(output_file)
+    writer.writerow(header + ['state'] + columns)
+    state_names = np.array([''] + states)[index_ids + 1]
+    for position, row in enumerate(rows):
+        writer.writerow(row + [state_names[position]] + [resolved[column][position] for column in columns])
+    if args.output:
+        output_file.close()
+
+
+if __name__ == '__main__':
+    main()
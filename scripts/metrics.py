@@ -0,0 +1,272 @@
+import argparse
+
+import numpy as np
+
+import db
+
+########################################################################################################################
+# WGS 84
+########################################################################################################################
+
+A = 6378137.0
+F = 1 / 298.257223563
+B = A * (1 - F)
+E2 = F * (2 - F)
+E = np.sqrt(E2)
+
+SQUARE_METERS_PER_SQUARE_MILE = 2589988.11
+METERS_PER_MILE = 1609.34
+
+########################################################################################################################
+# Coordinate Arrays
+########################################################################################################################
+
+# Flattens a batch of GeoJSON (Multi)Polygons into one array of vertices. `edge_ring` maps every edge (vertex i to
+# vertex i + 1 of the same ring) to its ring, `ring_geometry` maps every ring to its geometry and `ring_sign` is +1 for
+# exterior rings and -1 for holes.
+
+def flatten(geometries):
+    coordinates = []
+    edge_ring = []
+    ring_geometry = []
+    ring_sign = []
+    for index, geometry in enumerate(geometries):
+        if geometry['type'] == 'Polygon':
+            polygons = [geometry['coordinates']]
+        elif geometry['type'] == 'MultiPolygon':
+            polygons = geometry['coordinates']
+        else:
+            raise ValueError('Geometry type \'{}\' has no area'.format(geometry['type']))
+        for polygon in polygons:
+            for position, ring in enumerate(polygon):
+                ring_array = np.asarray(ring, dtype=np.float64)[:, :2]
+                coordinates.append(ring_array)
+                # The last vertex of a GeoJSON ring repeats the first, so a ring of n vertices has n - 1 edges
+                edge_ring.append(np.full(len(ring_array), len(ring_geometry), dtype=np.int64))
+                edge_ring[-1][-1] = -1
+                ring_geometry.append(index)
+                ring_sign.append(1.0 if position == 0 else -1.0)
+    if not coordinates:
+        empty = np.empty(0)
+        return empty.reshape(0, 2), empty.astype(np.int64), empty.astype(np.int64), empty
+    return (np.concatenate(coordinates), np.concatenate(edge_ring), np.asarray(ring_geometry, dtype=np.int64),
+            np.asarray(ring_sign))
+
+########################################################################################################################
+# Geodesic Length
+########################################################################################################################
+
+# Vincenty's inverse formula evaluated for every edge at once. Edges that have converged are masked out of further
+# iterations; nearly antipodal edges (which do not occur in ward or district rings) keep their last estimate.
+
+def geodesic_lengths(lon1, lat1, lon2, lat2, iterations=20, tolerance=1e-12):
+    L = np.radians(lon2 - lon1)
+    U1 = np.arctan((1 - F) * np.tan(np.radians(lat1)))
+    U2 = np.arctan((1 - F) * np.tan(np.radians(lat2)))
+    sin_U1, cos_U1 = np.sin(U1), np.cos(U1)
+    sin_U2, cos_U2 = np.sin(U2), np.cos(U2)
+
+    lam = L.copy()
+    sin_sigma = np.zeros_like(L)
+    cos_sigma = np.ones_like(L)
+    sigma = np.zeros_like(L)
+    cos2_alpha = np.ones_like(L)
+    cos_2sigma_m = np.zeros_like(L)
+    active = np.ones(L.shape, dtype=bool)
+
+    for _ in range(iterations):
+        sin_lam, cos_lam = np.sin(lam[active]), np.cos(lam[active])
+        s_U1, c_U1, s_U2, c_U2 = sin_U1[active], cos_U1[active], sin_U2[active], cos_U2[active]
+
+        s_sigma = np.hypot(c_U2 * sin_lam, c_U1 * s_U2 - s_U1 * c_U2 * cos_lam)
+        c_sigma = s_U1 * s_U2 + c_U1 * c_U2 * cos_lam
+        sig = np.arctan2(s_sigma, c_sigma)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            sin_alpha = np.where(s_sigma == 0, 0.0, c_U1 * c_U2 * sin_lam / s_sigma)
+            c2_alpha = 1 - sin_alpha ** 2
+            c_2sigma_m = np.where(c2_alpha == 0, 0.0, c_sigma - 2 * s_U1 * s_U2 / c2_alpha)
+        C = F / 16 * c2_alpha * (4 + F * (4 - 3 * c2_alpha))
+        previous = lam[active]
+        updated = L[active] + (1 - C) * F * sin_alpha * (
+            sig + C * s_sigma * (c_2sigma_m + C * c_sigma * (-1 + 2 * c_2sigma_m ** 2)))
+
+        lam[active] = updated
+        sin_sigma[active] = s_sigma
+        cos_sigma[active] = c_sigma
+        sigma[active] = sig
+        cos2_alpha[active] = c2_alpha
+        cos_2sigma_m[active] = c_2sigma_m
+
+        indexes = np.flatnonzero(active)
+        active[indexes[np.abs(updated - previous) < tolerance]] = False
+        if not active.any():
+            break
+
+    u2 = cos2_alpha * (A ** 2 - B ** 2) / B ** 2
+    k1 = (np.sqrt(1 + u2) - 1) / (np.sqrt(1 + u2) + 1)
+    big_a = (1 + k1 ** 2 / 4) / (1 - k1)
+    big_b = k1 * (1 - 3 / 8 * k1 ** 2)
+    delta_sigma = big_b * sin_sigma * (cos_2sigma_m + big_b / 4 * (
+        cos_sigma * (-1 + 2 * cos_2sigma_m ** 2)
+        - big_b / 6 * cos_2sigma_m * (-3 + 4 * sin_sigma ** 2) * (-3 + 4 * cos_2sigma_m ** 2)))
+    return B * big_a * (sigma - delta_sigma)
+
+########################################################################################################################
+# Ellipsoidal Area
+########################################################################################################################
+
+# Rings are mapped to authalic latitude (which preserves area between the ellipsoid and a sphere of radius R_q) and
+# measured with the spherical-excess formula for each edge, summed per ring.
+
+Q_P = (1 - E2) * (1 / (1 - E2) - 1 / (2 * E) * np.log((1 - E) / (1 + E)))
+R_Q = A * np.sqrt(Q_P / 2)
+
+
+def authalic_latitudes(lat):
+    sin_lat = np.sin(np.radians(lat))
+    q = (1 - E2) * (sin_lat / (1 - E2 * sin_lat ** 2) - 1 / (2 * E) * np.log((1 - E * sin_lat) / (1 + E * sin_lat)))
+    return np.arcsin(np.clip(q / Q_P, -1, 1))
+
+
+def spherical_excesses(lon1, beta1, lon2, beta2):
+    d_lon = np.radians(lon2 - lon1)
+    d_lon = (d_lon + np.pi) % (2 * np.pi) - np.pi
+    t1 = np.tan(beta1 / 2)
+    t2 = np.tan(beta2 / 2)
+    return 2 * np.arctan2(np.tan(d_lon / 2) * (t1 + t2), 1 + t1 * t2)
+
+########################################################################################################################
+# Metrics
+########################################################################################################################
+
+# Returns square miles, miles and the normalized perimeter index (2 * sqrt(pi * area) / perimeter, the square root of
+# Polsby-Popper) for every geometry, matching the `area`, `perimeter` and `npi` columns that PostGIS generates with
+# `ST_Area(geometry, true)` and `ST_Perimeter(geometry, true)`.
+
+def geodesic_metrics(geometries):
+    count = len(geometries)
+    coordinates, edge_ring, ring_geometry, ring_sign = flatten(geometries)
+    if len(coordinates) == 0:
+        return np.zeros(count), np.zeros(count), np.zeros(count)
+
+    edges = np.flatnonzero(edge_ring >= 0)
+    rings = edge_ring[edges]
+    lon1, lat1 = coordinates[edges, 0], coordinates[edges, 1]
+    lon2, lat2 = coordinates[edges + 1, 0], coordinates[edges + 1, 1]
+
+    lengths = geodesic_lengths(lon1, lat1, lon2, lat2)
+    ring_lengths = np.bincount(rings, weights=lengths, minlength=len(ring_geometry))
+
+    beta = authalic_latitudes(coordinates[:, 1])
+    excesses = spherical_excesses(lon1, beta[edges], lon2, beta[edges + 1])
+    ring_areas = np.abs(np.bincount(rings, weights=excesses, minlength=len(ring_geometry))) * R_Q ** 2
+
+    area = np.bincount(ring_geometry, weights=ring_sign * ring_areas, minlength=count)
+    perimeter = np.bincount(ring_geometry, weights=ring_lengths, minlength=count)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        npi = np.where(perimeter > 0, 2 * np.sqrt(np.pi * area) / perimeter, 0.0)
+
+    return area / SQUARE_METERS_PER_SQUARE_MILE, perimeter / METERS_PER_MILE, npi
+
+########################################################################################################################
+# Metrics Writer
+########################################################################################################################
+
+# Wraps any writer of a geometry table whose `area`, `perimeter` and `npi` columns are plain columns rather than
+# generated ones. Rows are buffered, their metrics are computed for the whole batch in one vectorized pass and the rows
+# are passed on with the three values appended.
+
+
+class MetricsWriter:
+
+    def __init__(self, writer, batch_size=10000, geometry_index=-1):
+        self.writer = writer
+        self.batch_size = batch_size
+        self.geometry_index = geometry_index
+        self.rows = []
+
+    def __getattr__(self, name):
+        return getattr(self.writer, name)
+
+    def begin(self, source):
+        return self.writer.begin(source)
+
+    def write(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            area, perimeter, npi = geodesic_metrics([row[self.geometry_index] for row in self.rows])
+            for row, row_area, row_perimeter, row_npi in zip(self.rows, area, perimeter, npi):
+                self.writer.write(tuple(row) + (float(row_area), float(row_perimeter), float(row_npi)))
+            self.rows = []
+        self.writer.flush()
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+########################################################################################################################
+# Parity Report
+########################################################################################################################
+
+# Compares the client-computed columns of every geometry table with the values PostGIS computes for the same rows.
+
+PARITY_SQL = '''
+SELECT COUNT(*),
+       MAX(ABS(area - pg_area) / NULLIF(pg_area, 0)),
+       AVG(ABS(area - pg_area) / NULLIF(pg_area, 0)),
+       MAX(ABS(perimeter - pg_perimeter) / NULLIF(pg_perimeter, 0)),
+       AVG(ABS(perimeter - pg_perimeter) / NULLIF(pg_perimeter, 0)),
+       MAX(ABS(npi - pg_npi)),
+       AVG(ABS(npi - pg_npi))
+
+  FROM (SELECT area,
+               perimeter,
+               npi,
+               ST_Area(geometry, true) / 2589988.11 AS pg_area,
+               ST_Perimeter(geometry, true) / 1609.34 AS pg_perimeter,
+               (2 * SQRT(PI() * ST_Area(geometry, true))) / NULLIF(ST_Perimeter(geometry, true), 0) AS pg_npi
+
+          FROM gm.{table}) AS metrics;
+'''
+
+
+def parity(cur, tables):
+    report = {}
+    for table in tables:
+        cur.execute(PARITY_SQL.format(table=table))
+        row = cur.fetchone()
+        report[table] = {
+            'rows': row[0],
+            'area_max_relative_error': row[1],
+            'area_mean_relative_error': row[2],
+            'perimeter_max_relative_error': row[3],
+            'perimeter_mean_relative_error': row[4],
+            'npi_max_absolute_error': row[5],
+            'npi_mean_absolute_error': row[6],
+        }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare client-computed area, perimeter and npi with PostGIS.')
+    parser.add_argument('tables', nargs='*', default=['states', 'counties', 'assemblies', 'senates', 'congressionals',
+                                                      'wards'], help='geometry tables to compare (default: all)')
+    args = parser.parse_args()
+
+    conn = db.connect()
+    cur = conn.cursor()
+    for table, errors in parity(cur, args.tables).items():
+        print('gm.{}: {} rows'.format(table, errors['rows']))
+        for name, value in errors.items():
+            if name != 'rows':
+                print('    {}: {}'.format(name, 'n/a' if value is None else '{:.3e}'.format(value)))
+    cur.close()
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+import re
+
+import bulk
+import db
+
+########################################################################################################################
+# Partitions
+########################################################################################################################
+
+# With `partitioned` the fact tables `gm.votes` and `gm.populations` are partitioned by state, and every state
+# partition by (election or census) year: `gm.votes_<state>` holds `gm.votes_<state>_<year>`. Their unique keys lead
+# with both partition keys, so every API query, which filters on state and year, is pruned to a single partition, and
+# reloading one state's results of one year only touches that partition.
+#
+# A full ingest loads every (state, year) into a detached `<partition>_load` table, which is indexed, checked against
+# the partition bounds (so attaching it skips the validation scan) and attached once every task loading it is done.
+# An incremental ingest upserts through the parent, into partitions created up front for any new (state, year).
+
+TABLES = ['votes', 'populations']
+
+
+def partition_sql(table_sql):
+    return re.sub(r'\);\s*$', ') PARTITION BY LIST (state);\n', table_sql)
+
+
+def partition_name(table, state, year=None):
+    return '{}_{}'.format(table, state) if year is None else '{}_{}_{}'.format(table, state, year)
+
+
+def is_partitioned(cur, table):
+    cur.execute('SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = TO_REGCLASS(%s));',
+                ('{}.{}'.format(db.schema(), table),))
+    return cur.fetchone()[0]
+
+
+def partition_keys(state_sources):
+    # The (state, year) partitions every table is loaded into, from the sources
+    keys = {table: set() for table in TABLES}
+    for state, sources in state_sources.items():
+        for meta in sources.get('votes', []):
+            keys['votes'].update((state, year['year']) for years in meta['races'].values() for year in years)
+        for meta in sources.get('populations', []):
+            keys['populations'].add((state, meta['year']))
+    return {table: sorted(table_keys) for table, table_keys in keys.items()}
+
+
+def create_partitions(cur, keys, load):
+    for table in TABLES:
+        for state in sorted({state for state, _ in keys[table]}):
+            cur.execute('''
+            CREATE TABLE IF NOT EXISTS gm.{partition}
+                PARTITION OF gm.{table}
+                FOR VALUES IN (%s)
+                PARTITION BY LIST (year);
+            '''.format(partition=partition_name(table, state), table=table), (state,))
+        for state, year in keys[table]:
+            partition = partition_name(table, state, year)
+            if load:
+                cur.execute('DROP TABLE IF EXISTS gm.{}_load;'.format(partition))
+                cur.execute('CREATE TABLE gm.{}_load (LIKE gm.{} INCLUDING DEFAULTS INCLUDING GENERATED);'.format(
+                    partition, table))
+            else:
+                cur.execute('CREATE TABLE IF NOT EXISTS gm.{} PARTITION OF gm.{} FOR VALUES IN (%s);'.format(
+                    partition, partition_name(table, state)), (year,))
+
+########################################################################################################################
+# Partition Writer
+########################################################################################################################
+
+# Drop-in replacement for `bulk.CopyWriter` that routes every row to the load table of its (state, year) partition.
+
+
+class PartitionWriter:
+
+    def __init__(self, cur, table, columns, batch_size=10000, parents=()):
+        self.cur = cur
+        self.table = table
+        self.columns = columns
+        self.batch_size = batch_size
+        self.parents = list(parents)
+        names = [name for name, _ in columns]
+        self.state_index = names.index('state')
+        self.year_index = names.index('year')
+        self.writers = {}
+
+    @property
+    def total_rows(self):
+        return sum(writer.total_rows for writer in self.writers.values())
+
+    @property
+    def total_bytes(self):
+        return sum(writer.total_bytes for writer in self.writers.values())
+
+    def begin(self, source):
+        return True
+
+    def write(self, row):
+        key = (row[self.state_index], row[self.year_index])
+        if key not in self.writers:
+            self.writers[key] = bulk.CopyWriter(self.cur, 'gm.{}_load'.format(partition_name(self.table, *key)),
+                                                self.columns, batch_size=self.batch_size, parents=self.parents)
+        self.writers[key].write(row)
+
+    def flush(self):
+        for writer in self.writers.values():
+            writer.flush()
+
+    def close(self):
+        for writer in self.writers.values():
+            writer.close()
+
+########################################################################################################################
+# Attach Stage
+########################################################################################################################
+
+def attach_state(table, key, state, years):
+    conn = db.connection()
+    with conn.cursor() as cur:
+        for year in years:
+            partition = partition_name(table, state, year)
+            cur.execute('DROP TABLE IF EXISTS gm.{};'.format(partition))
+            cur.execute('ALTER TABLE gm.{0}_load ADD CONSTRAINT {0}_bounds CHECK (state = %s AND year = %s);'.format(
+                partition), (state, year))
+            cur.execute('CREATE UNIQUE INDEX {0}_key ON gm.{0}_load ({1});'.format(partition, ', '.join(key)))
+            cur.execute('ALTER TABLE gm.{0}_load RENAME TO {0};'.format(partition))
+            cur.execute('ALTER TABLE gm.{} ATTACH PARTITION gm.{} FOR VALUES IN (%s);'.format(
+                partition_name(table, state), partition), (year,))
+    conn.commit()
+    return [{'table': table, 'derived': '{} partitions attached ({})'.format(len(years), ', '.join(years))}]
@@ -0,0 +1,380 @@
+import argparse
+import json
+import os
+import struct
+import time
+
+import numpy as np
+
+import adjacency
+import db
+import schedule
+
+########################################################################################################################
+# Inputs
+########################################################################################################################
+
+# A chain runs on the ward adjacency graph of one ward vintage (see `adjacency.py`), with every ward's population from
+# `gm.populations.total` and its county and enacted district from `gm.wards`. Districts and counties are dictionary-
+# encoded in the order of their sorted names.
+
+LEVELS = ['assembly', 'senate', 'congressional']
+
+
+def load_inputs(cur, state, year, level, population_year, directory):
+    csr = adjacency.load(os.path.join(directory, '{}-{}.npz'.format(state, year)))
+    names = [str(name) for name in csr['names']]
+    index = {name: position for position, name in enumerate(names)}
+
+    cur.execute('SELECT name, county, {} FROM gm.wards WHERE state = %s AND year = %s;'.format(level), (state, year))
+    counties = [None] * len(names)
+    districts = [None] * len(names)
+    for name, county, district in cur.fetchall():
+        if name in index:
+            counties[index[name]] = county
+            districts[index[name]] = district
+    if None in districts:
+        raise ValueError('The adjacency graph of {} {} is out of date with gm.wards'.format(state, year))
+
+    if population_year is None:
+        cur.execute('SELECT MAX(year) FROM gm.populations WHERE state = %s AND ward_year = %s;', (state, year))
+        population_year = cur.fetchone()[0]
+    cur.execute('SELECT ward, total FROM gm.populations WHERE state = %s AND ward_year = %s AND year = %s;',
+                (state, year, population_year))
+    populations = np.zeros(len(names), dtype=np.int64)
+    for name, total in cur.fetchall():
+        if name in index:
+            populations[index[name]] = total
+
+    district_labels, initial = np.unique(np.asarray(districts, dtype=str), return_inverse=True)
+    county_labels, county_codes = np.unique(np.asarray(counties, dtype=str), return_inverse=True)
+    return {
+        'names': names,
+        'population_year': population_year,
+        'districts': [str(label) for label in district_labels],
+        'counties': [str(label) for label in county_labels],
+        'indptr': csr['indptr'],
+        'indices': csr['indices'].astype(np.int64),
+        'populations': populations,
+        'county_codes': county_codes.reshape(-1).astype(np.int64),
+        'initial': initial.reshape(-1).astype(np.int64),
+    }
+
+########################################################################################################################
+# Plan Store
+########################################################################################################################
+
+# Every chain writes its plans as deltas: plan i differs from plan i - 1 by the wards `wards[offsets[i - 1]:offsets[i]]`
+# moving to `districts[offsets[i - 1]:offsets[i]]`, and plan 0 is the enacted plan in `initial.npy`. A recombination
+# only redraws two districts, so a plan costs a few hundred bytes instead of one byte per ward. The arrays are plain
+# `.npy` files (so `np.load(..., mmap_mode='r')` works) streamed to disk with their length filled in on close.
+
+HEADER_SIZE = 128
+
+
+class ArrayWriter:
+
+    def __init__(self, path, dtype, buffer_size=1 << 16):
+        self.file = open(path, 'wb')
+        self.dtype = np.dtype(dtype)
+        self.buffer_size = buffer_size
+        self.chunks = []
+        self.buffered = 0
+        self.length = 0
+        self.file.write(self.header())
+
+    def header(self):
+        header = repr({'descr': np.lib.format.dtype_to_descr(self.dtype), 'fortran_order': False,
+                       'shape': (self.length,)})
+        header = header.ljust(HEADER_SIZE - 11) + '\n'
+        return np.lib.format.MAGIC_PREFIX + b'\x01\x00' + struct.pack('<H', len(header)) + header.encode('latin1')
+
+    def write(self, values):
+        values = np.asarray(values, dtype=self.dtype).reshape(-1)
+        self.chunks.append(values)
+        self.buffered += len(values)
+        self.length += len(values)
+        if self.buffered >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self.chunks:
+            self.file.write(np.concatenate(self.chunks).tobytes())
+            self.chunks = []
+            self.buffered = 0
+
+    def close(self):
+        self.flush()
+        self.file.seek(0)
+        self.file.write(self.header())
+        self.file.close()
+
+
+def chain_paths(directory, chain):
+    return {name: os.path.join(directory, 'chain-{:04d}-{}.npy'.format(chain, name))
+            for name in ['offsets', 'wards', 'districts']}
+
+
+def read_plans(directory, chain):
+    # Yields every plan of a chain as a ward -> district code array (the same array, updated in place)
+    plan = np.load(os.path.join(directory, 'initial.npy')).copy()
+    paths = chain_paths(directory, chain)
+    offsets = np.load(paths['offsets'], mmap_mode='r')
+    wards = np.load(paths['wards'], mmap_mode='r')
+    districts = np.load(paths['districts'], mmap_mode='r')
+    yield plan
+    for start, end in zip(offsets[:-1], offsets[1:]):
+        plan[wards[start:end]] = districts[start:end]
+        yield plan
+
+########################################################################################################################
+# Recombination
+########################################################################################################################
+
+# One ReCom step picks a random cut edge (an edge between wards of different districts, kept in `cuts`), merges the
+# two districts on either side of it, draws a random spanning tree of the merged wards (Kruskal's algorithm over a
+# random edge order) and cuts the tree at a random edge that leaves both halves within `epsilon` of the ideal district
+# population. Both halves of a tree are connected, so contiguity holds by construction. A step that finds no balanced
+# cut in `attempts` trees, or that would exceed `max_county_splits`, is rejected and repeats the current plan.
+
+
+class Chain:
+
+    def __init__(self, inputs, epsilon, max_county_splits, attempts, rng):
+        self.indptr = inputs['indptr']
+        self.indices = inputs['indices']
+        self.sources = np.repeat(np.arange(len(self.indptr) - 1), np.diff(self.indptr))
+        self.populations = inputs['populations']
+        self.county_codes = inputs['county_codes']
+        self.assignment = inputs['initial'].copy()
+        self.district_count = len(inputs['districts'])
+        if self.district_count < 2:
+            raise ValueError('ReCom needs at least two districts, got {}'.format(self.district_count))
+        self.cuts = np.flatnonzero(self.assignment[self.sources] != self.assignment[self.indices])
+        if len(self.cuts) == 0:
+            # E.g. every district is a component of its own, like island wards, or the graph has no edges
+            raise ValueError('ReCom needs adjacent wards in different districts, but no edge joins two districts')
+        self.ideal = self.populations.sum() / self.district_count
+        self.epsilon = epsilon
+        self.max_county_splits = max_county_splits
+        self.attempts = attempts
+        self.rng = rng
+        self.local = np.full(len(self.assignment), -1, dtype=np.int64)
+
+        self.county_districts = np.zeros((len(inputs['counties']), self.district_count), dtype=np.int64)
+        np.add.at(self.county_districts, (self.county_codes, self.assignment), 1)
+        self.county_splits = int((self.county_districts > 0).sum()) - len(inputs['counties'])
+
+    def cut_edge(self):
+        edge = self.cuts[self.rng.integers(len(self.cuts))]
+        return self.assignment[self.sources[edge]], self.assignment[self.indices[edge]]
+
+    def merged_edges(self, nodes):
+        self.local[nodes] = np.arange(len(nodes))
+        starts = self.indptr[nodes]
+        degrees = self.indptr[nodes + 1] - starts
+        positions = np.repeat(starts - np.cumsum(degrees) + degrees, degrees) + np.arange(degrees.sum())
+        sources = np.repeat(np.arange(len(nodes)), degrees)
+        targets = self.local[self.indices[positions]]
+        self.local[nodes] = -1
+        keep = targets > sources
+        return sources[keep], targets[keep]
+
+    def spanning_tree(self, count, sources, targets):
+        # Union-find with path halving, inlined since this loop is the hot path of a step
+        order = self.rng.permutation(len(sources))
+        parents = list(range(count))
+        neighbours = [[] for _ in range(count)]
+        remaining = count - 1
+        for source, target in zip(sources[order].tolist(), targets[order].tolist()):
+            source_root = source
+            while parents[source_root] != source_root:
+                parents[source_root] = parents[parents[source_root]]
+                source_root = parents[source_root]
+            target_root = target
+            while parents[target_root] != target_root:
+                parents[target_root] = parents[parents[target_root]]
+                target_root = parents[target_root]
+            if source_root != target_root:
+                parents[source_root] = target_root
+                neighbours[source].append(target)
+                neighbours[target].append(source)
+                remaining -= 1
+                if not remaining:
+                    break
+        return neighbours
+
+    def balanced_cut(self, populations, neighbours):
+        # Orders the tree breadth-first from a random root and accumulates subtree populations leaves first; cutting
+        # above node i splits off exactly its subtree
+        count = len(neighbours)
+        root = int(self.rng.integers(count))
+        order = [root]
+        parents = [-1] * count
+        parents[root] = root
+        for node in order:
+            for neighbour in neighbours[node]:
+                if parents[neighbour] == -1:
+                    parents[neighbour] = node
+                    order.append(neighbour)
+        if len(order) < count:
+            return None
+
+        subtotals = populations.astype(np.float64).tolist()
+        for node in reversed(order[1:]):
+            subtotals[parents[node]] += subtotals[node]
+        total = subtotals[root]
+        low, high = self.ideal * (1 - self.epsilon), self.ideal * (1 + self.epsilon)
+        candidates = [node for node in order[1:] if low <= subtotals[node] <= high and low <= total - subtotals[node]
+                      <= high]
+        if not candidates:
+            return None
+
+        child = candidates[int(self.rng.integers(len(candidates)))]
+        side = np.zeros(count, dtype=bool)
+        side[child] = True
+        for node in order[order.index(child) + 1:]:
+            side[node] = side[parents[node]]
+        return side
+
+    def step(self):
+        first, second = self.cut_edge()
+        nodes = np.flatnonzero((self.assignment == first) | (self.assignment == second))
+        sources, targets = self.merged_edges(nodes)
+        populations = self.populations[nodes]
+
+        for _ in range(self.attempts):
+            side = self.balanced_cut(populations, self.spanning_tree(len(nodes), sources, targets))
+            if side is not None:
+                break
+        else:
+            return None
+
+        # Label the halves so that as few wards as possible move
+        proposal = np.where(side, first, second)
+        if np.count_nonzero(proposal != self.assignment[nodes]) > len(nodes) // 2:
+            proposal = np.where(side, second, first)
+        moved = proposal != self.assignment[nodes]
+        wards, districts = nodes[moved], proposal[moved]
+
+        if self.max_county_splits is not None:
+            counties = self.county_codes[wards]
+            affected = np.unique(counties)
+            before = int((self.county_districts[affected] > 0).sum())
+            np.add.at(self.county_districts, (counties, self.assignment[wards]), -1)
+            np.add.at(self.county_districts, (counties, districts), 1)
+            splits = self.county_splits + int((self.county_districts[affected] > 0).sum()) - before
+            if splits > self.max_county_splits:
+                np.add.at(self.county_districts, (counties, districts), -1)
+                np.add.at(self.county_districts, (counties, self.assignment[wards]), 1)
+                return None
+            self.county_splits = splits
+
+        self.assignment[wards] = districts
+        # Both halves are non-empty and adjacent in the tree, so at least one cut edge always remains
+        self.cuts = np.flatnonzero(self.assignment[self.sources] != self.assignment[self.indices])
+        return wards, districts
+
+########################################################################################################################
+# Ensemble
+########################################################################################################################
+
+def run_chain(inputs, directory, chain, steps, epsilon, max_county_splits, attempts, seed):
+    rng = np.random.default_rng([seed, chain])
+    walker = Chain(inputs, epsilon, max_county_splits, attempts, rng)
+    district_dtype = np.uint8 if walker.district_count <= 256 else np.uint16
+    paths = chain_paths(directory, chain)
+    offsets = ArrayWriter(paths['offsets'], np.int64)
+    wards = ArrayWriter(paths['wards'], np.int32)
+    districts = ArrayWriter(paths['districts'], district_dtype)
+
+    start = time.perf_counter()
+    offset = 0
+    accepted = 0
+    offsets.write([0])
+    for _ in range(steps):
+        move = walker.step()
+        if move is not None:
+            wards.write(move[0])
+            districts.write(move[1])
+            offset += len(move[0])
+            accepted += 1
+        offsets.write([offset])
+    elapsed = time.perf_counter() - start
+
+    for writer in (offsets, wards, districts):
+        writer.close()
+    return {'chain': chain, 'plans': steps, 'accepted': accepted, 'seconds': elapsed}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate an ensemble of ward -> district plans with independent '
+                                                 'ReCom chains that start from the enacted plan.')
+    parser.add_argument('state')
+    parser.add_argument('year', help='ward vintage (and year of the enacted districts)')
+    parser.add_argument('level', choices=LEVELS)
+    parser.add_argument('output', help='directory to write the ensemble to')
+    parser.add_argument('--chains', type=int, default=os.cpu_count(), help='number of chains (default: CPU count)')
+    parser.add_argument('--steps', type=int, default=10000, help='plans per chain (default: 10000)')
+    parser.add_argument('--epsilon', type=float, default=0.05,
+                        help='allowed relative deviation from the ideal district population (default: 0.05)')
+    parser.add_argument('--max-county-splits', type=int,
+                        help='reject plans that split counties more times than this (default: no limit)')
+    parser.add_argument('--attempts', type=int, default=10,
+                        help='spanning trees to draw per step before rejecting it (default: 10)')
+    parser.add_argument('--population-year', help='year of `gm.populations` to balance (default: latest)')
+    parser.add_argument('--adjacency', default='adjacency',
+                        help='directory of the ward adjacency graphs (default: adjacency)')
+    parser.add_argument('--seed', type=int, default=0, help='random seed of the ensemble (default: 0)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='number of worker processes (default: CPU count)')
+    args = parser.parse_args()
+
+    conn = db.connect()
+    cur = conn.cursor()
+    inputs = load_inputs(cur, args.state, args.year, args.level, args.population_year, args.adjacency)
+    cur.close()
+    conn.close()
+    try:
+        Chain(inputs, args.epsilon, args.max_county_splits, args.attempts, np.random.default_rng(args.seed))
+    except ValueError as error:
+        parser.error('{} {} {}: {}'.format(args.state, args.year, args.level, error))
+
+    os.makedirs(args.output, exist_ok=True)
+    np.save(os.path.join(args.output, 'initial.npy'), inputs['initial'].astype(
+        np.uint8 if len(inputs['districts']) <= 256 else np.uint16))
+    np.save(os.path.join(args.output, 'populations.npy'), inputs['populations'])
+    with open(os.path.join(args.output, 'ensemble.json'), 'w') as ensemble_file:
+        json.dump({
+            'state': args.state,
+            'year': args.year,
+            'level': args.level,
+            'population_year': inputs['population_year'],
+            'epsilon': args.epsilon,
+            'max_county_splits': args.max_county_splits,
+            'chains': args.chains,
+            'steps': args.steps,
+            'seed': args.seed,
+            'wards': inputs['names'],
+            'districts': inputs['districts'],
+        }, ensemble_file)
+
+    start = time.perf_counter()
+    tasks = {
+        'chain-{:04d}'.format(chain): schedule.Task(run_chain, (inputs, args.output, chain, args.steps, args.epsilon,
+                                                                args.max_county_splits, args.attempts, args.seed), [])
+        for chain in range(args.chains)
+    }
+    results = schedule.run(tasks, workers=args.workers, on_done=lambda task, result: print(
+        '{}: {} plans ({} accepted) in {:.1f}s, {:.0f} plans/s'.format(
+            task, result['plans'], result['accepted'], result['seconds'], result['plans'] / result['seconds'])))
+    elapsed = time.perf_counter() - start
+
+    plans = sum(result['plans'] for result in results.values())
+    busy = sum(result['seconds'] for result in results.values())
+    print('{} plans in {:.1f}s: {:.0f} plans/s, {:.0f} plans/s per core'.format(
+        plans, elapsed, plans / elapsed, plans / busy))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,196 @@
+import db
+
+########################################################################################################################
+# Vote Rollups
+########################################################################################################################
+
+# `gm.vote_rollups` holds the vote totals of every state, county, assembly, senate and congressional district for every
+# race and year, so the API can serve grouped votes without joining and aggregating `gm.votes` per request. Rows are
+# kept per ward vintage (`ward_year`), which is also the year of the districts the wards were assigned to.
+
+TABLE_SQL = '''
+CREATE TABLE IF NOT EXISTS gm.vote_rollups (
+    state           VARCHAR NOT NULL,
+
+                    FOREIGN KEY (state)
+                     REFERENCES gm.states(name),
+
+    race            VARCHAR NOT NULL,
+    year            CHAR(4) NOT NULL,
+    ward_year       CHAR(4) NOT NULL,
+    level           VARCHAR NOT NULL,
+    name            VARCHAR NOT NULL,
+
+                    UNIQUE (state, race, year, level, ward_year, name),
+
+    total           INTEGER NOT NULL,
+    democrat        INTEGER NOT NULL,
+    republican      INTEGER NOT NULL,
+
+    competitiveness REAL GENERATED ALWAYS AS (CASE
+                                                WHEN democrat + republican > 0
+                                                  THEN ((democrat::REAL / (democrat + republican)) - 0.5) / 0.5
+                                                ELSE 0
+                                              END) STORED
+);
+'''
+
+# A slice is `(state, ward_year, race, year)`; `None` matches every value, so `(state, None, None, None)` is the whole
+# state. Every level of a slice is recomputed with a single scan of its votes.
+
+SLICE_SQL = '''
+    vt.state = %(state)s
+AND (%(ward_year)s::CHAR(4) IS NULL OR vt.ward_year = %(ward_year)s)
+AND (%(race)s::VARCHAR IS NULL OR vt.race = %(race)s)
+AND (%(year)s::CHAR(4) IS NULL OR vt.year = %(year)s)
+'''
+
+DELETE_SQL = '''
+DELETE FROM gm.vote_rollups AS vt
+      WHERE {slice};
+'''.format(slice=SLICE_SQL)
+
+INSERT_SQL = '''
+INSERT INTO gm.vote_rollups (
+    state,
+    race,
+    year,
+    ward_year,
+    level,
+    name,
+    total,
+    democrat,
+    republican
+)
+SELECT vt.state,
+       vt.race,
+       vt.year,
+       vt.ward_year,
+       CASE
+         WHEN GROUPING(wrd.county) = 0 THEN 'county'
+         WHEN GROUPING(wrd.assembly) = 0 THEN 'assembly'
+         WHEN GROUPING(wrd.senate) = 0 THEN 'senate'
+         WHEN GROUPING(wrd.congressional) = 0 THEN 'congressional'
+         ELSE 'state'
+       END,
+       COALESCE(wrd.county, wrd.assembly, wrd.senate, wrd.congressional, vt.state),
+       SUM(vt.total),
+       SUM(vt.democrat),
+       SUM(vt.republican)
+
+  FROM gm.votes AS vt
+
+       JOIN gm.wards AS wrd
+       ON vt.state = wrd.state
+          AND vt.ward_year = wrd.year
+          AND vt.ward = wrd.name
+
+ WHERE {slice}
+
+ GROUP BY vt.state,
+          vt.race,
+          vt.year,
+          vt.ward_year,
+          GROUPING SETS ((), (wrd.county), (wrd.assembly), (wrd.senate), (wrd.congressional));
+'''.format(slice=SLICE_SQL)
+
+
+def create_table(cur, drop):
+    if drop:
+        cur.execute('DROP TABLE IF EXISTS gm.vote_rollups;')
+    cur.execute(TABLE_SQL)
+
+
+def slices(summaries):
+    # Changed or deleted votes only affect their own race and year; a changed or deleted ward may have moved between
+    # counties or districts, which affects every race of its state and vintage.
+    changed = set()
+    for summary in summaries:
+        if summary['table'] == 'votes':
+            for key in summary['changed'] + summary['deleted']:
+                state, race, year, ward_year, _ = key.split('/')
+                changed.add((state, ward_year, race, year))
+        elif summary['table'] == 'wards':
+            for key in summary['changed'] + summary['deleted']:
+                state, year, _ = key.split('/')
+                changed.add((state, year, None, None))
+    return sorted(
+        (state, ward_year, race, year) for state, ward_year, race, year in changed
+        if race is None or (state, ward_year, None, None) not in changed
+    )
+
+
+def refresh(state_slices):
+    conn = db.connection()
+    with conn.cursor() as cur:
+        for state, ward_year, race, year in state_slices:
+            parameters = {'state': state, 'ward_year': ward_year, 'race': race, 'year': year}
+            cur.execute(DELETE_SQL, parameters)
+            cur.execute(INSERT_SQL, parameters)
+    conn.commit()
+    return [{'table': 'vote_rollups', 'derived': '{} slices refreshed'.format(len(state_slices))}]
+
+########################################################################################################################
+# Deltas
+########################################################################################################################
+
+# Streamed results (see `stream.py`) change a handful of wards at a time, so instead of recomputing their slices the
+# rollups are adjusted in place: `changes` holds every changed vote row with its ward's county and districts, its new
+# counts and its previous counts (0 for a new row), and the difference is added to the state, county and district rows
+# it falls in, creating any that do not exist yet. Rows are upserted in key order, so concurrent transactions lock them
+# in the same order.
+
+DELTA_SQL = '''
+INSERT INTO gm.vote_rollups AS vr (
+    state,
+    race,
+    year,
+    ward_year,
+    level,
+    name,
+    total,
+    democrat,
+    republican
+)
+SELECT ch.state,
+       ch.race,
+       ch.year,
+       ch.ward_year,
+       CASE
+         WHEN GROUPING(ch.county) = 0 THEN 'county'
+         WHEN GROUPING(ch.assembly) = 0 THEN 'assembly'
+         WHEN GROUPING(ch.senate) = 0 THEN 'senate'
+         WHEN GROUPING(ch.congressional) = 0 THEN 'congressional'
+         ELSE 'state'
+       END AS level,
+       COALESCE(ch.county, ch.assembly, ch.senate, ch.congressional, ch.state) AS name,
+       SUM(ch.total - ch.previous_total),
+       SUM(ch.democrat - ch.previous_democrat),
+       SUM(ch.republican - ch.previous_republican)
+
+  FROM {changes} AS ch
+
+ GROUP BY ch.state,
+          ch.race,
+          ch.year,
+          ch.ward_year,
+          GROUPING SETS ((), (ch.county), (ch.assembly), (ch.senate), (ch.congressional))
+
+ ORDER BY ch.state,
+          ch.race,
+          ch.year,
+          ch.ward_year,
+          level,
+          name
+
+    ON CONFLICT (state, race, year, level, ward_year, name)
+ DO UPDATE SET total = vr.total + EXCLUDED.total,
+               democrat = vr.democrat + EXCLUDED.democrat,
+               republican = vr.republican + EXCLUDED.republican;
+'''
+
+
+def apply_deltas(cur, changes):
+    # Returns the number of rollup rows adjusted or created
+    cur.execute(DELTA_SQL.format(changes=changes))
+    return cur.rowcount
@@ -0,0 +1,56 @@
+import collections
+import multiprocessing
+from concurrent import futures
+
+import instrument
+
+########################################################################################################################
+# Dependency Scheduler
+########################################################################################################################
+
+# A task is a picklable module-level function, its arguments and the names of the tasks that must finish before it
+# starts. Every task whose dependencies are done is submitted to the process pool at once, so independent states and
+# independent layers of the same state load concurrently. Workers are spawned (not forked) so that no worker inherits
+# the parent's database connection. With `on_metrics`, every task is run through `instrument.measure()` and its metrics
+# are passed to `on_metrics` as it finishes.
+
+Task = collections.namedtuple('Task', ['function', 'args', 'dependencies'])
+
+
+def run(tasks, workers=None, on_done=None, on_metrics=None):
+    for name, task in tasks.items():
+        for dependency in task.dependencies:
+            if dependency not in tasks:
+                raise ValueError('Task \'{}\' depends on unknown task \'{}\''.format(name, dependency))
+
+    results = {}
+    pending = dict(tasks)
+    running = {}
+
+    executor = futures.ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+    try:
+        while pending or running:
+            for name, task in list(pending.items()):
+                if all(dependency in results for dependency in task.dependencies):
+                    if on_metrics:
+                        running[executor.submit(instrument.measure, task.function, *task.args)] = name
+                    else:
+                        running[executor.submit(task.function, *task.args)] = name
+                    del pending[name]
+
+            if not running:
+                raise ValueError('Tasks {} have cyclic dependencies'.format(sorted(pending)))
+
+            done, _ = futures.wait(running, return_when=futures.FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                results[name] = future.result()
+                if on_metrics:
+                    results[name], metrics = results[name]
+                    on_metrics(name, metrics)
+                if on_done:
+                    on_done(name, results[name])
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+    return results
@@ -13,8 +13,12 @@ psql -U gm_admin -d gm -c "$(cat << END
 END
 )";
 
-# Create schema
+# Create schema, plus the schemas a staged ingest builds in and keeps the previous version in (see `staging.py`) and
+# the one benchmarks run in (see `benchmark.py`)
 psql -U gm_admin -d gm -c "CREATE SCHEMA gm;";
+psql -U gm_admin -d gm -c "CREATE SCHEMA gm_staging;";
+psql -U gm_admin -d gm -c "CREATE SCHEMA gm_previous;";
+psql -U gm_admin -d gm -c "CREATE SCHEMA gm_benchmark;";
 
 # Create readonly role
 psql -U gm_admin -d gm -c "$(cat << END
@@ -23,6 +27,7 @@ psql -U gm_admin -d gm -c "$(cat << END
   GRANT USAGE ON SCHEMA gm TO gm_readonly;
   GRANT SELECT ON ALL TABLES IN SCHEMA gm TO gm_readonly;
   ALTER DEFAULT PRIVILEGES IN SCHEMA gm GRANT SELECT ON TABLES TO gm_readonly;
+  ALTER DEFAULT PRIVILEGES IN SCHEMA gm_staging GRANT SELECT ON TABLES TO gm_readonly;
 END
 )";
 
@@ -35,6 +40,9 @@ psql -U gm_admin -d gm -c "$(cat << END
   ALTER DEFAULT PRIVILEGES IN SCHEMA gm GRANT SELECT, INSERT, UPDATE, DELETE ON TABLES TO gm_readwrite;
   GRANT USAGE ON ALL SEQUENCES IN SCHEMA gm TO gm_readwrite;
   ALTER DEFAULT PRIVILEGES IN SCHEMA gm GRANT USAGE ON SEQUENCES TO gm_readwrite;
+  GRANT USAGE, CREATE ON SCHEMA gm_staging, gm_previous, gm_benchmark TO gm_readwrite;
+  ALTER DEFAULT PRIVILEGES IN SCHEMA gm_staging GRANT SELECT, INSERT, UPDATE, DELETE ON TABLES TO gm_readwrite;
+  ALTER DEFAULT PRIVILEGES IN SCHEMA gm_staging GRANT USAGE ON SEQUENCES TO gm_readwrite;
 END
 )";
 
@@ -65,3 +73,7 @@ psql -U gm_admin -d gm -c "$(cat << END
   ALTER EXTENSION postgis SET SCHEMA gm;
 END
 )";
+
+# Enable per-statement statistics for `ingest.py --profile` (see `instrument.py`), which also requires
+# `shared_preload_libraries = 'pg_stat_statements'` in `postgresql.conf`
+psql -U gm_admin -d gm -c "CREATE EXTENSION pg_stat_statements SCHEMA gm;";
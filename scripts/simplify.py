@@ -0,0 +1,202 @@
+import argparse
+import json
+import os
+
+import numpy as np
+
+import bulk
+import db
+import layers
+import schedule
+import topology
+
+########################################################################################################################
+# Levels
+########################################################################################################################
+
+# Every geometry table keeps its full geometry plus one simplified copy per zoom level in `geometry_z<zoom>`, simplified
+# to about one screen pixel at that zoom, so a query for zoom z can use the coarsest column whose zoom is at least z.
+
+ZOOMS = [5, 8, 11]
+
+
+def tolerance(zoom):
+    # Degrees spanned by one 256px-tile pixel at the equator
+    return 360 / (256 * 2 ** zoom)
+
+
+def create_columns(cur):
+    for table in layers.GEOMETRY_TABLES:
+        for zoom in ZOOMS:
+            cur.execute('ALTER TABLE gm.{} ADD COLUMN IF NOT EXISTS geometry_z{} GEOMETRY;'.format(table, zoom))
+
+########################################################################################################################
+# Arc Simplification
+########################################################################################################################
+
+# Douglas-Peucker is run once per arc of the shared-arc topology, recording for every vertex the tolerance below which
+# it is kept (capped by the tolerance of the vertex that split its span, so levels nest). Every level is then a filter
+# on those importances, and since neighbours share their arcs, their simplified boundaries still coincide: no slivers
+# and no gaps. Arc endpoints are always kept. Longitudes are scaled by the cosine of the arc's latitude so tolerances
+# are roughly isotropic.
+
+def importances(coordinates):
+    count = len(coordinates)
+    importance = np.full(count, np.inf)
+    if count < 3:
+        return importance
+    xy = coordinates * [np.cos(np.radians(coordinates[:, 1].mean())), 1.0]
+
+    stack = [(0, count - 1, np.inf)]
+    while stack:
+        start, end, ceiling = stack.pop()
+        if end - start < 2:
+            continue
+        origin, direction = xy[start], xy[end] - xy[start]
+        span = xy[start + 1:end] - origin
+        length = np.hypot(direction[0], direction[1])
+        if length == 0:
+            distances = np.hypot(span[:, 0], span[:, 1])
+        else:
+            distances = np.abs(direction[0] * span[:, 1] - direction[1] * span[:, 0]) / length
+        split = start + 1 + int(np.argmax(distances))
+        importance[split] = min(distances[split - start - 1], ceiling)
+        stack.append((start, split, importance[split]))
+        stack.append((split, end, importance[split]))
+    return importance
+
+
+def simplify(topo, zooms=ZOOMS):
+    # Rings made of fewer than three arcs would collapse to a line, so their arcs always keep enough of their most
+    # important vertices to stay a triangle (like mapshaper's `keep-shapes`)
+    keep = np.zeros(len(topo.arcs), dtype=np.int64)
+    for shape in topo.shapes:
+        for polygon in shape:
+            for ring in polygon:
+                if len(ring) < 3:
+                    for reference in ring:
+                        index = reference if reference >= 0 else ~reference
+                        keep[index] = max(keep[index], 3 - len(ring))
+
+    arc_importances = []
+    for index, arc in enumerate(topo.arcs):
+        importance = importances(topo.points[arc])
+        if keep[index]:
+            interior = importance[1:-1]
+            interior[np.argsort(-interior, kind='stable')[:keep[index]]] = np.inf
+        arc_importances.append(importance)
+
+    return {zoom: [arc[importance > tolerance(zoom)] for arc, importance in zip(topo.arcs, arc_importances)]
+            for zoom in zooms}
+
+########################################################################################################################
+# Simplify Stage
+########################################################################################################################
+
+# Geometries are simplified per group of tables whose boundaries coincide: the national states, and the counties,
+# districts and wards of each state. A group is always simplified as a whole since its arcs are shared.
+
+STATE_TABLES = ['counties', 'assemblies', 'senates', 'congressionals', 'wards']
+
+
+def group_tables(group):
+    return ['states'] if group == 'states' else STATE_TABLES
+
+
+def groups(summaries):
+    changed = set()
+    for summary in summaries:
+        if summary['table'] in layers.GEOMETRY_TABLES:
+            for key in summary['changed'] + summary['deleted']:
+                changed.add('states' if summary['table'] == 'states' else key.split('/')[0])
+    return sorted(changed)
+
+
+def simplify_group(group):
+    tables = group_tables(group)
+    conn = db.connection()
+    with conn.cursor() as cur:
+        rows = {}
+        geometries = []
+        for table in tables:
+            key = layers.KEYS[table]
+            if group == 'states':
+                cur.execute('SELECT {}, ST_AsGeoJSON(geometry) FROM gm.{};'.format(', '.join(key), table))
+            else:
+                cur.execute('SELECT {}, ST_AsGeoJSON(geometry) FROM gm.{} WHERE state = %s;'.format(
+                    ', '.join(key), table), (group,))
+            rows[table] = []
+            for row in cur.fetchall():
+                rows[table].append(row[:-1])
+                geometries.append(json.loads(row[-1]))
+
+        topo = topology.build(geometries)
+        levels = simplify(topo)
+
+        summaries = []
+        index = 0
+        for table in tables:
+            key = layers.KEYS[table]
+            columns = ['geometry_z{}'.format(zoom) for zoom in ZOOMS]
+            staging = 'simplified_' + table
+            cur.execute('CREATE TEMPORARY TABLE {} ON COMMIT DROP AS SELECT {} FROM gm.{} WITH NO DATA;'.format(
+                staging, ', '.join(key + columns), table))
+            writer = bulk.CopyWriter(cur, staging, [(name, 'text') for name in key] +
+                                     [(name, 'geometry') for name in columns])
+            vertices = {zoom: 0 for zoom in ZOOMS}
+            for row in rows[table]:
+                simplified = []
+                for zoom in ZOOMS:
+                    geometry = topo.geometry(index, levels[zoom])
+                    vertices[zoom] += sum(len(ring) for polygon in topology.polygons(geometry) for ring in polygon)
+                    simplified.append(geometry if geometry['coordinates'] else None)
+                writer.write(tuple(row) + tuple(simplified))
+                index += 1
+            writer.close()
+            cur.execute('''
+            UPDATE gm.{table} AS t
+               SET {updates}
+              FROM {staging} AS s
+             WHERE {conditions};
+            '''.format(
+                table=table,
+                updates=', '.join('{0} = s.{0}'.format(name) for name in columns),
+                staging=staging,
+                conditions=' AND '.join('t.{0} = s.{0}'.format(name) for name in key),
+            ))
+            summaries.append({
+                'table': table,
+                'derived': '{} rows simplified ({})'.format(len(rows[table]), ', '.join(
+                    'z{}: {} vertices'.format(zoom, vertices[zoom]) for zoom in ZOOMS)),
+            })
+    conn.commit()
+    return summaries
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Store a simplified copy of every geometry per zoom level in '
+                                                 '`geometry_z<zoom>`, keeping shared boundaries consistent.')
+    parser.add_argument('groups', nargs='*', help='`states` and/or the states whose counties, districts and wards to '
+                                                  'simplify (default: all)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='number of worker processes, each with its own connection (default: CPU count)')
+    args = parser.parse_args()
+
+    conn = db.connect()
+    cur = conn.cursor()
+    create_columns(cur)
+    conn.commit()
+    selected = args.groups
+    if not selected:
+        cur.execute('SELECT state FROM gm.counties UNION SELECT state FROM gm.wards ORDER BY state;')
+        selected = ['states'] + [row[0] for row in cur.fetchall()]
+    cur.close()
+    conn.close()
+
+    tasks = {group: schedule.Task(simplify_group, (group,), []) for group in selected}
+    schedule.run(tasks, workers=args.workers, on_done=lambda group, summaries: [
+        print('{} gm.{}: {}'.format(group, summary['table'], summary['derived'])) for summary in summaries])
+
+
+if __name__ == '__main__':
+    main()
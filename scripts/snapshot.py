@@ -0,0 +1,204 @@
+import argparse
+import datetime
+import json
+import os
+import shutil
+
+import numpy as np
+
+import db
+import layers
+
+########################################################################################################################
+# Layout
+########################################################################################################################
+
+# Every ward vintage of a state is snapshotted to `<directory>/<state>-<year>/<version>/` as one `.npy` file per
+# column plus a `manifest.json`, so analysis processes open it with `np.load(..., mmap_mode='r')` and share its pages
+# through the OS cache instead of each querying and holding its own copy:
+#
+# - `names`: the dense ward index, sorted by name like the adjacency graphs (see `adjacency.py`)
+# - `county`, `assembly`, `senate`, `congressional`: int32 codes into the sorted labels listed in the manifest
+# - `area`, `perimeter`: float64 square miles and miles
+# - `votes-<race>-<year>-<total|democrat|republican>`: int32, one file per race of the vintage
+# - `populations-<year>-<column>`: int32, one file per population column and census year
+#
+# A rebuild writes a new version next to the old ones and then atomically replaces `CURRENT`, which names the version
+# readers should open, so a reader never sees a half-written snapshot. Older versions are pruned but, since unlinked
+# files stay readable while mapped, processes that still have them open are unaffected.
+
+FORMAT = 1
+
+DISTRICT_COLUMNS = ['county', 'assembly', 'senate', 'congressional']
+VOTE_COLUMNS = ['total', 'democrat', 'republican']
+POPULATION_COLUMNS = ['total', 'white', 'black', 'american_indian', 'asian', 'pacific_islander', 'hispanic']
+
+
+def vintage_directory(directory, state, year):
+    return os.path.join(directory, '{}-{}'.format(state, year))
+
+
+def load(directory, state, year):
+    # Returns the manifest and every column of the current version of a vintage, memory-mapped
+    path = vintage_directory(directory, state, year)
+    with open(os.path.join(path, 'CURRENT'), 'r') as current_file:
+        path = os.path.join(path, current_file.read().strip())
+    with open(os.path.join(path, 'manifest.json'), 'r') as manifest_file:
+        manifest = json.load(manifest_file)
+    if manifest['format'] != FORMAT:
+        raise ValueError('Unsupported snapshot format {} in {}'.format(manifest['format'], path))
+    return manifest, {name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+                      for name in manifest['columns']}
+
+########################################################################################################################
+# Writer
+########################################################################################################################
+
+def write_vintage(directory, state, year, wards, votes, populations, keep=2):
+    # `wards` are (name, county, assembly, senate, congressional, area, perimeter) rows sorted by name, `votes`
+    # (race, year, ward, total, democrat, republican) and `populations` (year, ward, *POPULATION_COLUMNS)
+    names = [row[0] for row in wards]
+    index = {name: position for position, name in enumerate(names)}
+    columns = {'names': np.asarray(names, dtype=str)}
+    labels = {}
+    for position, column in enumerate(DISTRICT_COLUMNS, start=1):
+        labels[column], codes = np.unique(np.asarray([row[position] for row in wards], dtype=str), return_inverse=True)
+        columns[column] = codes.reshape(-1).astype(np.int32)
+    columns['area'] = np.array([row[5] or 0.0 for row in wards], dtype=np.float64)
+    columns['perimeter'] = np.array([row[6] or 0.0 for row in wards], dtype=np.float64)
+
+    races = sorted({(race, race_year) for race, race_year, _, _, _, _ in votes})
+    for race, race_year in races:
+        for column in VOTE_COLUMNS:
+            columns['votes-{}-{}-{}'.format(layers.sanitize(race), race_year, column)] = np.zeros(len(names), np.int32)
+    for race, race_year, ward, *counts in votes:
+        if ward in index:
+            for column, count in zip(VOTE_COLUMNS, counts):
+                columns['votes-{}-{}-{}'.format(layers.sanitize(race), race_year, column)][index[ward]] = count
+
+    population_years = sorted({row[0] for row in populations})
+    for population_year in population_years:
+        for column in POPULATION_COLUMNS:
+            columns['populations-{}-{}'.format(population_year, column)] = np.zeros(len(names), np.int32)
+    for population_year, ward, *counts in populations:
+        if ward in index:
+            for column, count in zip(POPULATION_COLUMNS, counts):
+                columns['populations-{}-{}'.format(population_year, column)][index[ward]] = count
+
+    path = vintage_directory(directory, state, year)
+    os.makedirs(path, exist_ok=True)
+    versions = sorted(int(name) for name in os.listdir(path) if name.isdigit())
+    version = '{:06d}'.format(versions[-1] + 1 if versions else 1)
+    os.makedirs(os.path.join(path, version))
+    for name, values in columns.items():
+        np.save(os.path.join(path, version, name + '.npy'), values)
+    with open(os.path.join(path, version, 'manifest.json'), 'w') as manifest_file:
+        json.dump({
+            'format': FORMAT,
+            'state': state,
+            'year': year,
+            'version': version,
+            'created': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'wards': len(names),
+            'labels': {column: [str(label) for label in values] for column, values in labels.items()},
+            'races': [{'race': race, 'year': race_year, 'columns': {
+                column: 'votes-{}-{}-{}'.format(layers.sanitize(race), race_year, column) for column in VOTE_COLUMNS
+            }} for race, race_year in races],
+            'populations': [{'year': population_year, 'columns': {
+                column: 'populations-{}-{}'.format(population_year, column) for column in POPULATION_COLUMNS
+            }} for population_year in population_years],
+            'columns': {name: values.dtype.str for name, values in columns.items()},
+        }, manifest_file, indent=2)
+
+    with open(os.path.join(path, 'CURRENT.tmp'), 'w') as current_file:
+        current_file.write(version)
+    os.replace(os.path.join(path, 'CURRENT.tmp'), os.path.join(path, 'CURRENT'))
+    for old in versions[:max(len(versions) + 1 - keep, 0)]:
+        shutil.rmtree(os.path.join(path, '{:06d}'.format(old)))
+    return version
+
+########################################################################################################################
+# Snapshot Stage
+########################################################################################################################
+
+# Rebuilds every ward vintage of a state whose wards, votes or populations changed; vintages that no longer have any
+# wards are removed.
+
+def states(summaries):
+    return sorted({key.split('/')[0] for summary in summaries if summary['table'] in ['wards', 'votes', 'populations']
+                   for key in summary['changed'] + summary['deleted']})
+
+
+def build_state(state, directory):
+    conn = db.connection()
+    with conn.cursor() as cur:
+        cur.execute('''
+        SELECT year,
+               name,
+               county,
+               assembly,
+               senate,
+               congressional,
+               area,
+               perimeter
+
+          FROM gm.wards
+
+         WHERE state = %s
+
+         ORDER BY year,
+                  name;
+        ''', (state,))
+        years = {}
+        for year, *row in cur.fetchall():
+            years.setdefault(year, {'wards': [], 'votes': [], 'populations': []})['wards'].append(row)
+
+        cur.execute('SELECT ward_year, race, year, ward, {} FROM gm.votes WHERE state = %s;'.format(
+            ', '.join(VOTE_COLUMNS)), (state,))
+        for ward_year, *row in cur.fetchall():
+            if ward_year in years:
+                years[ward_year]['votes'].append(row)
+
+        cur.execute('SELECT ward_year, year, ward, {} FROM gm.populations WHERE state = %s;'.format(
+            ', '.join(POPULATION_COLUMNS)), (state,))
+        for ward_year, *row in cur.fetchall():
+            if ward_year in years:
+                years[ward_year]['populations'].append(row)
+    conn.commit()
+
+    if os.path.isdir(directory):
+        for name in os.listdir(directory):
+            year = name[len(state) + 1:]
+            if name.startswith(state + '-') and year.isdigit() and year not in years:
+                shutil.rmtree(os.path.join(directory, name))
+
+    written = []
+    for year, rows in years.items():
+        version = write_vintage(directory, state, year, rows['wards'], rows['votes'], rows['populations'])
+        written.append('{} v{} ({} wards)'.format(year, int(version), len(rows['wards'])))
+    return [{'table': 'snapshot', 'path': directory, 'derived': ', '.join(written) or 'no wards'}]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Write a memory-mappable columnar snapshot of every ward vintage, '
+                                                 'with its votes and populations.')
+    parser.add_argument('states', nargs='*', help='states to snapshot (default: all)')
+    parser.add_argument('--output', default='snapshot', help='directory of the snapshots (default: snapshot)')
+    args = parser.parse_args()
+
+    conn = db.connect()
+    cur = conn.cursor()
+    selected = args.states
+    if not selected:
+        cur.execute('SELECT DISTINCT state FROM gm.wards ORDER BY state;')
+        selected = [row[0] for row in cur.fetchall()]
+    cur.close()
+    conn.close()
+
+    for state in selected:
+        for summary in build_state(state, args.output):
+            print('{} {}: {}'.format(state, summary['path'], summary['derived']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,201 @@
+import numpy as np
+
+import metrics
+
+########################################################################################################################
+# Bounding Boxes
+########################################################################################################################
+
+# Boxes are (n, 4) arrays of `[min_x, min_y, max_x, max_y]`.
+
+def bounds(geometries):
+    coordinates, edge_ring, ring_geometry, _ = metrics.flatten(geometries)
+    boxes = np.full((len(geometries), 4), np.nan)
+    if len(coordinates):
+        # The closing vertex of a ring (`edge_ring` -1) repeats its first vertex and belongs to the same ring
+        vertex_geometry = ring_geometry[np.maximum.accumulate(np.where(edge_ring >= 0, edge_ring, 0))]
+        for column, (reduce, axis) in enumerate([(np.fmin, 0), (np.fmin, 1), (np.fmax, 0), (np.fmax, 1)]):
+            reduce.at(boxes[:, column], vertex_geometry, coordinates[:, axis])
+    return boxes
+
+
+def intersects(first, second):
+    return ((first[:, 0] <= second[:, 2]) & (second[:, 0] <= first[:, 2]) &
+            (first[:, 1] <= second[:, 3]) & (second[:, 1] <= first[:, 3]))
+
+########################################################################################################################
+# STR-Tree
+########################################################################################################################
+
+# A static R-tree bulk loaded with Sort-Tile-Recursive: items are sorted into vertical slices by the x of their centers,
+# each slice by y, and packed `node_capacity` at a time into leaves; every upper level packs consecutive nodes of the
+# level below, which STR has already laid out spatially. `levels[0]` holds the item boxes in leaf order (`order` maps
+# them back to item indexes) and `levels[-1]` the root, each as a (4, n) array of box columns padded to a multiple of
+# `node_capacity` with empty boxes, so the children of node i are always `i * node_capacity` onwards. A query walks a
+# chunk of its boxes down the tree together, testing all children of every visited node in one broadcast per level.
+
+EMPTY = [np.inf, np.inf, -np.inf, -np.inf]
+
+
+class STRtree:
+
+    def __init__(self, boxes, node_capacity=16, levels=None, order=None):
+        self.node_capacity = node_capacity
+        if levels is not None:
+            self.levels = levels
+            self.order = order
+            return
+
+        boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        count = len(boxes)
+        centers = (boxes[:, :2] + boxes[:, 2:]) / 2
+        leaves = -(-count // node_capacity)
+        slices = max(int(np.ceil(np.sqrt(leaves))), 1)
+        by_x = np.argsort(centers[:, 0], kind='stable')
+        slice_ids = np.empty(count, dtype=np.int64)
+        slice_ids[by_x] = np.arange(count) // (slices * node_capacity)
+        self.order = np.lexsort((centers[:, 1], slice_ids))
+        self.levels = [self.pad(boxes[self.order])]
+        while self.levels[-1].shape[1] > node_capacity:
+            self.levels.append(self.pad(self.pack(self.levels[-1])))
+
+    def pad(self, boxes):
+        # (n, 4) boxes -> (4, n') columns, n' the next multiple of `node_capacity`
+        padded = np.empty((4, max(-(-len(boxes) // self.node_capacity), 1) * self.node_capacity))
+        padded[:] = np.array(EMPTY)[:, None]
+        padded[:, :len(boxes)] = boxes.T
+        return padded
+
+    def pack(self, columns):
+        groups = columns.reshape(4, -1, self.node_capacity)
+        return np.stack([groups[0].min(axis=1), groups[1].min(axis=1), groups[2].max(axis=1), groups[3].max(axis=1)],
+                        axis=1)
+
+    def query(self, boxes, chunk_size=1 << 12):
+        # Every (query, item) pair whose boxes intersect, as two arrays sorted by query
+        boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        results = [self.query_chunk(boxes[start:start + chunk_size], start)
+                   for start in range(0, len(boxes), chunk_size)]
+        if not results:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        return np.concatenate([queries for queries, _ in results]), np.concatenate([items for _, items in results])
+
+    def query_chunk(self, boxes, offset):
+        queries = np.arange(len(boxes))
+        nodes = np.zeros(len(boxes), dtype=np.int64)
+        children = np.arange(self.node_capacity)
+        for columns in reversed(self.levels):
+            candidates = nodes[:, None] * self.node_capacity + children
+            box = boxes[queries]
+            hits = ((columns[0][candidates] <= box[:, 2:3]) & (columns[2][candidates] >= box[:, 0:1]) &
+                    (columns[1][candidates] <= box[:, 3:4]) & (columns[3][candidates] >= box[:, 1:2]))
+            rows, positions = np.nonzero(hits)
+            queries, nodes = queries[rows], candidates[rows, positions]
+        return queries + offset, self.order[nodes]
+
+    def query_points(self, points):
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        return self.query(np.hstack([points, points]))
+
+    def arrays(self):
+        # Flat arrays for `np.savez`; `from_arrays` rebuilds the tree from them (or from memory-mapped copies)
+        return {
+            'tree_columns': np.concatenate(self.levels, axis=1),
+            'tree_level_sizes': np.array([level.shape[1] for level in self.levels], dtype=np.int64),
+            'tree_order': self.order,
+            'tree_node_capacity': np.array(self.node_capacity),
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        offsets = np.r_[0, np.cumsum(arrays['tree_level_sizes'])]
+        levels = [arrays['tree_columns'][:, start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+        return cls(None, node_capacity=int(arrays['tree_node_capacity']), levels=levels, order=arrays['tree_order'])
+
+########################################################################################################################
+# Point in Polygon
+########################################################################################################################
+
+# Even-odd ray casting against every ring edge of a geometry, so holes and multipolygons need no special handling. Each
+# geometry's edges are bucketed into horizontal bands of its bounding box, about `edges_per_band` edges to a band (an
+# edge is listed in every band it spans), and a point is only tested against the edges of its band. Points exactly on
+# a boundary may go either way.
+
+
+class EdgeIndex:
+
+    def __init__(self, geometries, edges_per_band=8):
+        coordinates, edge_ring, ring_geometry, _ = metrics.flatten(geometries)
+        edges = np.flatnonzero(edge_ring >= 0)
+        self.start = coordinates[edges]
+        self.end = coordinates[edges + 1]
+        geometry = ring_geometry[edge_ring[edges]]
+        self.boxes = bounds(geometries)
+
+        edge_counts = np.bincount(geometry, minlength=len(geometries))
+        self.bands = np.maximum(edge_counts // edges_per_band, 1)
+        self.band_offsets = np.r_[0, np.cumsum(self.bands)]
+        low = self.band(geometry, np.minimum(self.start[:, 1], self.end[:, 1]))
+        high = self.band(geometry, np.maximum(self.start[:, 1], self.end[:, 1]))
+        spans = high - low + 1
+        band_ids = np.repeat(low - np.cumsum(spans) + spans, spans) + np.arange(spans.sum())
+        band_edges = np.repeat(np.arange(len(edges)), spans)
+        sort = np.argsort(band_ids, kind='stable')
+        self.edges = band_edges[sort]
+        self.indptr = np.r_[0, np.cumsum(np.bincount(band_ids, minlength=self.band_offsets[-1]))]
+
+    def arrays(self):
+        # Flat arrays for `np.save`/`np.savez`, like `STRtree.arrays()`
+        return {
+            'edge_start': self.start,
+            'edge_end': self.end,
+            'edge_boxes': self.boxes,
+            'edge_bands': self.bands,
+            'edge_band_offsets': self.band_offsets,
+            'edge_ids': self.edges,
+            'edge_indptr': self.indptr,
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        index = cls.__new__(cls)
+        index.start, index.end, index.boxes = arrays['edge_start'], arrays['edge_end'], arrays['edge_boxes']
+        index.bands, index.band_offsets = arrays['edge_bands'], arrays['edge_band_offsets']
+        index.edges, index.indptr = arrays['edge_ids'], arrays['edge_indptr']
+        return index
+
+    def band(self, geometry, y):
+        # Global band id of `y` within `geometry`'s bounding box, clipped to its bands
+        low, high = self.boxes[geometry, 1], self.boxes[geometry, 3]
+        height = np.where(high > low, high - low, 1.0)
+        local = np.clip(((y - low) / height * self.bands[geometry]).astype(np.int64), 0, self.bands[geometry] - 1)
+        return self.band_offsets[geometry] + local
+
+    def contains(self, points, geometry, chunk_size=1 << 22):
+        # Whether `points[i]` is inside `geometry[i]`, for every i
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        geometry = np.asarray(geometry, dtype=np.int64)
+        inside = np.zeros(len(points), dtype=bool)
+        box = self.boxes[geometry]
+        candidates = np.flatnonzero((points[:, 0] >= box[:, 0]) & (points[:, 0] <= box[:, 2]) &
+                                    (points[:, 1] >= box[:, 1]) & (points[:, 1] <= box[:, 3]))
+        bands = self.band(geometry[candidates], points[candidates, 1])
+        counts = self.indptr[bands + 1] - self.indptr[bands]
+
+        # Chunks of candidates whose edge tests fit in `chunk_size`
+        step = max(chunk_size // max(counts.max(initial=0), 1), 1)
+        for first in range(0, len(candidates), step):
+            last = first + step
+            chunk = candidates[first:last]
+            chunk_counts = counts[first:last]
+            starts = self.indptr[bands[first:last]]
+            pairs = np.repeat(np.arange(len(chunk)), chunk_counts)
+            edges = self.edges[np.repeat(starts - np.cumsum(chunk_counts) + chunk_counts, chunk_counts) +
+                               np.arange(chunk_counts.sum())]
+            x, y = points[chunk[pairs], 0], points[chunk[pairs], 1]
+            (x0, y0), (x1, y1) = self.start[edges].T, self.end[edges].T
+            straddles = (y0 > y) != (y1 > y)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                crosses = straddles & (x < x0 + (y - y0) * (x1 - x0) / (y1 - y0))
+            inside[chunk] = np.bincount(pairs[crosses], minlength=len(chunk)) % 2 == 1
+        return inside
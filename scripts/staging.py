@@ -0,0 +1,113 @@
+import argparse
+
+import db
+
+########################################################################################################################
+# Staging Schemas
+########################################################################################################################
+
+# A staged ingest builds the whole dataset, with its indexes and statistics, in `gm_staging` while the API keeps reading
+# `gm`, then swaps it in with one short transaction that moves every relation built in `gm_staging` into `gm` and the
+# relations they replace into `gm_previous` (`ALTER ... SET SCHEMA` only updates the catalog, so no data is copied). The
+# previous version stays there until the next staged ingest, so `rollback()` can swap it back just as quickly.
+#
+# Only relations are moved: PostGIS and its `spatial_ref_sys` stay in `gm`, and indexes, sequences and partitions'
+# bounds follow their tables. Both schemas are created by `setup.sh`, with the same privileges as `gm`.
+
+STAGING = 'gm_staging'
+PREVIOUS = 'gm_previous'
+
+# Readers wait behind a swap that waits for a lock, so rather than queueing them indefinitely a swap that cannot get its
+# locks quickly fails and can be retried
+LOCK_TIMEOUT = '5s'
+
+RELATION_KINDS = {
+    'r': 'TABLE',
+    'p': 'TABLE',
+    'v': 'VIEW',
+    'm': 'MATERIALIZED VIEW',
+}
+
+
+def relations(cur, schema):
+    # Name and `ALTER` keyword of every relation of `schema`, parents before partitions
+    cur.execute('''
+    SELECT c.relname,
+           c.relkind
+
+      FROM pg_class AS c
+
+           JOIN pg_namespace AS n
+           ON c.relnamespace = n.oid
+
+     WHERE n.nspname = %s
+       AND c.relkind IN ('r', 'p', 'v', 'm')
+
+     ORDER BY c.relispartition,
+              c.relname;
+    ''', (schema,))
+    return [(name, RELATION_KINDS[kind]) for name, kind in cur.fetchall()]
+
+
+def clear(cur, schema):
+    for name, kind in relations(cur, schema):
+        cur.execute('DROP {} IF EXISTS {}.{} CASCADE;'.format(kind, schema, name))
+
+
+def analyze(cur, schema):
+    names = [name for name, kind in relations(cur, schema) if kind == 'TABLE']
+    for name in names:
+        cur.execute('ANALYZE {}.{};'.format(schema, name))
+    return len(names)
+
+
+def move(cur, source, target, exchange=None):
+    # Moves every relation of `source` into `target`; a relation of the same name already in `target` is moved into
+    # `exchange` first
+    moved = relations(cur, source)
+    existing = {name: kind for name, kind in relations(cur, target)}
+    for name, kind in moved:
+        if name in existing:
+            cur.execute('ALTER {} {}.{} SET SCHEMA {};'.format(existing[name], target, name, exchange))
+    for name, kind in moved:
+        cur.execute('ALTER {} {}.{} SET SCHEMA {};'.format(kind, source, name, target))
+    return len(moved)
+
+
+def swap(conn):
+    # `gm_staging` -> `gm` -> `gm_previous`, keeping whatever the staged build did not replace in `gm`
+    with conn.cursor() as cur:
+        clear(cur, PREVIOUS)
+        conn.commit()
+        cur.execute("SET LOCAL lock_timeout = '{}';".format(LOCK_TIMEOUT))
+        count = move(cur, STAGING, db.SCHEMA, exchange=PREVIOUS)
+    conn.commit()
+    return count
+
+
+def rollback(conn):
+    # `gm_previous` <-> `gm`, through the empty `gm_staging`, so rolling back twice restores the swapped-in version
+    with conn.cursor() as cur:
+        clear(cur, STAGING)
+        conn.commit()
+        cur.execute("SET LOCAL lock_timeout = '{}';".format(LOCK_TIMEOUT))
+        count = move(cur, PREVIOUS, db.SCHEMA, exchange=STAGING)
+        move(cur, STAGING, PREVIOUS)
+    conn.commit()
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Swap the previous version of the gm schema kept by a staged ingest '
+                                                 '(`ingest.py --staging`) back in; running it again undoes the '
+                                                 'rollback.')
+    parser.parse_args()
+
+    conn = db.connect()
+    count = rollback(conn)
+    conn.close()
+    print('{} relations swapped back from {}'.format(count, PREVIOUS))
+
+
+if __name__ == '__main__':
+    main()
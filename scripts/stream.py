@@ -0,0 +1,317 @@
+import argparse
+import csv
+import json
+import os
+import shutil
+import sys
+import time
+
+import psycopg2
+
+import bulk
+import db
+import layers
+import partitions
+import rollups
+import surrogate
+
+########################################################################################################################
+# Records
+########################################################################################################################
+
+# On election night ward returns arrive in small batches every few minutes, far too often for a full ingest. A batch is
+# a file of ward-level result records dropped into a watched directory: CSV with a header, or JSON Lines, with the
+# fields below. `state`, `county` and `ward` are the raw names and are sanitized into the ward key exactly like the
+# GeoJSON properties (see `layers.load_wards()`); `race` and `year` are the race name and election year of the API.
+# Producers write a file under a name starting with `.` or ending with `.tmp` and rename it into place, so a batch is
+# never read half-written. Batches are processed in arrival (modification time) order.
+
+FIELDS = ['state', 'race', 'year', 'ward_year', 'county', 'ward', 'total', 'democrat', 'republican']
+SUFFIXES = ('.csv', '.jsonl')
+
+
+def read_records(path):
+    with open(path, 'r', newline='') as records_file:
+        if path.endswith('.csv'):
+            yield from csv.DictReader(records_file)
+        else:
+            for line in records_file:
+                if line.strip():
+                    record = json.loads(line)
+                    if not isinstance(record, dict):
+                        raise ValueError('record is not an object: {}'.format(line.strip()))
+                    yield record
+
+
+def vote_row(record):
+    # A `gm.votes` row (see `layers.COLUMNS`)
+    missing = [field for field in FIELDS if record.get(field) in [None, '']]
+    if missing:
+        raise ValueError('record is missing {}: {}'.format(', '.join(missing), record))
+    state = layers.sanitize(record['state'])
+    county = layers.sanitize(record['county'])
+    return (
+        state,
+        str(record['race']),
+        str(record['year']),
+        str(record['ward_year']),
+        county + '_' + layers.sanitize(record['ward']),
+        int(record['total']),
+        int(record['democrat']),
+        int(record['republican']),
+    )
+
+
+def pending(directory):
+    batches = []
+    for entry in os.scandir(directory):
+        if entry.is_file() and entry.name.endswith(SUFFIXES) and not entry.name.startswith('.'):
+            batches.append((entry.stat().st_mtime, entry.name, entry.path))
+    return sorted(batches)
+
+########################################################################################################################
+# Upserts
+########################################################################################################################
+
+# Every batch is applied in its own short transaction: the records are copied into a temporary table, joined to their
+# wards (records of unknown wards are rejected) and to their current votes, upserted into `gm.votes` (or, with
+# surrogate keys, `gm.vote_facts`) and the difference is added to the rollups (see `rollups.apply_deltas()`). Readers
+# are never blocked: they see the previous counts until the commit and the new ones, in votes and rollups alike, right
+# after it. The previous counts are read before the upsert, so concurrent streams are serialized by an advisory lock;
+# a record that is applied again (e.g. after a crash before its file was moved) leaves nothing to add.
+#
+# Snapshots and other derived artifacts are not refreshed; they catch up with the next ingest. The next incremental
+# ingest of an unchanged GeoJSON file keeps the streamed counts, while a full or staged ingest replaces them.
+
+LOCK = 0x676d5354
+
+STAGING_SQL = '''
+CREATE TEMPORARY TABLE stream_votes (
+    state      VARCHAR,
+    race       VARCHAR,
+    year       CHAR(4),
+    ward_year  CHAR(4),
+    ward       VARCHAR,
+    total      INTEGER,
+    democrat   INTEGER,
+    republican INTEGER
+) ON COMMIT DROP;
+'''
+
+CHANGES_SQL = '''
+CREATE TEMPORARY TABLE stream_changes ON COMMIT DROP AS
+SELECT s.state,
+       s.race,
+       s.year,
+       s.ward_year,
+       s.ward,
+       wrd.county,
+       wrd.assembly,
+       wrd.senate,
+       wrd.congressional,
+       s.total,
+       s.democrat,
+       s.republican,
+       COALESCE(vt.total, 0) AS previous_total,
+       COALESCE(vt.democrat, 0) AS previous_democrat,
+       COALESCE(vt.republican, 0) AS previous_republican
+
+  FROM stream_votes AS s
+
+       JOIN gm.wards AS wrd
+       ON s.state = wrd.state
+          AND s.ward_year = wrd.year
+          AND s.ward = wrd.name
+
+       LEFT JOIN gm.votes AS vt
+       ON s.state = vt.state
+          AND s.race = vt.race
+          AND s.year = vt.year
+          AND s.ward_year = vt.ward_year
+          AND s.ward = vt.ward
+
+ WHERE vt.ward IS NULL
+    OR (s.total, s.democrat, s.republican) IS DISTINCT FROM (vt.total, vt.democrat, vt.republican);
+'''
+
+UPSERT_SQL = '''
+INSERT INTO gm.votes (state, race, year, ward_year, ward, total, democrat, republican)
+     SELECT state,
+            race,
+            year,
+            ward_year,
+            ward,
+            total,
+            democrat,
+            republican
+
+       FROM stream_changes
+
+         ON CONFLICT (state, race, year, ward_year, ward)
+         DO UPDATE SET total = EXCLUDED.total,
+                       democrat = EXCLUDED.democrat,
+                       republican = EXCLUDED.republican;
+'''
+
+# With surrogate keys `gm.votes` is a view (see `surrogate.py`), so the facts are upserted by id, after registering
+# any race that is new
+SURROGATE_UPSERT_SQL = [
+    '''
+    INSERT INTO gm.races (race, year)
+         SELECT DISTINCT race,
+                         year
+
+           FROM stream_changes
+
+             ON CONFLICT (race, year)
+             DO NOTHING;
+    ''',
+    '''
+    INSERT INTO gm.vote_facts (race_id, ward_id, total, democrat, republican)
+         SELECT rc.id,
+                wrd.id,
+                ch.total,
+                ch.democrat,
+                ch.republican
+
+           FROM stream_changes AS ch
+
+                JOIN gm.races AS rc
+                ON ch.race = rc.race
+                   AND ch.year = rc.year
+
+                JOIN gm.wards AS wrd
+                ON ch.state = wrd.state
+                   AND ch.ward_year = wrd.year
+                   AND ch.ward = wrd.name
+
+             ON CONFLICT (race_id, ward_id)
+             DO UPDATE SET total = EXCLUDED.total,
+                           democrat = EXCLUDED.democrat,
+                           republican = EXCLUDED.republican;
+    ''',
+]
+
+
+class Stream:
+
+    def __init__(self, conn):
+        self.conn = conn
+        with conn.cursor() as cur:
+            kind = surrogate.relation_kind(cur, 'votes')
+            if kind is None:
+                raise ValueError('gm.votes does not exist; run a full ingest first')
+            self.surrogate_keys = kind == 'VIEW'
+            self.partitioned = not self.surrogate_keys and partitions.is_partitioned(cur, 'votes')
+        conn.commit()
+        self.partitions = set()
+
+    def apply(self, rows):
+        # Upserts the rows in one transaction, returning the number of records that were (changed, unchanged, of
+        # unknown wards) and of rollup rows adjusted
+        rows = list({row[:5]: row for row in rows}.values())
+        created = set()
+        try:
+            with self.conn.cursor() as cur:
+                cur.execute('SELECT pg_advisory_xact_lock(%s);', (LOCK,))
+                cur.execute(STAGING_SQL)
+                staging = bulk.CopyWriter(cur, 'stream_votes', layers.COLUMNS['votes'], batch_size=len(rows) + 1)
+                for row in rows:
+                    staging.write(row)
+                staging.close()
+                cur.execute('SELECT COUNT(*) FROM stream_votes AS s JOIN gm.wards AS wrd ON s.state = wrd.state '
+                            'AND s.ward_year = wrd.year AND s.ward = wrd.name;')
+                known = cur.fetchone()[0]
+                cur.execute(CHANGES_SQL)
+                changed = cur.rowcount
+
+                if self.partitioned:
+                    keys = {(row[0], row[2]) for row in rows} - self.partitions
+                    if keys:
+                        # Only for the first results of a (state, year), as attaching a partition locks the table
+                        partitions.create_partitions(cur, {'votes': sorted(keys), 'populations': []}, load=False)
+                        created = keys
+                for query in SURROGATE_UPSERT_SQL if self.surrogate_keys else [UPSERT_SQL]:
+                    cur.execute(query)
+                adjusted = rollups.apply_deltas(cur, 'stream_changes') if changed else 0
+            self.conn.commit()
+        except BaseException:
+            self.conn.rollback()
+            raise
+        # Only once committed, as a rollback drops the partitions again
+        self.partitions.update(created)
+        return changed, known - changed, len(rows) - known, adjusted
+
+########################################################################################################################
+# Watcher
+########################################################################################################################
+
+# Polls the directory for batches (a poll is one `scandir`, so a short interval is cheap) and applies every batch in
+# transactions of at most `batch_size` records. A batch that was applied is moved to `done/`; one that cannot be
+# (unreadable records, or values the database rejects) is moved to `failed/` and the stream goes on. Any other error,
+# such as a lost connection, stops the stream with the batch left in place, to be applied again on restart.
+
+FILE_ERRORS = (ValueError, csv.Error, psycopg2.DataError, psycopg2.IntegrityError)
+
+
+def chunks(rows, size):
+    for start in range(0, len(rows), size):
+        yield rows[start:start + size]
+
+
+def move(path, subdirectory):
+    directory = os.path.join(os.path.dirname(path), subdirectory)
+    os.makedirs(directory, exist_ok=True)
+    shutil.move(path, os.path.join(directory, os.path.basename(path)))
+
+
+def process(stream, path, arrived, batch_size):
+    name = os.path.basename(path)
+    try:
+        rows = [vote_row(record) for record in read_records(path)]
+        counts = [0, 0, 0, 0]
+        for chunk in chunks(rows, batch_size):
+            counts = [total + count for total, count in zip(counts, stream.apply(chunk))]
+    except FILE_ERRORS as error:
+        move(path, 'failed')
+        print('{}: failed, moved to failed/: {}'.format(name, str(error).strip()), file=sys.stderr)
+        return False
+    move(path, 'done')
+    changed, unchanged, unknown, adjusted = counts
+    print('{}: {} records, {} changed, {} unchanged, {} of unknown wards, {} rollup rows, visible {:.2f} s after '
+          'arrival'.format(name, len(rows), changed, unchanged, unknown, adjusted, time.time() - arrived),
+          file=sys.stderr)
+    return True
+
+
+def watch(directory, interval=0.5, batch_size=1000, once=False):
+    stream = Stream(db.connect())
+    while True:
+        batches = pending(directory)
+        for arrived, _, path in batches:
+            process(stream, path, arrived, batch_size)
+        if once:
+            return
+        if not batches:
+            time.sleep(interval)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stream ward-level election results from batch files dropped into '
+                                                 'a directory into gm.votes, updating the vote rollups in place.')
+    parser.add_argument('directory', help='directory to watch for .csv and .jsonl batches')
+    parser.add_argument('--interval', type=float, default=0.5, help='seconds between polls (default: 0.5)')
+    parser.add_argument('--batch-size', type=int, default=1000,
+                        help='maximum records per transaction (default: 1000)')
+    parser.add_argument('--once', action='store_true', help='apply the pending batches and exit instead of watching')
+    args = parser.parse_args()
+
+    os.makedirs(args.directory, exist_ok=True)
+    try:
+        watch(args.directory, args.interval, args.batch_size, args.once)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,266 @@
+import bulk
+import db
+
+########################################################################################################################
+# Surrogate Key Schema
+########################################################################################################################
+
+# With `surrogate_keys` every geometry table gets a compact integer `id`, every (race, year) pair an id in `gm.races`,
+# and the vote and population facts are stored in `gm.vote_facts` and `gm.population_facts` keyed by those ids instead
+# of by repeated `state`/`race`/`year`/`ward_year`/`ward` VARCHARs. `gm.votes` and `gm.populations` become views that
+# resolve the ids back to names, with exactly the columns of the tables they replace, so the URI-style names of the API
+# and every reader of those tables keep working unchanged.
+
+DIMENSION_TABLES = ['states', 'counties', 'assemblies', 'senates', 'congressionals', 'wards']
+
+FACT_TABLES = {
+    'votes': 'vote_facts',
+    'populations': 'population_facts',
+}
+
+TABLES_SQL = {
+    'races': '''
+CREATE TABLE IF NOT EXISTS gm.races (
+    id   SMALLINT GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+    race VARCHAR  NOT NULL,
+    year CHAR(4)  NOT NULL,
+
+         UNIQUE (race, year)
+);
+''',
+    'vote_facts': '''
+CREATE TABLE IF NOT EXISTS gm.vote_facts (
+    race_id         SMALLINT NOT NULL,
+
+                    FOREIGN KEY (race_id)
+                     REFERENCES gm.races(id),
+
+    ward_id         INTEGER  NOT NULL,
+
+                    FOREIGN KEY (ward_id)
+                     REFERENCES gm.wards(id),
+
+                    PRIMARY KEY (race_id, ward_id),
+
+    total           INTEGER  NOT NULL,
+    democrat        INTEGER  NOT NULL,
+    republican      INTEGER  NOT NULL,
+
+    competitiveness REAL GENERATED ALWAYS AS (CASE
+                                                WHEN democrat + republican > 0
+                                                  THEN ((democrat::REAL / (democrat + republican)) - 0.5) / 0.5
+                                                ELSE 0
+                                              END) STORED
+);
+''',
+    'population_facts': '''
+CREATE TABLE IF NOT EXISTS gm.population_facts (
+    year             CHAR(4) NOT NULL,
+    ward_id          INTEGER NOT NULL,
+
+                     FOREIGN KEY (ward_id)
+                      REFERENCES gm.wards(id),
+
+                     PRIMARY KEY (year, ward_id),
+
+    total            INTEGER NOT NULL,
+    white            INTEGER NOT NULL,
+    black            INTEGER NOT NULL,
+    american_indian  INTEGER NOT NULL,
+    asian            INTEGER NOT NULL,
+    pacific_islander INTEGER NOT NULL,
+    hispanic         INTEGER NOT NULL
+);
+''',
+}
+
+VIEWS_SQL = {
+    'votes': '''
+CREATE OR REPLACE VIEW gm.votes AS
+SELECT wrd.state AS state,
+       rc.race AS race,
+       rc.year AS year,
+       wrd.year AS ward_year,
+       wrd.name AS ward,
+       vf.total AS total,
+       vf.democrat AS democrat,
+       vf.republican AS republican,
+       vf.competitiveness AS competitiveness
+
+  FROM gm.vote_facts AS vf
+
+       JOIN gm.races AS rc
+       ON vf.race_id = rc.id
+
+       JOIN gm.wards AS wrd
+       ON vf.ward_id = wrd.id;
+''',
+    'populations': '''
+CREATE OR REPLACE VIEW gm.populations AS
+SELECT wrd.state AS state,
+       pf.year AS year,
+       wrd.year AS ward_year,
+       wrd.name AS ward,
+       pf.total AS total,
+       pf.white AS white,
+       pf.black AS black,
+       pf.american_indian AS american_indian,
+       pf.asian AS asian,
+       pf.pacific_islander AS pacific_islander,
+       pf.hispanic AS hispanic
+
+  FROM gm.population_facts AS pf
+
+       JOIN gm.wards AS wrd
+       ON pf.ward_id = wrd.id;
+''',
+}
+
+# The primary keys lead with the race or census year, which every query filters on; the ward indexes serve joins from
+# `gm.wards` and the foreign key checks of ward deletes.
+INDEXES_SQL = {
+    'votes': [
+        'CREATE INDEX IF NOT EXISTS vote_facts_ward_id_fkey ON gm.vote_facts(ward_id);',
+    ],
+    'populations': [
+        'CREATE INDEX IF NOT EXISTS population_facts_ward_id_fkey ON gm.population_facts(ward_id);',
+    ],
+}
+
+
+def relation_kind(cur, name):
+    # 'BASE TABLE', 'VIEW' or None
+    cur.execute('SELECT table_type FROM information_schema.tables WHERE table_schema = %s AND table_name = %s;',
+                (db.schema(), name))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def drop_relation(cur, name):
+    kind = relation_kind(cur, name)
+    if kind == 'VIEW':
+        cur.execute('DROP VIEW gm.{} CASCADE;'.format(name))
+    elif kind is not None:
+        cur.execute('DROP TABLE gm.{} CASCADE;'.format(name))
+
+
+def create_ids(cur, table):
+    cur.execute('ALTER TABLE gm.{} ADD COLUMN IF NOT EXISTS id INTEGER GENERATED ALWAYS AS IDENTITY;'.format(table))
+    cur.execute('CREATE UNIQUE INDEX IF NOT EXISTS {0}_id_idx ON gm.{0}(id);'.format(table))
+
+
+def drop_tables(cur):
+    for name in ['population_facts', 'vote_facts', 'races']:
+        drop_relation(cur, name)
+
+
+def create_tables(cur, drop):
+    # Called by `layers.create_tables` after the dimension tables exist, in place of creating `gm.votes` and
+    # `gm.populations`
+    if drop:
+        drop_tables(cur)
+    for table in DIMENSION_TABLES:
+        create_ids(cur, table)
+    for name in ['races', 'vote_facts', 'population_facts']:
+        cur.execute(TABLES_SQL[name])
+    for table in FACT_TABLES:
+        if relation_kind(cur, table) == 'BASE TABLE':
+            drop_relation(cur, table)
+        cur.execute(VIEWS_SQL[table])
+
+
+def insert_races(cur, state_sources):
+    # Races are known up front from the sources, so their ids exist before any load task resolves them and concurrent
+    # tasks never race to create the same one
+    races = sorted({(race, year['year']) for sources in state_sources.values() for meta in sources.get('votes', [])
+                    for race, years in meta['races'].items() for year in years})
+    for race, year in races:
+        cur.execute('INSERT INTO gm.races (race, year) VALUES (%s, %s) ON CONFLICT (race, year) DO NOTHING;',
+                    (race, year))
+
+########################################################################################################################
+# Fact Writer
+########################################################################################################################
+
+# Takes the same rows as a writer of `gm.votes` or `gm.populations` (with names for keys), copies them into a temporary
+# table and, on `close()`, resolves the names to ids with one join against `gm.wards` and `gm.races` and inserts the
+# result into the fact table. A row whose ward or race does not exist is an error, as it is a foreign key violation
+# with the VARCHAR-keyed tables.
+
+RESOLVE_SQL = {
+    'votes': '''
+    INSERT INTO gm.vote_facts (race_id, ward_id, total, democrat, republican)
+         SELECT rc.id,
+                wrd.id,
+                s.total,
+                s.democrat,
+                s.republican
+
+           FROM {staging} AS s
+
+                JOIN gm.races AS rc
+                ON s.race = rc.race
+                   AND s.year = rc.year
+
+                JOIN gm.wards AS wrd
+                ON s.state = wrd.state
+                   AND s.ward_year = wrd.year
+                   AND s.ward = wrd.name;
+    ''',
+    'populations': '''
+    INSERT INTO gm.population_facts (year, ward_id, total, white, black, american_indian, asian, pacific_islander,
+                                     hispanic)
+         SELECT s.year,
+                wrd.id,
+                s.total,
+                s.white,
+                s.black,
+                s.american_indian,
+                s.asian,
+                s.pacific_islander,
+                s.hispanic
+
+           FROM {staging} AS s
+
+                JOIN gm.wards AS wrd
+                ON s.state = wrd.state
+                   AND s.ward_year = wrd.year
+                   AND s.ward = wrd.name;
+    ''',
+}
+
+
+class FactWriter:
+
+    def __init__(self, cur, table, columns, batch_size=10000, parents=()):
+        self.cur = cur
+        self.table = table
+        self.staging = 'staging_' + FACT_TABLES[table]
+        definitions = ['{} {}'.format(name, 'INTEGER' if column_type == 'integer' else 'VARCHAR')
+                       for name, column_type in columns]
+        cur.execute('CREATE TEMPORARY TABLE {} ({}) ON COMMIT DROP;'.format(self.staging, ', '.join(definitions)))
+        self.rows = bulk.CopyWriter(cur, self.staging, columns, batch_size=batch_size, parents=parents)
+        self.total_rows = 0
+
+    @property
+    def total_bytes(self):
+        return self.rows.total_bytes
+
+    def begin(self, source):
+        return True
+
+    def write(self, row):
+        self.rows.write(row)
+
+    def flush(self):
+        self.rows.flush()
+
+    def close(self):
+        self.rows.close()
+        if self.rows.total_rows == 0:
+            return
+        self.cur.execute(RESOLVE_SQL[self.table].format(staging=self.staging))
+        self.total_rows = self.cur.rowcount
+        if self.total_rows != self.rows.total_rows:
+            raise ValueError('{} of {} gm.{} rows reference a ward or race that does not exist'.format(
+                self.rows.total_rows - self.total_rows, self.rows.total_rows, self.table))
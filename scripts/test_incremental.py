@@ -0,0 +1,57 @@
+import unittest
+
+import incremental
+
+########################################################################################################################
+# Stale Keys
+########################################################################################################################
+
+# An in-memory manifest as it is after every source was loaded: `sources` are the stored (layer, source) pairs and
+# `features` maps every (layer, key) to the source that last wrote it.
+
+class Manifest(incremental.Manifest):
+
+    def __init__(self, sources, features):
+        super().__init__(None)
+        self.sources = set(sources)
+        self.features = dict(features)
+
+    def stored_sources(self, layer):
+        return [source for source_layer, source in self.sources if source_layer == layer]
+
+    def key_sources(self, layer, keys):
+        return {key: self.features[(layer, key)] for key in keys if (layer, key) in self.features}
+
+    def stored_row_hashes(self, layer, source):
+        return {key: 'hash' for (key_layer, key), key_source in self.features.items()
+                if key_layer == layer and key_source == source}
+
+
+class StaleKeysTest(unittest.TestCase):
+
+    def test_key_moved_to_another_changed_source_is_kept(self):
+        # `a` no longer has wisconsin/2011/b_2, which `b` wrote instead and took over in the manifest
+        manifest = Manifest([('gm.wards', 'a.geojson'), ('gm.wards', 'b.geojson')], {
+            ('gm.wards', 'wisconsin/2011/a_1'): 'a.geojson',
+            ('gm.wards', 'wisconsin/2011/a_3'): 'a.geojson',
+            ('gm.wards', 'wisconsin/2011/b_2'): 'b.geojson',
+        })
+        unwritten = [('wisconsin/2011/a_3', 'a.geojson'), ('wisconsin/2011/b_2', 'a.geojson')]
+        deleted, removed = incremental.stale_keys(manifest, 'gm.wards', unwritten, ['a.geojson', 'b.geojson'])
+        self.assertEqual(deleted, ['wisconsin/2011/a_3'])
+        self.assertEqual(removed, [])
+
+    def test_keys_of_unlisted_source_are_deleted(self):
+        # `old` was renamed to `new`, which repeats wisconsin/2011/a_1 but not wisconsin/2011/a_2
+        manifest = Manifest([('gm.wards', 'old.geojson'), ('gm.wards', 'new.geojson'), ('gm.votes', 'old.geojson')], {
+            ('gm.wards', 'wisconsin/2011/a_1'): 'new.geojson',
+            ('gm.wards', 'wisconsin/2011/a_2'): 'old.geojson',
+            ('gm.votes', 'wisconsin/president/2016/2011/a_2'): 'old.geojson',
+        })
+        deleted, removed = incremental.stale_keys(manifest, 'gm.wards', [], ['new.geojson'])
+        self.assertEqual(deleted, ['wisconsin/2011/a_2'])
+        self.assertEqual(removed, ['old.geojson'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,399 @@
+import argparse
+import gzip
+import json
+import multiprocessing
+import os
+import sqlite3
+from concurrent import futures
+
+import numpy as np
+
+import db
+
+########################################################################################################################
+# Layers
+########################################################################################################################
+
+# Every geometry table becomes one layer of the vector tiles, from its minimum zoom up to the maximum zoom of the
+# pyramid. Features carry their URI, name and metrics, their votes (`<race>_<year>_<total|democrat|republican>`) and
+# their populations (`population_<year>_<column>`). Wards take their votes from `gm.votes`; every other layer takes them
+# from `gm.vote_rollups` and sums the populations of its wards. `wards` matches the wards (`w`) of a feature (`f`).
+
+LAYERS = {
+    'states': {
+        'min_zoom': 0,
+        'key': ['name'],
+        'uri': 'CONCAT(\'/states/\', f.name)',
+        'votes': 'gm.vote_rollups',
+        'votes_match': 'vt.level = \'state\' AND vt.state = f.name',
+        'wards': 'w.state = f.name',
+    },
+    'counties': {
+        'min_zoom': 4,
+        'key': ['state', 'name'],
+        'uri': 'CONCAT(\'/states/\', f.state, \'/counties/\', f.name)',
+        'votes': 'gm.vote_rollups',
+        'votes_match': 'vt.level = \'county\' AND vt.state = f.state AND vt.name = f.name',
+        'wards': 'w.state = f.state AND w.county = f.name',
+    },
+    'assemblies': {
+        'min_zoom': 4,
+        'key': ['state', 'year', 'name'],
+        'uri': 'CONCAT(\'/states/\', f.state, \'/years/\', f.year, \'/assemblies/\', f.name)',
+        'votes': 'gm.vote_rollups',
+        'votes_match': 'vt.level = \'assembly\' AND vt.state = f.state AND vt.ward_year = f.year AND vt.name = f.name',
+        'wards': 'w.state = f.state AND w.year = f.year AND w.assembly = f.name',
+    },
+    'senates': {
+        'min_zoom': 4,
+        'key': ['state', 'year', 'name'],
+        'uri': 'CONCAT(\'/states/\', f.state, \'/years/\', f.year, \'/senates/\', f.name)',
+        'votes': 'gm.vote_rollups',
+        'votes_match': 'vt.level = \'senate\' AND vt.state = f.state AND vt.ward_year = f.year AND vt.name = f.name',
+        'wards': 'w.state = f.state AND w.year = f.year AND w.senate = f.name',
+    },
+    'congressionals': {
+        'min_zoom': 4,
+        'key': ['state', 'year', 'name'],
+        'uri': 'CONCAT(\'/states/\', f.state, \'/years/\', f.year, \'/congressionals/\', f.name)',
+        'votes': 'gm.vote_rollups',
+        'votes_match': 'vt.level = \'congressional\' AND vt.state = f.state AND vt.ward_year = f.year '
+                       'AND vt.name = f.name',
+        'wards': 'w.state = f.state AND w.year = f.year AND w.congressional = f.name',
+    },
+    'wards': {
+        'min_zoom': 8,
+        'key': ['state', 'year', 'name'],
+        'uri': 'CONCAT(\'/states/\', f.state, \'/years/\', f.year, \'/wards/\', f.name)',
+        'votes': 'gm.votes',
+        'votes_match': 'vt.state = f.state AND vt.ward_year = f.year AND vt.ward = f.name',
+        'wards': 'w.state = f.state AND w.year = f.year AND w.name = f.name',
+    },
+}
+
+EXTENT = 4096
+BUFFER = 64
+
+# Half the width of the Web Mercator square, in meters
+BOUND = 20037508.342789244
+
+########################################################################################################################
+# Tile Features
+########################################################################################################################
+
+# `gm.tile_features` holds every feature of every layer already projected to Web Mercator with its properties, so that
+# tiles never transform geometries or join votes themselves. Its `hash` covers both geometry and properties and is what
+# the MBTiles store compares against to find the tiles that a re-ingest affected.
+
+TABLE_SQL = '''
+CREATE TABLE IF NOT EXISTS gm.tile_features (
+    layer      VARCHAR  NOT NULL,
+    key        VARCHAR  NOT NULL,
+
+               UNIQUE (layer, key),
+
+    hash       CHAR(32) NOT NULL,
+    geometry   GEOMETRY NOT NULL,
+    properties JSONB    NOT NULL
+);
+'''
+
+INDEX_SQL = 'CREATE INDEX IF NOT EXISTS tile_features_geometry_idx ON gm.tile_features USING GIST (geometry);'
+
+FEATURES_SQL = '''
+INSERT INTO gm.tile_features (layer, key, hash, geometry, properties)
+SELECT '{layer}',
+       key,
+       MD5(ST_AsEWKB(geometry) || CONVERT_TO(properties::TEXT, 'UTF8')),
+       geometry,
+       properties
+
+  FROM (SELECT CONCAT_WS('/', {key}) AS key,
+               ST_Transform(f.geometry, 3857) AS geometry,
+               JSONB_BUILD_OBJECT('uri', {uri},
+                                  'name', f.name,
+                                  'area', f.area,
+                                  'perimeter', f.perimeter,
+                                  'npi', f.npi)
+               || COALESCE(vt.properties, '{{}}')
+               || COALESCE(pop.properties, '{{}}') AS properties
+
+          FROM gm.{layer} AS f
+
+               LEFT JOIN LATERAL (SELECT JSONB_OBJECT_AGG(CONCAT_WS('_', vt.race, vt.year, c.name), c.value)
+                                         AS properties
+
+                                    FROM {votes} AS vt
+
+                                         CROSS JOIN LATERAL (VALUES ('total', vt.total),
+                                                                    ('democrat', vt.democrat),
+                                                                    ('republican', vt.republican)) AS c(name, value)
+
+                                   WHERE {votes_match}) AS vt
+               ON TRUE
+
+               LEFT JOIN LATERAL (SELECT JSONB_OBJECT_AGG(CONCAT_WS('_', 'population', pop.year, c.name), c.value)
+                                         AS properties
+
+                                    FROM (SELECT p.year AS year,
+                                                 SUM(p.total) AS total,
+                                                 SUM(p.white) AS white,
+                                                 SUM(p.black) AS black,
+                                                 SUM(p.american_indian) AS american_indian,
+                                                 SUM(p.asian) AS asian,
+                                                 SUM(p.pacific_islander) AS pacific_islander,
+                                                 SUM(p.hispanic) AS hispanic
+
+                                            FROM gm.populations AS p
+
+                                                 JOIN gm.wards AS w
+                                                 ON p.state = w.state
+                                                    AND p.ward_year = w.year
+                                                    AND p.ward = w.name
+
+                                           WHERE {wards}
+
+                                           GROUP BY p.year) AS pop
+
+                                         CROSS JOIN LATERAL (VALUES ('total', pop.total),
+                                                                    ('white', pop.white),
+                                                                    ('black', pop.black),
+                                                                    ('american_indian', pop.american_indian),
+                                                                    ('asian', pop.asian),
+                                                                    ('pacific_islander', pop.pacific_islander),
+                                                                    ('hispanic', pop.hispanic)) AS c(name, value)) AS pop
+               ON TRUE) AS features;
+'''
+
+
+def refresh_features(cur):
+    cur.execute(TABLE_SQL)
+    cur.execute(INDEX_SQL)
+    cur.execute('TRUNCATE gm.tile_features;')
+    for layer, config in LAYERS.items():
+        cur.execute(FEATURES_SQL.format(
+            layer=layer,
+            key=', '.join('f.' + name for name in config['key']),
+            uri=config['uri'],
+            votes=config['votes'],
+            votes_match=config['votes_match'],
+            wards=config['wards'],
+        ))
+    cur.execute('ANALYZE gm.tile_features;')
+
+
+def read_features(cur):
+    cur.execute('''
+    SELECT layer,
+           key,
+           hash,
+           ST_XMin(geometry),
+           ST_YMin(geometry),
+           ST_XMax(geometry),
+           ST_YMax(geometry)
+
+      FROM gm.tile_features;
+    ''')
+    return {(layer, key): (digest, bbox) for layer, key, digest, *bbox in cur.fetchall()}
+
+########################################################################################################################
+# Tile Coverage
+########################################################################################################################
+
+# Returns the tiles (as `x * 2 ** zoom + y`) that the Web Mercator bounding boxes `(xmin, ymin, xmax, ymax)` overlap
+# at `zoom`, padded by the tile buffer so that features clipped into a neighbouring tile's buffer are covered too.
+
+def covered_tiles(bboxes, zoom):
+    if len(bboxes) == 0:
+        return np.empty(0, dtype=np.int64)
+    n = 1 << zoom
+    scale = n / (2 * BOUND)
+    pad = BUFFER / EXTENT
+    bboxes = np.asarray(bboxes, dtype=np.float64)
+    x0 = np.clip(np.floor((bboxes[:, 0] + BOUND) * scale - pad), 0, n - 1).astype(np.int64)
+    x1 = np.clip(np.floor((bboxes[:, 2] + BOUND) * scale + pad), 0, n - 1).astype(np.int64)
+    y0 = np.clip(np.floor((BOUND - bboxes[:, 3]) * scale - pad), 0, n - 1).astype(np.int64)
+    y1 = np.clip(np.floor((BOUND - bboxes[:, 1]) * scale + pad), 0, n - 1).astype(np.int64)
+
+    widths = x1 - x0 + 1
+    counts = widths * (y1 - y0 + 1)
+    boxes = np.repeat(np.arange(len(bboxes)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    xs = x0[boxes] + offsets % widths[boxes]
+    ys = y0[boxes] + offsets // widths[boxes]
+    return np.unique(xs * n + ys)
+
+
+def dirty_tiles(stored, current, min_zoom, max_zoom, full):
+    # A changed feature dirties the tiles under both its old and its new bounding box
+    bboxes = {layer: [] for layer in LAYERS}
+    for feature in stored.keys() | current.keys():
+        old, new = stored.get(feature), current.get(feature)
+        if not full and old is not None and new is not None and old[0] == new[0]:
+            continue
+        for entry in (old, new):
+            if entry is not None and None not in entry[1]:
+                bboxes[feature[0]].append(entry[1])
+
+    tiles = []
+    for zoom in range(min_zoom, max_zoom + 1):
+        layer_bboxes = [bbox for layer, config in LAYERS.items() if config['min_zoom'] <= zoom for bbox in bboxes[layer]]
+        n = 1 << zoom
+        tiles.extend((zoom, int(tile // n), int(tile % n)) for tile in covered_tiles(layer_bboxes, zoom))
+    return tiles
+
+########################################################################################################################
+# Tile Rendering
+########################################################################################################################
+
+# One statement renders every layer visible at a zoom into a single tile; MVT layers concatenate byte-wise.
+
+LAYER_SQL = '''
+COALESCE((SELECT ST_AsMVT(t, '{layer}', {extent}, 'geometry')
+            FROM (SELECT ST_AsMVTGeom(f.geometry, ST_TileEnvelope(%(z)s, %(x)s, %(y)s), {extent}, {buffer}, true)
+                         AS geometry,
+                         f.properties
+
+                    FROM gm.tile_features AS f
+
+                   WHERE f.layer = '{layer}'
+                     AND f.geometry && ST_Expand(ST_TileEnvelope(%(z)s, %(x)s, %(y)s), {margin})) AS t
+           WHERE t.geometry IS NOT NULL), ''::BYTEA)
+'''
+
+
+def tile_sql(zoom):
+    margin = 2 * BOUND / (1 << zoom) * BUFFER / EXTENT
+    return 'SELECT {};'.format(' || '.join(
+        LAYER_SQL.format(layer=layer, extent=EXTENT, buffer=BUFFER, margin=margin)
+        for layer, config in LAYERS.items() if config['min_zoom'] <= zoom
+    ))
+
+
+def render_tiles(tiles):
+    conn = db.connection()
+    rendered = []
+    with conn.cursor() as cur:
+        for z, x, y in tiles:
+            cur.execute(tile_sql(z), {'z': z, 'x': x, 'y': y})
+            data = bytes(cur.fetchone()[0])
+            rendered.append((z, x, y, gzip.compress(data) if data else None))
+    conn.rollback()
+    return rendered
+
+########################################################################################################################
+# MBTiles
+########################################################################################################################
+
+# Tiles are stored gzipped with TMS rows as the MBTiles spec requires. `features` is not part of the spec: it records
+# the hash and Web Mercator bounding box of every feature the tiles were rendered from.
+
+MBTILES_SQL = '''
+CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB,
+                                  PRIMARY KEY (zoom_level, tile_column, tile_row));
+CREATE TABLE IF NOT EXISTS features (layer TEXT, key TEXT, hash TEXT, xmin REAL, ymin REAL, xmax REAL, ymax REAL,
+                                     PRIMARY KEY (layer, key));
+'''
+
+
+def open_mbtiles(path):
+    store = sqlite3.connect(path)
+    store.executescript(MBTILES_SQL)
+    return store
+
+
+def stored_features(store):
+    return {(layer, key): (digest, bbox) for layer, key, digest, *bbox in store.execute('SELECT * FROM features;')}
+
+
+def write_metadata(store, min_zoom, max_zoom):
+    metadata = {
+        'name': 'gm',
+        'format': 'pbf',
+        'type': 'overlay',
+        'minzoom': str(min_zoom),
+        'maxzoom': str(max_zoom),
+        'bounds': '-180.0,-85.0511,180.0,85.0511',
+        'json': json.dumps({'vector_layers': [{
+            'id': layer,
+            'minzoom': max(config['min_zoom'], min_zoom),
+            'maxzoom': max_zoom,
+            'fields': {'uri': 'String', 'name': 'String', 'area': 'Number', 'perimeter': 'Number', 'npi': 'Number'},
+        } for layer, config in LAYERS.items()]}),
+    }
+    store.executemany('INSERT OR REPLACE INTO metadata (name, value) VALUES (?, ?);', metadata.items())
+
+
+def write_tiles(store, rendered):
+    store.executemany('DELETE FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?;',
+                      [(z, x, (1 << z) - 1 - y) for z, x, y, _ in rendered])
+    store.executemany('INSERT INTO tiles (zoom_level, tile_column, tile_row, tile_data) VALUES (?, ?, ?, ?);',
+                      [(z, x, (1 << z) - 1 - y, data) for z, x, y, data in rendered if data is not None])
+
+
+def write_features(store, current):
+    store.execute('DELETE FROM features;')
+    store.executemany('INSERT INTO features VALUES (?, ?, ?, ?, ?, ?, ?);',
+                      [(layer, key, digest, *bbox) for (layer, key), (digest, bbox) in current.items()])
+
+########################################################################################################################
+# Build
+########################################################################################################################
+
+# Refreshes `gm.tile_features`, diffs it against the features the store was last rendered from and re-renders only the
+# tiles under changed, added or removed features, in parallel. The feature list is written last, so an interrupted
+# build is simply redone by the next one. Changing the zoom range re-renders everything.
+
+def build(path, min_zoom=0, max_zoom=12, workers=None, full=False, chunk_size=256):
+    conn = db.connect()
+    cur = conn.cursor()
+    refresh_features(cur)
+    conn.commit()
+    current = read_features(cur)
+    cur.close()
+    conn.close()
+
+    store = open_mbtiles(path)
+    zooms = dict(store.execute('SELECT name, value FROM metadata WHERE name IN (\'minzoom\', \'maxzoom\');'))
+    full = full or zooms != {'minzoom': str(min_zoom), 'maxzoom': str(max_zoom)}
+    if full:
+        store.execute('DELETE FROM tiles;')
+    tiles = dirty_tiles(stored_features(store), current, min_zoom, max_zoom, full)
+
+    chunks = [tiles[index:index + chunk_size] for index in range(0, len(tiles), chunk_size)]
+    written = 0
+    executor = futures.ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+    try:
+        for rendered in executor.map(render_tiles, chunks):
+            write_tiles(store, rendered)
+            store.commit()
+            written += sum(data is not None for _, _, _, data in rendered)
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+    write_metadata(store, min_zoom, max_zoom)
+    write_features(store, current)
+    store.commit()
+    store.close()
+    return {'features': len(current), 'tiles': len(tiles), 'written': written}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Render the gm layers into a Mapbox Vector Tile pyramid stored as '
+                                                 'MBTiles, re-rendering only the tiles whose features changed.')
+    parser.add_argument('mbtiles', nargs='?', default='gm.mbtiles', help='MBTiles file (default: gm.mbtiles)')
+    parser.add_argument('--min-zoom', type=int, default=0, help='lowest zoom level (default: 0)')
+    parser.add_argument('--max-zoom', type=int, default=12, help='highest zoom level (default: 12)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='number of worker processes, each with its own connection (default: CPU count)')
+    parser.add_argument('--full', action='store_true', help='re-render every tile')
+    args = parser.parse_args()
+
+    result = build(args.mbtiles, min_zoom=args.min_zoom, max_zoom=args.max_zoom, workers=args.workers, full=args.full)
+    print('{}: {} features, {} tiles rendered, {} non-empty'.format(
+        args.mbtiles, result['features'], result['tiles'], result['written']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,341 @@
+import argparse
+import json
+import sys
+
+import numpy as np
+
+import db
+import simplify
+import snapshot
+import topology
+
+########################################################################################################################
+# TopoJSON
+########################################################################################################################
+
+# The state, its counties, districts and wards share almost all of their boundaries, so a map that shows several of
+# them (like the votes page's base and overlay layers) is sent as one TopoJSON document in which every boundary of the
+# shared-arc topology (see `topology.py`) is stored once, for all layers. Coordinates are quantized to a `quantization`
+# x `quantization` grid over the bounding box, described by the `transform`, and every arc is delta-encoded, so most
+# positions are small integers. Consecutive positions that quantize to the same point are dropped.
+#
+# `zoom` optionally replaces every arc with its simplification for that zoom level (see `simplify.py`), which keeps
+# neighbours' boundaries coincident just like the stored simplified geometries.
+
+QUANTIZATION = 100000
+
+
+def transform(points, quantization):
+    if len(points) == 0:
+        return {'scale': [1, 1], 'translate': [0, 0]}
+    low, high = points.min(axis=0), points.max(axis=0)
+    scale = np.where(high > low, (high - low) / (quantization - 1), 1)
+    return {'scale': scale.tolist(), 'translate': low.tolist()}
+
+
+def quantize(points, quantize_transform):
+    return np.rint((points - quantize_transform['translate']) / quantize_transform['scale']).astype(np.int64)
+
+
+def encode_arc(positions):
+    # An arc keeps both of its ends even when they quantize to the same point, so rings stay closed
+    kept = np.ones(len(positions), dtype=bool)
+    kept[1:] = np.any(positions[1:] != positions[:-1], axis=1)
+    kept[-1] = True
+    positions = positions[kept]
+    return np.concatenate([positions[:1], np.diff(positions, axis=0)]).tolist()
+
+
+def encode_arcs(topo, quantization=QUANTIZATION, zoom=None):
+    # The `bbox`, `transform` and `arcs` members of the document
+    arc_points = simplify.simplify(topo, [zoom])[zoom] if zoom is not None else topo.arcs
+    quantize_transform = transform(topo.points, quantization)
+    positions = quantize(topo.points, quantize_transform)
+    return {
+        'bbox': (np.concatenate([topo.points.min(axis=0), topo.points.max(axis=0)]).tolist() if len(topo.points)
+                 else []),
+        'transform': quantize_transform,
+        'arcs': [encode_arc(positions[indexes]) for indexes in arc_points],
+    }
+
+
+def encode_shape(shape):
+    if not shape:
+        return {'type': None}
+    if len(shape) == 1:
+        return {'type': 'Polygon', 'arcs': shape[0]}
+    return {'type': 'MultiPolygon', 'arcs': shape}
+
+
+def encode_objects(topo, objects):
+    # `objects` maps every object name to the (shape index, id, properties) of its geometries, where the shape index is
+    # the position of the geometry in the list passed to `topology.build()`
+    return {name: {'type': 'GeometryCollection', 'geometries': [
+        dict(encode_shape(topo.shapes[index]), id=identifier, properties=properties)
+        for index, identifier, properties in geometries
+    ]} for name, geometries in objects.items()}
+
+
+def text(value):
+    return json.dumps(value, separators=(',', ':'))
+
+
+def document(bbox, quantize_transform, objects, arcs):
+    # Assembles a document from the serialized members, exactly like the API (see `topologyGetSQL` in `api/main.js`)
+    return '{{"type":"Topology","bbox":{},"transform":{},"objects":{},"arcs":{}}}'.format(
+        bbox, quantize_transform, objects, arcs)
+
+########################################################################################################################
+# Tables
+########################################################################################################################
+
+# Every race shown on the votes page needs the same boundaries but its own counts, so the serialized members of every
+# document are stored apart: `gm.topologies` holds the bounding box, transform and arcs of every ward vintage of every
+# state, and `gm.topology_objects` the objects of every race and election year on that vintage. The API concatenates
+# the two verbatim, so a page only downloads the counts of its own race.
+#
+# A race's document has one object per level, named like the `group` of the votes API: `state`, `county` (the state's
+# counties), `assembly`, `senate` and `congressional` (the districts of the vintage's year) and `ward`. Like the votes
+# API, it only has the geometries with votes in the race. Every geometry's `id` is its URI and its properties are its
+# name, its metrics, its `total`, `democrat` and `republican` votes and its populations (`population_<year>_<column>`,
+# named like the vector tile properties, see `tiles.py`).
+
+TABLES_SQL = [
+    '''
+    CREATE TABLE IF NOT EXISTS gm.topologies (
+        state         VARCHAR NOT NULL,
+
+                      FOREIGN KEY (state)
+                       REFERENCES gm.states(name),
+
+        year          CHAR(4) NOT NULL,
+
+                      UNIQUE (state, year),
+
+        bbox          TEXT    NOT NULL,
+        transform     TEXT    NOT NULL,
+        arcs          TEXT    NOT NULL,
+        geojson_bytes INTEGER NOT NULL
+    );
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS gm.topology_objects (
+        state     VARCHAR NOT NULL,
+        ward_year CHAR(4) NOT NULL,
+
+                  FOREIGN KEY (state, ward_year)
+                   REFERENCES gm.topologies(state, year)
+                   ON DELETE CASCADE,
+
+        race      VARCHAR NOT NULL,
+        year      CHAR(4) NOT NULL,
+
+                  UNIQUE (state, race, year, ward_year),
+
+        objects   TEXT    NOT NULL
+    );
+    ''',
+]
+
+LEVELS = {
+    'states': 'state',
+    'counties': 'county',
+    'assemblies': 'assembly',
+    'senates': 'senate',
+    'congressionals': 'congressional',
+    'wards': 'ward',
+}
+
+
+def create_table(cur, drop):
+    if drop:
+        cur.execute('DROP TABLE IF EXISTS gm.topology_objects;')
+        cur.execute('DROP TABLE IF EXISTS gm.topologies;')
+    for query in TABLES_SQL:
+        cur.execute(query)
+
+
+def uri(state, table, year, name):
+    if table == 'states':
+        return '/states/{}'.format(name)
+    if table == 'counties':
+        return '/states/{}/counties/{}'.format(state, name)
+    return '/states/{}/years/{}/{}/{}'.format(state, year, table, name)
+
+
+def metric(value):
+    return round(value, 4) if value is not None else None
+
+########################################################################################################################
+# Topology Stage
+########################################################################################################################
+
+# Rebuilds every ward vintage of a state whose geometries, votes or populations changed, once its rollups are current.
+# The state and its counties have no vintage, so they are part of every vintage's topology; their votes and
+# populations are those of the vintage's wards.
+
+def states(summaries):
+    return sorted(set(snapshot.states(summaries)) | (set(simplify.groups(summaries)) - {'states'}))
+
+
+def read_state(cur, state):
+    # Returns the geometries of every table and the votes of every race and populations of every level, keyed by ward
+    # vintage
+    geometries = {}
+    for table in LEVELS:
+        cur.execute('''
+        SELECT {year},
+               name,
+               area,
+               perimeter,
+               npi,
+               ST_AsGeoJSON(geometry)
+
+          FROM gm.{table}
+
+         WHERE {state} = %s
+
+         ORDER BY name;
+        '''.format(year='NULL' if table in ['states', 'counties'] else 'year', table=table,
+                   state='name' if table == 'states' else 'state'), (state,))
+        for year, *row in cur.fetchall():
+            geometries.setdefault(table, {}).setdefault(year, []).append(row)
+
+    votes = {}
+    cur.execute('SELECT ward_year, level, name, race, year, {} FROM gm.vote_rollups WHERE state = %s;'.format(
+        ', '.join(snapshot.VOTE_COLUMNS)), (state,))
+    rows = cur.fetchall()
+    cur.execute('SELECT ward_year, \'ward\', ward, race, year, {} FROM gm.votes WHERE state = %s;'.format(
+        ', '.join(snapshot.VOTE_COLUMNS)), (state,))
+    for ward_year, level, name, race, year, *counts in rows + cur.fetchall():
+        votes.setdefault(ward_year, {}).setdefault((race, year), {})[(level, name)] = dict(
+            zip(snapshot.VOTE_COLUMNS, counts))
+
+    populations = {}
+    cur.execute('''
+    SELECT pop.ward_year,
+           pop.year,
+           pop.ward,
+           wrd.county,
+           wrd.assembly,
+           wrd.senate,
+           wrd.congressional,
+           {}
+
+      FROM gm.populations AS pop
+
+           JOIN gm.wards AS wrd
+           ON pop.state = wrd.state
+              AND pop.ward_year = wrd.year
+              AND pop.ward = wrd.name
+
+     WHERE pop.state = %s;
+    '''.format(', '.join('pop.' + column for column in snapshot.POPULATION_COLUMNS)), (state,))
+    for ward_year, year, ward, *row in cur.fetchall():
+        districts, counts = row[:len(snapshot.DISTRICT_COLUMNS)], row[len(snapshot.DISTRICT_COLUMNS):]
+        levels = [('state', state), ('ward', ward)] + list(zip(snapshot.DISTRICT_COLUMNS, districts))
+        for level, name in levels:
+            values = populations.setdefault(ward_year, {}).setdefault((level, name), {})
+            for column, count in zip(snapshot.POPULATION_COLUMNS, counts):
+                key = 'population_{}_{}'.format(year, column)
+                values[key] = values.get(key, 0) + count
+    return geometries, votes, populations
+
+
+def build_vintage(state, year, geometries, votes, populations, quantization=QUANTIZATION, zoom=None):
+    # Returns the serialized `bbox`, `transform` and `arcs` of the vintage, the serialized objects of every (race,
+    # election year) and the size of the same geometries as GeoJSON
+    shapes = []
+    features = {}
+    geojson_bytes = 0
+    for table, level in LEVELS.items():
+        rows = geometries.get(table, {}).get(None if table in ['states', 'counties'] else year, [])
+        features[level] = []
+        for name, area, perimeter, npi, geometry in rows:
+            properties = {'name': name, 'area': metric(area), 'perimeter': metric(perimeter), 'npi': metric(npi)}
+            properties.update(populations.get((level, name), {}))
+            features[level].append((len(shapes), uri(state, table, year, name), properties))
+            shapes.append(json.loads(geometry))
+            geojson_bytes += len(geometry)
+    topo = topology.build(shapes)
+    arcs = {member: text(value) for member, value in encode_arcs(topo, quantization, zoom).items()}
+
+    objects = {}
+    for race, race_votes in votes.items():
+        objects[race] = text(encode_objects(topo, {level: [
+            (index, identifier, dict(properties, **race_votes[(level, properties['name'])]))
+            for index, identifier, properties in level_features if (level, properties['name']) in race_votes
+        ] for level, level_features in features.items()}))
+    return arcs, objects, geojson_bytes
+
+
+def build_state(state, quantization=QUANTIZATION, zoom=None):
+    conn = db.connection()
+    built = []
+    with conn.cursor() as cur:
+        geometries, votes, populations = read_state(cur, state)
+        cur.execute('DELETE FROM gm.topologies WHERE state = %s;', (state,))
+        for year in sorted(geometries.get('wards', {})):
+            arcs, objects, geojson_bytes = build_vintage(state, year, geometries, votes.get(year, {}),
+                                                         populations.get(year, {}), quantization, zoom)
+            cur.execute('INSERT INTO gm.topologies (state, year, bbox, transform, arcs, geojson_bytes) '
+                        'VALUES (%s, %s, %s, %s, %s, %s);',
+                        (state, year, arcs['bbox'], arcs['transform'], arcs['arcs'], geojson_bytes))
+            for (race, race_year), race_objects in sorted(objects.items()):
+                cur.execute('INSERT INTO gm.topology_objects (state, ward_year, race, year, objects) '
+                            'VALUES (%s, %s, %s, %s, %s);', (state, year, race, race_year, race_objects))
+            largest = max([len(race_objects) for race_objects in objects.values()] or [0])
+            size = sum(len(member) for member in arcs.values()) + largest
+            built.append('{} ({} races, up to {:.0f} KiB, {:.0%} of GeoJSON geometries alone)'.format(
+                year, len(objects), size / 2 ** 10, size / geojson_bytes if geojson_bytes else 0))
+    conn.commit()
+    return [{'table': 'topologies', 'derived': ', '.join(built) or 'no wards'}]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rebuild the shared-arc TopoJSON of the state, counties, districts '
+                                                 'and wards of every ward vintage in `gm.topologies`, or write the '
+                                                 'document of one race to a file.')
+    parser.add_argument('states', nargs='*', help='states to rebuild (default: all)')
+    parser.add_argument('--quantization', type=int, default=QUANTIZATION,
+                        help='grid size positions are quantized to (default: {})'.format(QUANTIZATION))
+    parser.add_argument('--zoom', type=int, choices=simplify.ZOOMS,
+                        help='simplify every arc for this zoom level (default: full detail)')
+    parser.add_argument('--year', help='with --output, the ward vintage to write')
+    parser.add_argument('--race', nargs=2, metavar=('RACE', 'YEAR'), help='with --output, the race to write')
+    parser.add_argument('--output', help='instead of storing them, write the document of the single state, --year '
+                                         'and --race to this file')
+    args = parser.parse_args()
+
+    conn = db.connect()
+    cur = conn.cursor()
+    selected = args.states
+    if not selected:
+        cur.execute('SELECT DISTINCT state FROM gm.wards ORDER BY state;')
+        selected = [row[0] for row in cur.fetchall()]
+
+    if args.output:
+        if len(selected) != 1 or not args.year or not args.race:
+            parser.error('--output takes exactly one state, --year and --race')
+        geometries, votes, populations = read_state(cur, selected[0])
+        arcs, objects, geojson_bytes = build_vintage(selected[0], args.year, geometries, votes.get(args.year, {}),
+                                                     populations.get(args.year, {}), args.quantization, args.zoom)
+        if tuple(args.race) not in objects:
+            parser.error('{} {} has no votes for {} {}'.format(selected[0], args.year, *args.race))
+        output = document(arcs['bbox'], arcs['transform'], objects[tuple(args.race)], arcs['arcs'])
+        with open(args.output, 'w') as output_file:
+            output_file.write(output)
+        print('{} {} {} {}: {} bytes, {} bytes of GeoJSON geometries'.format(
+            selected[0], args.year, *args.race, len(output), geojson_bytes), file=sys.stderr)
+    cur.close()
+    conn.close()
+    if args.output:
+        return
+
+    for state in selected:
+        for summary in build_state(state, args.quantization, args.zoom):
+            print('{} gm.{}: {}'.format(state, summary['table'], summary['derived']))
+
+
+if __name__ == '__main__':
+    main()
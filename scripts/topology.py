@@ -0,0 +1,128 @@
+import numpy as np
+
+########################################################################################################################
+# Shared-Arc Topology
+########################################################################################################################
+
+# Splits the rings of a set of (Multi)Polygons into arcs at every junction, i.e. every vertex whose neighbours differ
+# between the rings that pass through it, and stores each boundary shared by two rings once. Like TopoJSON, a ring is a
+# list of arc references where `~index` (`-index - 1`) is arc `index` reversed. Vertices are matched exactly, so
+# boundaries are only shared where the source files agree on the coordinates, as they do between wards of one file.
+
+
+class Topology:
+
+    def __init__(self, points, arcs, shapes):
+        # `points` is an (n, 2) array of unique vertices, `arcs` a list of arrays of point indexes and `shapes` one list
+        # of polygons per geometry, each a list of rings, each a list of arc references
+        self.points = points
+        self.arcs = arcs
+        self.shapes = shapes
+
+    def ring_points(self, ring, arc_points=None):
+        # `arc_points` optionally replaces the point indexes of every arc, e.g. with a simplified subset of them
+        arc_points = self.arcs if arc_points is None else arc_points
+        parts = []
+        for reference in ring:
+            indexes = arc_points[reference] if reference >= 0 else arc_points[~reference][::-1]
+            parts.append(indexes if not parts else indexes[1:])
+        return np.concatenate(parts)
+
+    def geometry(self, index, arc_points=None):
+        polygons = []
+        for polygon in self.shapes[index]:
+            rings = []
+            for ring in polygon:
+                indexes = self.ring_points(ring, arc_points)
+                if len(indexes) >= 4:
+                    rings.append(self.points[indexes].tolist())
+                elif not rings:
+                    # A collapsed exterior ring takes its polygon with it; a collapsed hole is dropped
+                    break
+            if rings:
+                polygons.append(rings)
+        if len(polygons) == 1:
+            return {'type': 'Polygon', 'coordinates': polygons[0]}
+        return {'type': 'MultiPolygon', 'coordinates': polygons}
+
+
+def polygons(geometry):
+    if geometry['type'] == 'Polygon':
+        return [geometry['coordinates']]
+    if geometry['type'] == 'MultiPolygon':
+        return geometry['coordinates']
+    raise ValueError('Geometry type \'{}\' has no rings'.format(geometry['type']))
+
+
+def build(geometries):
+    # Flatten every ring, dropping the closing vertex, and number the unique vertices
+    rings = []
+    structure = []
+    for geometry in geometries:
+        shape = []
+        for polygon in polygons(geometry):
+            shape.append([])
+            for ring in polygon:
+                ring_array = np.asarray(ring, dtype=np.float64)[:, :2]
+                if len(ring_array) > 1 and np.array_equal(ring_array[0], ring_array[-1]):
+                    ring_array = ring_array[:-1]
+                shape[-1].append(len(rings))
+                rings.append(ring_array)
+        structure.append(shape)
+
+    if not rings:
+        return Topology(np.empty((0, 2)), [], [[] for _ in geometries])
+
+    lengths = np.array([len(ring) for ring in rings])
+    starts = np.cumsum(lengths) - lengths
+    points, ids = np.unique(np.concatenate(rings), axis=0, return_inverse=True)
+    ids = ids.reshape(-1)
+
+    # Previous and next vertex of every ring vertex, wrapping around within its ring
+    positions = np.arange(len(ids))
+    ring_of = np.repeat(np.arange(len(rings)), lengths)
+    offsets = positions - starts[ring_of]
+    previous = ids[starts[ring_of] + (offsets - 1) % lengths[ring_of]]
+    following = ids[starts[ring_of] + (offsets + 1) % lengths[ring_of]]
+
+    # A vertex is a junction when it is passed with more than one (unordered) pair of neighbours
+    neighbours = np.stack([ids, np.minimum(previous, following), np.maximum(previous, following)], axis=1)
+    unique_neighbours = np.unique(neighbours, axis=0)
+    junction = np.bincount(unique_neighbours[:, 0], minlength=len(points)) > 1
+
+    arcs = []
+    arc_index = {}
+
+    def add_arc(indexes):
+        key = tuple(indexes.tolist())
+        if key in arc_index:
+            return arc_index[key]
+        reverse = key[::-1]
+        if reverse in arc_index:
+            return ~arc_index[reverse]
+        arc_index[key] = len(arcs)
+        arcs.append(indexes)
+        return arc_index[key]
+
+    ring_arcs = []
+    for ring in range(len(rings)):
+        ring_ids = ids[starts[ring]:starts[ring] + lengths[ring]]
+        cuts = np.flatnonzero(junction[ring_ids])
+        if len(cuts) == 0:
+            # A ring without junctions is a single closed arc; rotating it to its smallest vertex lets an identical
+            # ring in either direction find it
+            ring_ids = np.roll(ring_ids, -int(np.argmin(ring_ids)))
+            if len(ring_ids) > 2 and ring_ids[-1] < ring_ids[1]:
+                ring_ids = np.roll(ring_ids[::-1], 1)
+                ring_arcs.append([~add_arc(np.append(ring_ids, ring_ids[0]))])
+            else:
+                ring_arcs.append([add_arc(np.append(ring_ids, ring_ids[0]))])
+            continue
+        ring_ids = np.roll(ring_ids, -int(cuts[0]))
+        cuts = cuts - cuts[0]
+        bounds = np.append(cuts, len(ring_ids))
+        closed = np.append(ring_ids, ring_ids[0])
+        ring_arcs.append([add_arc(closed[start:end + 1]) for start, end in zip(bounds[:-1], bounds[1:])])
+
+    shapes = [[[ring_arcs[ring] for ring in polygon] for polygon in shape] for shape in structure]
+    return Topology(points, arcs, shapes)
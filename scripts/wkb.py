@@ -0,0 +1,74 @@
+import struct
+import sys
+from array import array
+
+########################################################################################################################
+# Extended Well-Known Binary (EWKB) Encoding
+########################################################################################################################
+
+SRID = 4326
+
+GEOMETRY_TYPES = {
+    'Point': 1,
+    'LineString': 2,
+    'Polygon': 3,
+    'MultiPoint': 4,
+    'MultiLineString': 5,
+    'MultiPolygon': 6,
+    'GeometryCollection': 7,
+}
+
+EWKB_SRID_FLAG = 0x20000000
+
+LITTLE_ENDIAN = sys.byteorder == 'little'
+
+
+def _header(geometry_type, srid):
+    if srid is None:
+        return struct.pack('<BI', 1, GEOMETRY_TYPES[geometry_type])
+    return struct.pack('<BII', 1, GEOMETRY_TYPES[geometry_type] | EWKB_SRID_FLAG, srid)
+
+
+def _points(coordinates):
+    # Only X and Y are kept, which matches how the simplified GeoJSON sources are produced
+    flat = array('d')
+    for coordinate in coordinates:
+        flat.append(coordinate[0])
+        flat.append(coordinate[1])
+    if not LITTLE_ENDIAN:
+        flat.byteswap()
+    return struct.pack('<I', len(coordinates)) + flat.tobytes()
+
+
+def _rings(rings):
+    return struct.pack('<I', len(rings)) + b''.join(_points(ring) for ring in rings)
+
+
+def _body(geometry_type, coordinates):
+    if geometry_type == 'Point':
+        return struct.pack('<dd', coordinates[0], coordinates[1])
+    if geometry_type == 'LineString':
+        return _points(coordinates)
+    if geometry_type == 'Polygon':
+        return _rings(coordinates)
+    if geometry_type == 'MultiPoint':
+        return struct.pack('<I', len(coordinates)) + b''.join(
+            _header('Point', None) + _body('Point', point) for point in coordinates
+        )
+    if geometry_type == 'MultiLineString':
+        return struct.pack('<I', len(coordinates)) + b''.join(
+            _header('LineString', None) + _points(line) for line in coordinates
+        )
+    if geometry_type == 'MultiPolygon':
+        return struct.pack('<I', len(coordinates)) + b''.join(
+            _header('Polygon', None) + _rings(polygon) for polygon in coordinates
+        )
+    raise ValueError('Geometry type \'{}\' is not supported'.format(geometry_type))
+
+
+def encode(geometry, srid=SRID):
+    if geometry['type'] == 'GeometryCollection':
+        return _header('GeometryCollection', srid) + struct.pack('<I', len(geometry['geometries'])) + b''.join(
+            encode(member, None) for member in geometry['geometries']
+        )
+    return _header(geometry['type'], srid) + _body(geometry['type'], geometry['coordinates'])
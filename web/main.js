@@ -88,8 +88,11 @@ app.get('/states/:state/races/:race/years/:year/votes', (req, res) => {
     race: prettify(race),
     base: district(prettify(base)),
     overlay: district(prettify(overlay)),
-    baseURI: `/states/${state}/races/${race}/years/${year}/votes?group=${base}`,
-    overlayURI: `/states/${state}/races/${race}/years/${year}/votes?group=${overlay}`,
+    stateURI: `/states/${state}`,
+    raceName: race,
+    baseGroup: base,
+    overlayGroup: overlay,
+    topologyURI: `/states/${state}/races/${race}/years/${year}/topology`,
   })
 
   logResponse(id, res)